@@ -0,0 +1,23 @@
+"""
+Access control of the admin endpoints
+"""
+
+import hmac
+import os
+
+from fastapi import Header, HTTPException
+
+from .config import settings
+
+# options of the [admin] section in database.ini, an empty token disables the admin endpoints
+ADMIN_DEFAULTS = {'token': ''}
+
+options = settings(os.getenv('FILE_NAME'), 'admin', ADMIN_DEFAULTS)
+
+
+def require_admin(x_admin_token:str = Header(None)):
+  """Dependency rejecting requests without the admin token in the X-Admin-Token header"""
+  if not options['token']:
+    raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+  if x_admin_token is None or not hmac.compare_digest(x_admin_token, options['token']):
+    raise HTTPException(status_code=401, detail="Invalid admin token")
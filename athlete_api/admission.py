@@ -0,0 +1,207 @@
+"""
+Admission control for the query endpoints
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from starlette.responses import JSONResponse
+
+from .metrics import metrics
+
+# path prefixes of the query endpoints under admission control
+QUERY_PATHS = ('/country/', '/noc/', '/athletes/', '/compare', '/stats/', '/timeseries')
+
+# options of the [admission] section in database.ini
+ADMISSION_DEFAULTS = {'rate': 10.0, 'burst': 20, 'query_concurrency': 8, 'detail_concurrency': 2,
+                      'queue_size': 32, 'queue_timeout': 5.0, 'retry_after': 1,
+                      'max_clients': 10000, 'trust_forwarded': False}
+
+
+class TokenBucket:
+  """Token bucket refilled continuously at `rate` tokens per second up to `burst`
+
+  Args:
+      rate (float): tokens added per second
+      burst (int): bucket capacity
+  """
+  def __init__(self, rate:float, burst:int):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+
+  def take(self):
+    """Take one token
+
+    Returns:
+        float: 0 if a token was taken, else seconds until one is available
+    """
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+  """Token bucket per client, keeping the `max_clients` most recent clients
+
+  Args:
+      rate (float): requests per second per client
+      burst (int): requests a client may send at once
+      max_clients (int, optional): clients tracked before the oldest is dropped. Defaults to 10000.
+  """
+  def __init__(self, rate:float, burst:int, max_clients:int = 10000):
+    self.rate = rate
+    self.burst = burst
+    self.max_clients = max_clients
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def take(self, client:str):
+    """Take one token from the bucket of a client
+
+    Args:
+        client (str): client identifier
+
+    Returns:
+        float: 0 if the request is allowed, else seconds to wait
+    """
+    with self._lock:
+      bucket = self._buckets.pop(client, None) or TokenBucket(self.rate, self.burst)
+      self._buckets[client] = bucket
+      if len(self._buckets) > self.max_clients:
+        self._buckets.popitem(last=False)
+      return bucket.take()
+
+
+class ConcurrencyGate:
+  """Concurrency cap with a bounded wait queue
+
+  Args:
+      limit (int): requests executing at once
+      queue_size (int): requests allowed to wait for a slot
+      timeout (float): seconds a request waits before it is shed
+  """
+  def __init__(self, limit:int, queue_size:int, timeout:float):
+    self.limit = limit
+    self.queue_size = queue_size
+    self.timeout = timeout
+    self.waiting = 0
+    self.running = 0
+    self._semaphore = asyncio.Semaphore(limit)
+
+  async def acquire(self):
+    """Wait for a slot
+
+    Returns:
+        str: None once admitted, else the reason the request is shed
+    """
+    if self._semaphore.locked() and self.waiting >= self.queue_size:
+      return 'queue_full'
+    self.waiting += 1
+    try:
+      await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+    except asyncio.TimeoutError:
+      return 'queue_timeout'
+    finally:
+      self.waiting -= 1
+    self.running += 1
+    return None
+
+  def release(self):
+    """Free a slot"""
+    self.running -= 1
+    self._semaphore.release()
+
+
+def endpoint_class(scope:dict):
+  """Endpoint class of a request, None for requests not under admission control
+
+  Args:
+      scope (dict): ASGI scope of the request
+
+  Returns:
+      str: 'detail' for detail queries, 'query' for other query endpoints
+  """
+  if not scope['path'].startswith(QUERY_PATHS):
+    return None
+  query = parse_qs(scope.get('query_string', b'').decode())
+  if query.get('detail', ['false'])[0].lower() in ('true', '1', 'yes', 'on'):
+    return 'detail'
+  return 'query'
+
+
+class AdmissionMiddleware:
+  """ASGI middleware applying rate limits and concurrency caps to query endpoints
+
+  Requests over the client rate limit get 429, requests that find the wait queue
+  of their endpoint class full or wait too long get 503. Both carry Retry-After.
+
+  Args:
+      app: ASGI application
+      rate (float, optional): requests per second per client. Defaults to 10.
+      burst (int, optional): burst size per client. Defaults to 20.
+      query_concurrency (int, optional): concurrent summary queries. Defaults to 8.
+      detail_concurrency (int, optional): concurrent detail queries. Defaults to 2.
+      queue_size (int, optional): waiting requests per endpoint class. Defaults to 32.
+      queue_timeout (float, optional): seconds a request may wait. Defaults to 5.
+      retry_after (int, optional): Retry-After seconds for 503. Defaults to 1.
+      max_clients (int, optional): clients tracked by the rate limiter. Defaults to 10000.
+      trust_forwarded (bool, optional): identify clients by X-Forwarded-For. Defaults to False.
+  """
+  def __init__(self, app, rate:float = 10.0, burst:int = 20, query_concurrency:int = 8,
+               detail_concurrency:int = 2, queue_size:int = 32, queue_timeout:float = 5.0,
+               retry_after:int = 1, max_clients:int = 10000, trust_forwarded:bool = False):
+    self.app = app
+    self.limiter = RateLimiter(rate, burst, max_clients)
+    self.gates = {'query': ConcurrencyGate(query_concurrency, queue_size, queue_timeout),
+                  'detail': ConcurrencyGate(detail_concurrency, queue_size, queue_timeout)}
+    self.retry_after = retry_after
+    self.trust_forwarded = trust_forwarded
+
+  def client_id(self, scope:dict):
+    """Client identifier, the peer address or the first X-Forwarded-For address"""
+    if self.trust_forwarded:
+      for name, value in scope.get('headers', []):
+        if name == b'x-forwarded-for':
+          return value.decode().split(',')[0].strip()
+    client = scope.get('client')
+    return client[0] if client else 'unknown'
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or (kind := endpoint_class(scope)) is None:
+      await self.app(scope, receive, send)
+      return
+
+    wait = self.limiter.take(self.client_id(scope))
+    if wait:
+      metrics.inc('admission_shed_total', reason='rate_limit', endpoint_class=kind)
+      response = JSONResponse({'detail': 'Rate limit exceeded'}, status_code=429,
+                              headers={'Retry-After': str(math.ceil(wait))})
+      await response(scope, receive, send)
+      return
+
+    gate = self.gates[kind]
+    reason = await gate.acquire()
+    if reason:
+      metrics.inc('admission_shed_total', reason=reason, endpoint_class=kind)
+      response = JSONResponse({'detail': 'Server busy, retry later'}, status_code=503,
+                              headers={'Retry-After': str(self.retry_after)})
+      await response(scope, receive, send)
+      return
+
+    metrics.inc('admission_admitted_total', endpoint_class=kind)
+    metrics.set('admission_in_flight', gate.running, endpoint_class=kind)
+    try:
+      await self.app(scope, receive, send)
+    finally:
+      gate.release()
+      metrics.set('admission_in_flight', gate.running, endpoint_class=kind)
@@ -0,0 +1,251 @@
+"""
+Change log of the athlete and region tables, keeping the caches of every worker current
+"""
+
+import logging
+import threading
+import time
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session, SQLModel, delete, select
+
+from .metrics import metrics
+from .models import AthleteChange, CacheGeneration, Seasons
+
+logger = logging.getLogger(__name__)
+
+# options of the [changes] section in database.ini
+CHANGES_DEFAULTS = {'interval': 1.0, 'keep': 3600.0}
+
+# names of the generations in cache_generations
+ATHLETES = 'athletes'
+REGIONS = 'regions'
+# generation up to which the athlete log was pruned
+PRUNED = 'athlete_changes_pruned'
+
+# columns added to athlete_changes after its first release, logged entries before them lack them
+ADD_CHANGE_COLUMNS = """
+    ALTER TABLE athlete_changes ADD COLUMN IF NOT EXISTS noc VARCHAR,
+                                ADD COLUMN IF NOT EXISTS year INTEGER
+"""
+
+
+def create_tables(engine):
+  """Create the generation counters and the athlete log of a database, or add the columns it misses"""
+  SQLModel.metadata.create_all(engine, tables=[CacheGeneration.__table__, AthleteChange.__table__])
+  if engine.dialect.name == 'postgresql':
+    with engine.begin() as connection:
+      connection.execute(text(ADD_CHANGE_COLUMNS))
+
+
+def bump(session, name:str):
+  """Count a change of a cached table, in the transaction of the change
+
+  The counter row stays locked until the transaction ends, so concurrent changes
+  commit in the order of their generations.
+
+  Returns:
+      int: generation of the change
+  """
+  table = CacheGeneration.__table__
+  statement = insert(table).values(name=name, generation=1)
+  statement = statement.on_conflict_do_update(
+    index_elements=['name'], set_={'generation': table.c.generation + 1}).returning(table.c.generation)
+  return session.execute(statement).scalar_one()
+
+
+def generation(session, name:str):
+  """Committed generation of a cached table as seen by the session, 0 before its first change"""
+  value = session.execute(select(CacheGeneration.generation).where(CacheGeneration.name == name)).scalar()
+  return value or 0
+
+
+def repeatable_read(session):
+  """Read everything the session reads from the same snapshot of the database"""
+  # SQLite transactions are serializable already
+  if session.get_bind().dialect.name == 'postgresql':
+    session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+  return session
+
+
+def log_changes(session, added=(), removed=(), rebuild:bool = False):
+  """Log the athlete entries added and removed by a change, in the transaction of the change
+
+  Args:
+      session: session of the change, on the shard holding the entries
+      added (iterable, optional): (season, entry) pairs of the added entries
+      removed (iterable, optional): (season, entry) pairs of the removed entries
+      rebuild (bool, optional): the change is not described by entries, e.g. a cascade delete,
+        and readers rebuild their profiles. Defaults to False.
+
+  Returns:
+      int: generation of the change
+  """
+  number = bump(session, ATHLETES)
+  created = time.time()
+  rows = [{'generation': number, 'created': created, 'sign': sign, 'season': Seasons(season).value,
+           'name': entry.name, 'team': entry.team, 'games': entry.games, 'sport': entry.sport,
+           'medal': getattr(entry.medal, 'value', entry.medal), 'noc': entry.noc, 'year': entry.year}
+          for sign, entries in ((-1, removed), (1, added)) for season, entry in entries]
+  if rebuild:
+    rows.append({'generation': number, 'created': created, 'sign': 0})
+  if rows:
+    session.execute(insert(AthleteChange.__table__), rows)
+  return number
+
+
+class ChangeFeed:
+  """Applies the changes of every worker to the profiles, estimates and regions of this worker
+
+  Writers log the entries they add and remove with log_changes, in the
+  transaction of the change. The feed reads the log of each shard past the
+  generation its athlete indexes, the profiles and the cardinality estimates,
+  include, in one REPEATABLE READ transaction with the current generation,
+  applies it to every index behind and records the new generation. A worker
+  catches up right after its own writes, so it reads them at once, and a
+  background thread polls every `interval` seconds for the writes of the others.
+  Indexes built at known generations, from the database or a snapshot, continue
+  from there. An index of unknown generations, a change asking for it or a log
+  pruned past the applied generation rebuilds that index from the primaries.
+  The regions are rebuilt when their generation changes. Log entries are kept
+  `keep` seconds. `on_change` is called once changes were applied, e.g. to
+  refresh the snapshot.
+
+  Args:
+      router: router of the shards
+      profiles (AthleteProfiles): profiles to keep current
+      regions (RegionIndex): regions to keep current
+      interval (float, optional): seconds between polls. Defaults to 1.
+      keep (float, optional): seconds log entries are kept. Defaults to 3600.
+      on_change (optional): function called without arguments after changes were applied
+      cardinality (CardinalityIndex, optional): estimates of the cost guard to keep current
+  """
+  def __init__(self, router, profiles, regions, interval:float = 1.0, keep:float = 3600.0,
+               on_change=None, cardinality=None):
+    self.router = router
+    self.profiles = profiles
+    self.regions = regions
+    # athlete indexes with add, remove, build and per-shard generations
+    self.indexes = [profiles] + ([cardinality] if cardinality is not None else [])
+    self.interval = interval
+    self.keep = keep
+    self.on_change = on_change
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._pruned = 0.0
+
+  def start(self):
+    """Start polling in a background thread"""
+    self._thread = threading.Thread(target=self._run, name='changes', daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    """Stop polling"""
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join(timeout=30)
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      try:
+        self.catch_up()
+        if time.time() - self._pruned >= self.keep / 10:
+          self.prune()
+      except Exception:
+        metrics.inc('changes_errors_total')
+        logger.exception("Catching up with the change log failed")
+
+  def catch_up(self, shards=None):
+    """Apply the logged changes of some shards, then check the regions
+
+    Args:
+        shards (list, optional): shards written by the caller. Defaults to all shards.
+    """
+    with self._lock:
+      every = self.router.shards()
+      changed = False
+      current = []
+      for index in self.indexes:
+        if index.generations is None or len(index.generations) != len(every):
+          changed = self._rebuild(index, every)
+        else:
+          current.append(index)
+      for position, shard in enumerate(every):
+        if shards is not None and shard not in shards:
+          continue
+        applied, stale = self._apply(position, shard, current)
+        for index in stale:
+          current.remove(index)
+          changed = self._rebuild(index, every)
+        changed = changed or applied > 0
+      if self.regions.ready:
+        with Session(self.router.writer()) as session:
+          if generation(session, REGIONS) != self.regions.generation:
+            self.regions.build(self.router.writer())
+            changed = True
+    if changed and self.on_change:
+      self.on_change()
+
+  def install(self, profiles):
+    """Serve profiles built elsewhere, e.g. by a job, with the changes logged since they were read"""
+    with self._lock:
+      self.profiles.replace(profiles)
+    self.catch_up()
+
+  def _apply(self, position:int, shard, indexes):
+    """Apply the log of a shard to the indexes behind it, reading the log once
+
+    Returns:
+        tuple: number of generations applied, indexes needing a rebuild
+    """
+    if not indexes:
+      return 0, []
+    with repeatable_read(Session(shard.writer())) as session:
+      current = generation(session, ATHLETES)
+      behind = [index for index in indexes if index.generations[position] != current]
+      if not behind:
+        return 0, []
+      pruned = generation(session, PRUNED)
+      oldest = min(index.generations[position] for index in behind)
+      changes = session.exec(select(AthleteChange).where(AthleteChange.generation > oldest)
+                             .order_by(AthleteChange.generation, AthleteChange.id)).all()
+    applied, stale = 0, []
+    for index in behind:
+      since = index.generations[position]
+      missed = [change for change in changes if change.generation > since]
+      if current < since or pruned > since or any(change.sign == 0 for change in missed):
+        stale.append(index)
+        continue
+      for change in missed:
+        if change.sign > 0:
+          index.add(Seasons(change.season), change)
+        else:
+          index.remove(Seasons(change.season), change)
+      index.generations[position] = current
+      metrics.inc('changes_applied_total', len(missed), index=type(index).__name__)
+      applied = max(applied, current - since)
+    return applied, stale
+
+  def _rebuild(self, index, shards):
+    index.build(*(shard.writer() for shard in shards))
+    metrics.inc('changes_rebuilds_total', index=type(index).__name__)
+    return True
+
+  def prune(self):
+    """Delete the log entries older than `keep` seconds, readers behind them rebuild"""
+    self._pruned = time.time()
+    table = CacheGeneration.__table__
+    for shard in self.router.shards():
+      with Session(shard.writer()) as session:
+        newest = session.execute(select(func.max(AthleteChange.generation))
+                                 .where(AthleteChange.created < self._pruned - self.keep)).scalar()
+        if newest is None:
+          continue
+        statement = insert(table).values(name=PRUNED, generation=newest)
+        session.execute(statement.on_conflict_do_update(
+          index_elements=['name'], set_={'generation': func.greatest(table.c.generation, newest)}))
+        session.execute(delete(AthleteChange).where(AthleteChange.generation <= newest))
+        session.commit()
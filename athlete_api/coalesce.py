@@ -0,0 +1,132 @@
+"""
+Request coalescing for identical in-flight queries
+"""
+
+import inspect
+import threading
+from enum import Enum
+from functools import wraps
+
+from .metrics import metrics
+from .profiler import current_sampler
+from .timeouts import current_scope
+
+
+class _Call:
+  """In-flight execution shared by the callers of one key"""
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+    self.scope = current_scope.get()
+
+
+class SingleFlight:
+  """Runs a function once per key at a time and shares its result with concurrent callers
+
+  Args:
+      name (str): name used to label the metrics of this group
+  """
+  def __init__(self, name:str):
+    self.name = name
+    self._calls = {}
+    self._lock = threading.Lock()
+
+  def do(self, key, fn):
+    """Run `fn` for `key`, or wait for the execution already in flight for `key`
+
+    Args:
+        key: hashable identity of the call
+        fn: function without arguments computing the result
+
+    Returns:
+        result of `fn`, raises its exception for every waiting caller
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+    metrics.inc('coalesce_requests_total', endpoint=self.name)
+
+    if not leader:
+      metrics.inc('coalesce_shared_total', endpoint=self.name)
+      scope = current_scope.get()
+      if scope and call.scope:
+        # the shared query is only cancelled once all of its clients are gone
+        scope.join(call.scope)
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = fn()
+    except BaseException as error:
+      call.error = error
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+
+def normalize(value):
+  """Hashable form of a parameter value for the request key
+
+  Strings are kept as sent: endpoints do not all treat case or surrounding spaces
+  alike, e.g. exact region matches, so only identical requests may share a result.
+  """
+  if isinstance(value, Enum):
+    return value.value
+  if isinstance(value, (list, tuple)):
+    return tuple(normalize(item) for item in value)
+  return value
+
+
+def request_key(func, *args, **kwargs):
+  """Parameters of a call to an endpoint function, identical for identical requests
+
+  Args:
+      func: endpoint function
+      args, kwargs: arguments of the call
+
+  Returns:
+      tuple: sorted (parameter, normalized value) pairs including defaults
+  """
+  bound = inspect.signature(func).bind(*args, **kwargs)
+  bound.apply_defaults()
+  return tuple(sorted((name, normalize(value)) for name, value in bound.arguments.items()))
+
+
+# functions called with the endpoint name and the normalized key of every coalesced call
+observers = []
+
+
+def observe(observer):
+  """Register a function called with (endpoint name, request key) on every coalesced call"""
+  observers.append(observer)
+
+
+def coalesce(func):
+  """Decorator coalescing concurrent calls of an endpoint with the same normalized parameters
+
+  The wrapper keeps the signature of `func`, so FastAPI resolves the same parameters.
+  """
+  group = SingleFlight(func.__name__)
+
+  @wraps(func)
+  def wrapper(*args, **kwargs):
+    key = request_key(func, *args, **kwargs)
+    for observer in observers:
+      observer(func.__name__, key)
+    sampler = current_sampler.get()
+    if sampler is not None:
+      # a profiled request runs on its own, so its profile shows the work and not a wait
+      with sampler.track():
+        return func(*args, **kwargs)
+    return group.do(key, lambda: func(*args, **kwargs))
+
+  wrapper.group = group
+  return wrapper
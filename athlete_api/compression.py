@@ -0,0 +1,166 @@
+"""
+Response compression with size-aware thresholds
+"""
+
+import gzip
+import time
+
+import anyio
+
+from .metrics import metrics
+
+try:
+  import brotli
+except ImportError:  # optional dependency
+  brotli = None
+
+try:
+  import zstandard
+except ImportError:  # optional dependency
+  zstandard = None
+
+# options of the [compression] section in database.ini
+COMPRESSION_DEFAULTS = {'minimum_size': 1024, 'level': 6, 'offload_size': 262144}
+
+
+def _gzip(body:bytes, level:int):
+  return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body:bytes, level:int):
+  return brotli.compress(body, quality=min(level, 11))
+
+
+def _zstd(body:bytes, level:int):
+  return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+def add_vary(headers:list, field:str):
+  """Response headers with `field` merged into their Vary header, keeping a single one
+
+  Args:
+      headers (list): (name, value) pairs of ASGI response headers
+      field (str): request header the response varies on
+
+  Returns:
+      list: headers with one Vary header listing the existing fields and `field`
+  """
+  fields = [name.strip() for header, value in headers if header == b'vary'
+            for name in value.decode('latin-1').split(',') if name.strip()]
+  if '*' not in fields and field.lower() not in (name.lower() for name in fields):
+    fields.append(field)
+  others = [(header, value) for header, value in headers if header != b'vary']
+  return others + [(b'vary', ', '.join(fields).encode('latin-1'))]
+
+
+def _timed(compress, body:bytes, level:int):
+  """Compress and measure the CPU time of the compressing thread"""
+  started = time.thread_time()
+  compressed = compress(body, level)
+  return compressed, time.thread_time() - started
+
+
+def available_encodings():
+  """Content encodings supported in this environment, in order of preference"""
+  encodings = {}
+  if brotli is not None:
+    encodings['br'] = _brotli
+  if zstandard is not None:
+    encodings['zstd'] = _zstd
+  encodings['gzip'] = _gzip
+  return encodings
+
+
+def choose_encoding(accept_encoding:str, encodings:dict):
+  """Preferred encoding accepted by the client, None if there is none
+
+  Args:
+      accept_encoding (str): Accept-Encoding header of the request
+      encodings (dict): supported encodings in order of preference
+
+  Returns:
+      str: content encoding to use
+  """
+  accepted = set()
+  for item in accept_encoding.split(','):
+    name, _, params = item.strip().partition(';')
+    if params.strip().replace(' ', '') in ('q=0', 'q=0.0'):
+      continue
+    accepted.add(name.strip().lower())
+  for name in encodings:
+    if name in accepted or '*' in accepted:
+      return name
+  return None
+
+
+class CompressionMiddleware:
+  """ASGI middleware compressing single-message responses above a minimum size
+
+  Bodies of at least `offload_size` bytes are compressed in a worker thread so
+  large detail responses do not block the event loop. Streaming responses and
+  responses that already carry a Content-Encoding are passed through.
+
+  Args:
+      app: ASGI application
+      minimum_size (int, optional): smallest body to compress in bytes. Defaults to 1024.
+      level (int, optional): compression level. Defaults to 6.
+      offload_size (int, optional): smallest body compressed off the event loop. Defaults to 256 KiB.
+  """
+  def __init__(self, app, minimum_size:int = 1024, level:int = 6, offload_size:int = 262144):
+    self.app = app
+    self.minimum_size = minimum_size
+    self.level = level
+    self.offload_size = offload_size
+    self.encodings = available_encodings()
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      await self.app(scope, receive, send)
+      return
+    accept = dict(scope.get('headers', [])).get(b'accept-encoding', b'').decode('latin-1')
+    encoding = choose_encoding(accept, self.encodings)
+    if encoding is None:
+      await self.app(scope, receive, send)
+      return
+
+    start_message = None
+    passthrough = False
+
+    async def send_compressed(message):
+      nonlocal start_message, passthrough
+      if passthrough:
+        await send(message)
+        return
+      if message['type'] == 'http.response.start':
+        start_message = message
+        return
+      headers = dict(start_message.get('headers', []))
+      if message.get('more_body') or b'content-encoding' in headers:
+        passthrough = True
+        await send(start_message)
+        await send(message)
+        return
+
+      body = message.get('body', b'')
+      if len(body) < self.minimum_size:
+        await send(start_message)
+        await send(message)
+        return
+
+      compress = self.encodings[encoding]
+      if len(body) >= self.offload_size:
+        compressed, cpu = await anyio.to_thread.run_sync(_timed, compress, body, self.level)
+      else:
+        compressed, cpu = _timed(compress, body, self.level)
+      metrics.inc('compression_cpu_seconds_total', cpu, encoding=encoding)
+      metrics.inc('compression_bytes_in_total', len(body), encoding=encoding)
+      metrics.inc('compression_bytes_out_total', len(compressed), encoding=encoding)
+
+      headers = [(name, value) for name, value in start_message.get('headers', [])
+                 if name != b'content-length']
+      headers += [(b'content-encoding', encoding.encode()),
+                  (b'content-length', str(len(compressed)).encode())]
+      await send({**start_message, 'headers': add_vary(headers, 'Accept-Encoding')})
+      await send({'type': 'http.response.body', 'body': compressed})
+
+    await self.app(scope, receive, send_compressed)
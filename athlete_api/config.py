@@ -2,8 +2,11 @@
 Config parser function
 """
 from configparser import ConfigParser
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 
 def config(filename:str, section:str):
     """
@@ -17,7 +20,7 @@ def config(filename:str, section:str):
       Postgresql object with configuration parameters from the config file or empty if not found. 
     """
     # Read the config file and return a dictionary of parameters
-    print(filename)
+    logger.debug("Reading config", extra={'filename': filename, 'section': section})
     # create a parser
     if os.path.isfile(filename):
         parser = ConfigParser()
@@ -25,8 +28,7 @@ def config(filename:str, section:str):
         parser.read(filename)
         # get section, default to postgresql
         db = {}
-        print(list(parser.items()))
-        print(parser.sections())
+        logger.debug("Config sections", extra={'sections': parser.sections()})
         if parser.has_section(section):
             params = parser.items(section)
             for param in params:
@@ -36,3 +38,57 @@ def config(filename:str, section:str):
     else:
         raise Exception(f'Config file {filename} not found')
     return db
+
+
+def sections(filename:str, prefix:str):
+    """
+    List sections of the config file whose name starts with a prefix.
+
+    Args:
+      filename: Name of the config file
+      prefix: Section name prefix to match e.g. 'postgresql_replica'
+
+    Returns:
+      Sorted list of matching section names, empty if the file is not found.
+    """
+    if not filename or not os.path.isfile(filename):
+        return []
+    parser = ConfigParser()
+    parser.read(filename)
+    return sorted(name for name in parser.sections() if name.startswith(prefix))
+
+
+def settings(filename:str, section:str, defaults:dict):
+    """
+    Read an optional section of the config file on top of default values.
+
+    Values are cast to the type of the matching default, so the defaults double as
+    the schema of the section. Unknown keys are ignored.
+
+    Args:
+      filename: Name of the config file
+      section: Name of the section to read
+      defaults: Default values for every supported key
+
+    Returns:
+      Dictionary with the defaults overridden by the values found in the section.
+    """
+    values = dict(defaults)
+    if not filename or not os.path.isfile(filename):
+        return values
+    parser = ConfigParser()
+    parser.read(filename)
+    if not parser.has_section(section):
+        return values
+    for key, default in defaults.items():
+        if not parser.has_option(section, key):
+            continue
+        if isinstance(default, bool):
+            values[key] = parser.getboolean(section, key)
+        elif isinstance(default, int):
+            values[key] = parser.getint(section, key)
+        elif isinstance(default, float):
+            values[key] = parser.getfloat(section, key)
+        else:
+            values[key] = parser.get(section, key)
+    return values
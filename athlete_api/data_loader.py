@@ -1,23 +1,231 @@
 """
 Data loader function
 """
+import csv
+import logging
 import os
+import tempfile
+import time
+from collections import namedtuple
 from typing import List
 
 from sqlmodel import Session
 
+from athlete_api.config import settings
+from athlete_api.medals import REBUILD_EVENT_MEDALS
 from athlete_api.services import connect
 
 os.environ['FILE_NAME'] = './athlete_api/database.ini'
 os.environ['SECTION_NAME'] = 'postgresql'
 
 # Connect to PostgreSQL
-engine = connect(filename=os.getenv('FILE_NAME'), section=os.getenv('SECTION_NAME'), echo=True)
+engine = connect(filename=os.getenv('FILE_NAME'), section=os.getenv('SECTION_NAME'))
+
+# options of the [loader] section in database.ini
+LOADER_DEFAULTS = {'data_directory': '/var/lib/postgresql/csv_data',
+                   'quarantine_directory': 'quarantine', 'chunk_size': 10000}
+
+REGION_COLUMNS = ('noc', 'region', 'notes')
+ATHLETE_COLUMNS = ('name', 'sex', 'age', 'team', 'noc', 'games', 'year', 'season',
+                   'city', 'sport', 'event', 'medal')
+MEDALS = {'', 'Gold', 'Silver', 'Bronze'}
+
+logger = logging.getLogger(__name__)
+
+LoadReport = namedtuple('LoadReport', ['table', 'rows', 'loaded', 'quarantined', 'seconds'])
+
+
+def _is_float(value:str):
+    if value == '':
+        return True
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_int(value:str):
+    return value == '' or value.lstrip('-').isdigit()
+
+
+def _max_length(length:int):
+    return lambda value: len(value) <= length
+
+
+def region_checks():
+    """
+    Column checks of the regions CSV, a list of (column, check, reason) tuples.
+    """
+    return [('noc', lambda value: len(value) == 3, 'NOC must have 3 characters')]
+
+
+def athlete_checks(nocs):
+    """
+    Column checks of the athletes CSVs, a list of (column, check, reason) tuples.
+
+    Args:
+      nocs: NOCs of the regions table, empty NOCs are loaded as NULL
+
+    Returns:
+      List of checks mirroring the column types and constraints of the athlete tables.
+    """
+    nocs = set(nocs) | {''}
+    checks = [('sex', lambda value: value in ('', 'M', 'F'), 'sex must be M or F'),
+              ('age', _is_float, 'age is not a number'),
+              ('year', _is_int, 'year is not an integer'),
+              ('noc', nocs.__contains__, 'NOC not found in regions'),
+              ('medal', MEDALS.__contains__, 'medal must be Gold, Silver or Bronze')]
+    checks += [(column, _max_length(255), 'longer than 255 characters')
+               for column in ('name', 'team', 'games', 'season', 'city', 'sport', 'event')]
+    return checks
+
+
+def validate_chunk(rows, columns, checks):
+    """
+    Validate a chunk of CSV rows column by column.
+
+    Args:
+      rows: list of rows as lists of strings
+      columns: expected column names
+      checks: list of (column, check, reason) tuples
+
+    Returns:
+      List with the failure reasons of every row, empty for valid rows.
+    """
+    reasons = [[] for _ in rows]
+    complete = []
+    for index, row in enumerate(rows):
+        if len(row) == len(columns):
+            complete.append(index)
+        else:
+            reasons[index].append(f'expected {len(columns)} fields, found {len(row)}')
+    if not complete:
+        return reasons
+    values = list(zip(*(rows[index] for index in complete)))
+    for column, check, reason in checks:
+        for index, valid in zip(complete, map(check, values[columns.index(column)])):
+            if not valid:
+                reasons[index].append(f'{column}: {reason}')
+    return reasons
+
+
+def validate_rows(rows, columns, checks, key=tuple, chunk_size:int = 10000):
+    """
+    Validate CSV rows in chunks and flag duplicates.
+
+    Args:
+      rows: iterable of rows as lists of strings, without the header
+      columns: expected column names
+      checks: list of (column, check, reason) tuples
+      key: function returning the identity of a row for the duplicate check
+      chunk_size: number of rows validated at once
+
+    Returns:
+      Generator of (line, row, reasons) tuples, line numbers start after the header.
+    """
+    seen = {}
+    rows = iter(rows)
+    line = 1
+    while True:
+        chunk = [row for _, row in zip(range(chunk_size), rows)]
+        if not chunk:
+            return
+        for row, reasons in zip(chunk, validate_chunk(chunk, columns, checks)):
+            line += 1
+            if not reasons:
+                first = seen.setdefault(key(row), line)
+                if first != line:
+                    reasons.append(f'duplicate of line {first}')
+            yield line, row, reasons
+
+
+def load_csv(cursor, table:str, columns, path:str, checks, key=tuple,
+             quarantine_directory:str = None, chunk_size:int = 10000, keep=None):
+    """
+    Validate a CSV file and copy its clean rows into a table.
+
+    Rows failing a check are written with their line number and reasons to
+    `<quarantine_directory>/<table>.csv` instead of aborting the whole COPY.
+
+    Args:
+      cursor: DBAPI cursor inside the loading transaction
+      table: name of the table to load
+      columns: columns of the table in the order of the CSV file
+      path: CSV file with a header line
+      checks: list of (column, check, reason) tuples
+      key: function returning the identity of a row for the duplicate check
+      quarantine_directory: directory of the quarantine files, None to drop bad rows
+      chunk_size: number of rows validated at once
+      keep: function telling if a valid row belongs in this table, e.g. to the NOCs of a shard,
+            None to load every valid row
+
+    Returns:
+      LoadReport with the row counts and the elapsed time.
+    """
+    started = time.perf_counter()
+    rows = loaded = quarantined = 0
+    quarantine = None
+    with open(path, newline='') as source, \
+            tempfile.SpooledTemporaryFile(max_size=64 * 2**20, mode='w+', newline='') as clean:
+        reader = csv.reader(source)
+        next(reader, None)
+        writer = csv.writer(clean)
+        try:
+            for line, row, reasons in validate_rows(reader, columns, checks, key, chunk_size):
+                rows += 1
+                if not reasons:
+                    if keep is None or keep(row):
+                        writer.writerow(row)
+                        loaded += 1
+                    continue
+                quarantined += 1
+                if quarantine_directory is None:
+                    continue
+                if quarantine is None:
+                    os.makedirs(quarantine_directory, exist_ok=True)
+                    quarantine = open(os.path.join(quarantine_directory, f'{table}.csv'), 'w',
+                                      newline='')
+                    csv.writer(quarantine).writerow(('line', 'reasons') + tuple(columns))
+                csv.writer(quarantine).writerow([line, '; '.join(reasons)] + row)
+        finally:
+            if quarantine is not None:
+                quarantine.close()
+        clean.seek(0)
+        cursor.copy_expert(f"COPY {table}({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", clean)
+    report = LoadReport(table, rows, loaded, quarantined, time.perf_counter() - started)
+    logger.info("Loaded %s of %s rows into %s", report.loaded, report.rows, table,
+                extra={'table': table, 'quarantined': report.quarantined,
+                       'rows_per_second': round(report.rows / max(report.seconds, 1e-9))})
+    return report
+
 
 # Create sequences and tables
-def data_loader(dbName:str = None):
+def data_loader(dbName:str = None, target=None, owns=None):
+    """
+    Create the sequence and tables if they do not exist and load them from the CSV files.
 
-    with Session(engine) as session:
+    Every file is validated before loading, rows failing a check are written to a
+    quarantine file and the clean rows are copied in one pass.
+
+    Args:
+      target: engine of the database to load, defaults to the configured database
+      owns: function telling if a NOC belongs to the database, e.g. to a shard,
+            None to load the athletes of every NOC
+    """
+    options = settings(os.getenv('FILE_NAME'), 'loader', LOADER_DEFAULTS)
+    data_directory = options.pop('data_directory')
+    options['quarantine_directory'] = options['quarantine_directory'] or None
+    regions_file = os.path.join(data_directory, 'regions_clean.csv')
+    summer_file = os.path.join(data_directory, 'Athletes_summer_games_clean.csv')
+    winter_file = os.path.join(data_directory, 'Athletes_winter_games_clean.csv')
+
+    athlete_options = dict(options)
+    if owns is not None:
+        noc_column = ATHLETE_COLUMNS.index('noc')
+        athlete_options['keep'] = lambda row: owns(row[noc_column])
+
+    with Session(target or engine) as session:
         # Create sequence if it doesn't exist
         sequence_exists= session.execute("""
                 SELECT EXISTS (
@@ -100,39 +308,60 @@ def data_loader(dbName:str = None):
             );
         """
 
-        # Copy data from CSV files
-        copy_regions_query = """
-            COPY regions(noc, region, notes)
-            FROM '/var/lib/postgresql/csv_data/regions_clean.csv'
-            DELIMITER ','
-            CSV HEADER;
-        """
+        event_medals_table_exists = session.execute("""
+            SELECT EXISTS (
+                SELECT 1
+                FROM information_schema.tables
+                WHERE table_name = 'event_medals'
+            )
+        """).fetchone()[0]
 
-        copy_athletes_summer_query = """
-            COPY athletes_summer(name, sex, age, team, noc, games, year, season, city, sport, event, medal)
-            FROM '/var/lib/postgresql/csv_data/Athletes_summer_games_clean.csv'
-            DELIMITER ','
-            CSV HEADER;
+        # one row per medal won in an event, so team medals are counted once
+        create_event_medals_table_query = """
+            CREATE TABLE event_medals (
+                games VARCHAR(255),
+                event VARCHAR(255),
+                noc CHAR(3) REFERENCES regions (noc) ON DELETE CASCADE ON UPDATE CASCADE,
+                medal VARCHAR,
+                year INTEGER,
+                season VARCHAR(255),
+                sport VARCHAR(255),
+                entries INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (games, event, noc, medal)
+            );
+            CREATE INDEX event_medals_noc_year ON event_medals (noc, year);
         """
 
-        copy_athletes_winter_query = """
-            COPY athletes_winter(name, sex, age, team, noc, games, year, season, city, sport, event, medal)
-            FROM '/var/lib/postgresql/csv_data/Athletes_winter_games_clean.csv'
-            DELIMITER ','
-            CSV HEADER;
+        # noc IN (...) filters compare the column, noc equal filters compare lower(noc)
+        create_noc_indexes_query = """
+            CREATE INDEX IF NOT EXISTS athletes_summer_noc ON athletes_summer (noc);
+            CREATE INDEX IF NOT EXISTS athletes_summer_lower_noc ON athletes_summer (lower(noc));
+            CREATE INDEX IF NOT EXISTS athletes_winter_noc ON athletes_winter (noc);
+            CREATE INDEX IF NOT EXISTS athletes_winter_lower_noc ON athletes_winter (lower(noc));
         """
 
     # Execute the queries
         if not sequence_exists:
             session.execute(create_sequences_query)
+        # Validate the CSV files and copy the clean rows
+        cursor = session.connection().connection.cursor()
         if not regions_table_exists:
             session.execute(create_regions_table_query)
-            session.execute(copy_regions_query)
+            load_csv(cursor, 'regions', REGION_COLUMNS, regions_file, region_checks(),
+                     key=lambda row: row[0], **options)
+        nocs = {noc for noc, in session.execute("SELECT noc FROM regions")}
         if not athletes_summer_table_exists:
             session.execute(create_athletes_summer_table_query)
-            session.execute(copy_athletes_summer_query)
+            load_csv(cursor, 'athletes_summer', ATHLETE_COLUMNS, summer_file,
+                     athlete_checks(nocs), **athlete_options)
         if not athletes_winter_table_exists:
             session.execute(create_athletes_winter_table_query)
-            session.execute(copy_athletes_winter_query)
+            load_csv(cursor, 'athletes_winter', ATHLETE_COLUMNS, winter_file,
+                     athlete_checks(nocs), **athlete_options)
+        if not event_medals_table_exists:
+            session.execute(create_event_medals_table_query)
+            session.execute(REBUILD_EVENT_MEDALS)
+        # also added to tables created before the indexes existed
+        session.execute(create_noc_indexes_query)
         session.commit()
         session.close()
@@ -0,0 +1,185 @@
+"""
+Query cost guard rejecting over-broad searches before they run
+"""
+
+import threading
+from collections import Counter, defaultdict
+
+from fastapi import HTTPException
+from sqlmodel import Session, func, select
+
+from .changes import ATHLETES, generation, repeatable_read
+from .metrics import metrics
+from .models import AthleteSummer, AthleteWinter
+
+# options of the [guard] section in database.ini
+GUARD_DEFAULTS = {'enabled': True, 'max_rows': 50000, 'detail_max_rows': 10000, 'ngram': 3}
+
+
+class CardinalityIndex:
+  """Entry counts per NOC, year and sport, per name and per name n-gram
+
+  The athlete filters compare lower-cased columns, so Postgres has no column
+  statistics for them and plans substring searches with a default selectivity.
+  These counts give an upper bound of the matching entries instead: a name
+  containing a search string contains every n-gram of it, so the entries are
+  at most the count of its rarest n-gram. Like the profiles, the counts are kept
+  current with `add` and `remove` by the ChangeFeed of the worker, past
+  `generations`, the generation of each shard they include.
+
+  Args:
+      n (int, optional): longest n-gram counted. Defaults to 3.
+  """
+  def __init__(self, n:int = 3):
+    self.n = n
+    self.ready = False
+    self.generations = None
+    self._nocs = {}
+    self._names = Counter()
+    self._grams = Counter()
+    self._lock = threading.Lock()
+
+  def build(self, *engines):
+    """Count the entries of the athlete tables
+
+    Each shard is read in one transaction with the generation of its athlete
+    tables, so the change feed continues from the state read.
+
+    Args:
+        engines: engines to read the athlete tables from, one per shard, in the order of the shards
+    """
+    nocs, names, generations = defaultdict(Counter), Counter(), []
+    for engine in engines:
+      with repeatable_read(Session(engine)) as session:
+        generations.append(generation(session, ATHLETES))
+        for model in (AthleteSummer, AthleteWinter):
+          name, sport = func.lower(model.name), func.lower(model.sport)
+          statement = select(model.noc, model.year, sport, func.count()).group_by(model.noc, model.year, sport)
+          for noc, year, sport_name, count in session.execute(statement):
+            nocs[noc.upper() if noc else noc][year, sport_name] += count
+          for athlete_name, count in session.execute(select(name, func.count()).group_by(name)):
+            names[athlete_name] += count
+    self._replace(nocs, names, generations)
+
+  def build_from_snapshot(self, snapshot):
+    """Count the entries of the athlete tables of a memory-mapped snapshot, reading every entry"""
+    nocs, names = defaultdict(Counter), Counter()
+    for model in (AthleteSummer, AthleteWinter):
+      table = model.__tablename__
+      for noc, year, sport in zip(snapshot.values(table, 'noc'), snapshot.values(table, 'year'),
+                                  snapshot.values(table, 'sport')):
+        nocs[noc.upper() if noc else noc][year, sport.lower() if sport else sport] += 1
+      names.update(name.lower() for name in snapshot.values(model.__tablename__, 'name') if name)
+    cache_generations = snapshot.cache_generations
+    self._replace(nocs, names, list(cache_generations['athletes']) if cache_generations else None)
+
+  def _replace(self, nocs, names, generations):
+    grams = Counter()
+    for name, count in names.items():
+      for gram in self.grams(name):
+        grams[gram] += count
+    with self._lock:
+      self._nocs, self._names, self._grams = nocs, names, grams
+      self.generations = generations
+      self.ready = True
+
+  def add(self, season, athlete):
+    """Count an entry
+
+    Args:
+        season (Seasons): season table of the entry, counted alike
+        athlete: entry with name, noc, year and sport attributes
+    """
+    self._update(athlete, 1)
+
+  def remove(self, season, athlete):
+    """Uncount an entry
+
+    Args:
+        season (Seasons): season table of the entry, counted alike
+        athlete: entry with name, noc, year and sport attributes
+    """
+    self._update(athlete, -1)
+
+  def _update(self, athlete, sign:int):
+    sport = athlete.sport.lower() if athlete.sport else athlete.sport
+    with self._lock:
+      # entries logged before the log recorded their NOC only count by name
+      if athlete.noc:
+        self._count(self._nocs.setdefault(athlete.noc.upper(), Counter()), (athlete.year, sport), sign)
+      if athlete.name:
+        name = athlete.name.lower()
+        self._count(self._names, name, sign)
+        for gram in self.grams(name):
+          self._count(self._grams, gram, sign)
+
+  @staticmethod
+  def _count(counts, key, sign:int):
+    """Add sign to a count, dropping counts that reach zero"""
+    counts[key] += sign
+    if counts[key] <= 0:
+      del counts[key]
+
+  def grams(self, text:str):
+    """Distinct n-grams of a text, the whole text if it is shorter than n"""
+    if len(text) <= self.n:
+      return {text, *(text[start:start + size] for size in range(1, len(text))
+                      for start in range(len(text) - size + 1))}
+    return {text[start:start + size] for size in range(1, self.n + 1)
+            for start in range(len(text) - size + 1)}
+
+  def name_rows(self, name:str, exact:bool = False):
+    """Upper bound of the entries of the athletes matching a name"""
+    name = name.strip().lower()
+    with self._lock:
+      if exact:
+        return self._names.get(name, 0)
+      if len(name) <= self.n:
+        return self._grams.get(name, 0)
+      return min(self._grams.get(name[start:start + self.n], 0)
+                 for start in range(len(name) - self.n + 1))
+
+  def noc_rows(self, nocs, start_date:int = None, end_date:int = None, sport:str = None):
+    """Entries of some NOCs, in the years from start_date to end_date and of a sport if given"""
+    sport = sport.lower() if sport else None
+    with self._lock:
+      counts = [self._nocs.get(noc.upper(), {}) for noc in {noc.upper() for noc in nocs}]
+    return sum(count for per_noc in counts for (year, entry_sport), count in per_noc.items()
+               if (not start_date or (year or 0) >= start_date)
+               and (not end_date or (year or 0) <= end_date)
+               and (not sport or entry_sport == sport))
+
+
+class CostGuard:
+  """Rejects queries whose estimated entries exceed a limit with a 400 explaining why
+
+  Args:
+      index (CardinalityIndex): counts the estimates come from
+      enabled (bool, optional): check queries. Defaults to True.
+      max_rows (int, optional): entries a summary query may aggregate. Defaults to 50000.
+      detail_max_rows (int, optional): entries a detail query may return. Defaults to 10000.
+  """
+  def __init__(self, index, enabled:bool = True, max_rows:int = 50000, detail_max_rows:int = 10000):
+    self.index = index
+    self.enabled = enabled
+    self.max_rows = max_rows
+    self.detail_max_rows = detail_max_rows
+
+  def check(self, endpoint:str, rows:int, detail:bool = False, hint:str = ''):
+    """Raise a 400 if the estimated entries of a query exceed the limit
+
+    Args:
+        endpoint (str): endpoint name for the metrics
+        rows (int): estimated entries
+        detail (bool, optional): query returning the entries. Defaults to False.
+        hint (str, optional): how to narrow the query
+    """
+    if not self.enabled or not self.index.ready:
+      return
+    limit = self.detail_max_rows if detail else self.max_rows
+    metrics.inc('guard_checked_total', endpoint=endpoint)
+    if rows > limit:
+      metrics.inc('guard_rejected_total', endpoint=endpoint)
+      raise HTTPException(status_code=400,
+                          detail=f"Query too broad: up to {rows} matching entries, "
+                                 f"the limit is {limit}. {hint}".strip())
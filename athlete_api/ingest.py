@@ -0,0 +1,239 @@
+"""
+Write-behind buffered ingestion of athlete entries
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, DisconnectionError, IntegrityError, OperationalError
+from sqlmodel import Session, text
+
+from .changes import log_changes
+from .medals import record_medals
+from .metrics import metrics
+from .profiles import season_of
+
+logger = logging.getLogger(__name__)
+
+# options of the [ingest] section in database.ini
+INGEST_DEFAULTS = {'buffered': False, 'batch_size': 500, 'flush_interval': 0.5,
+                   'id_block': 1000, 'max_pending': 10000, 'sequence': 'athletes_id_seq',
+                   'quarantine_directory': 'quarantine'}
+
+# errors of the database, not of the entries: the entries are buffered again and retried
+TRANSIENT_ERRORS = (OperationalError, DisconnectionError)
+# errors of an entry the database refuses, the entry is quarantined
+DATA_ERRORS = (IntegrityError, DataError)
+
+
+class BufferFull(Exception):
+  """Raised when the buffer holds `max_pending` entries"""
+
+
+class IdBlocks:
+  """Ids of the shared athlete sequence fetched in blocks
+
+  Args:
+      engine: engine of the database holding the sequence
+      sequence (str, optional): sequence name. Defaults to 'athletes_id_seq'.
+      block (int, optional): ids fetched per round trip. Defaults to 1000.
+  """
+  def __init__(self, engine, sequence:str = 'athletes_id_seq', block:int = 1000):
+    self.engine = engine
+    self.sequence = sequence
+    self.block = block
+    self._ids = []
+    self._lock = threading.Lock()
+
+  def next(self):
+    """Next free id, fetching a new block when the current one is used up"""
+    with self._lock:
+      if not self._ids:
+        with self.engine.connect() as connection:
+          ids = connection.execute(text("SELECT nextval(:sequence) FROM generate_series(1, :block)"),
+                                   {'sequence': self.sequence, 'block': self.block}).scalars().all()
+        self._ids = sorted(ids, reverse=True)
+        metrics.inc('ingest_id_blocks_total')
+      return self._ids.pop()
+
+
+class IngestBuffer:
+  """Acknowledges validated athlete entries at once and inserts them in batches
+
+  Entries accepted by `put` get their id from an IdBlocks of their shard, so the
+  response can carry it. A flusher thread writes the buffer with one multi-row
+  insert per table and one upsert of event_medals in a single transaction per
+  shard once `batch_size` entries are waiting or `flush_interval` seconds passed.
+  A batch failing on a lost or unavailable database is buffered again and retried
+  on the next flush. Other failures are retried entry by entry so one bad entry
+  does not drop the others; entries the database refuses with an integrity or
+  data error are written to `<quarantine_directory>/ingest.jsonl`. Entries are
+  visible to the read endpoints once flushed; `close` flushes what is left on
+  shutdown.
+
+  Args:
+      router: EngineRouter or ShardRouter of the databases to write to
+      batch_size (int, optional): entries triggering a flush. Defaults to 500.
+      flush_interval (float, optional): seconds between flushes. Defaults to 0.5.
+      id_block (int, optional): ids fetched from the sequence at once. Defaults to 1000.
+      max_pending (int, optional): buffered entries before `put` raises BufferFull. Defaults to 10000.
+      sequence (str, optional): sequence of the athlete ids. Defaults to 'athletes_id_seq'.
+      quarantine_directory (str, optional): directory of the quarantine file, None to only log
+        refused entries. Defaults to None.
+      on_flush (optional): function called with the flushed entries after the commit
+  """
+  def __init__(self, router, batch_size:int = 500, flush_interval:float = 0.5, id_block:int = 1000,
+               max_pending:int = 10000, sequence:str = 'athletes_id_seq', quarantine_directory:str = None,
+               on_flush=None):
+    self.router = router
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_pending = max_pending
+    self.quarantine_directory = quarantine_directory
+    self.on_flush = on_flush
+    self.ids = {shard.writer(): IdBlocks(shard.writer(), sequence, id_block)
+                for shard in router.shards()}
+    self._pending = []
+    self._pending_ids = set()
+    self._condition = threading.Condition()
+    self._flush_lock = threading.Lock()
+    self._retrying = False
+    self._closed = False
+    self._thread = None
+
+  def start(self):
+    """Start the flusher thread and flush the buffer at interpreter exit"""
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name='ingest-flush', daemon=True)
+      self._thread.start()
+      atexit.register(self.close)
+    return self
+
+  def put(self, db_athlete):
+    """Buffer an athlete entry
+
+    Args:
+        db_athlete: AthleteSummer or AthleteWinter without id
+
+    Returns:
+        int: id assigned to the entry
+    """
+    ids = self.ids[self.router.shard(db_athlete.noc).writer()]
+    with self._condition:
+      if len(self._pending) >= self.max_pending:
+        metrics.inc('ingest_rejected_total')
+        raise BufferFull(f'{self.max_pending} entries waiting to be flushed')
+      # only accepted entries take an id, a new block is fetched once per `id_block` entries
+      db_athlete.id = ids.next()
+      self._pending.append(db_athlete)
+      self._pending_ids.add(db_athlete.id)
+      metrics.inc('ingest_buffered_total')
+      metrics.set('ingest_pending', len(self._pending))
+      if len(self._pending) >= self.batch_size:
+        self._condition.notify()
+    return db_athlete.id
+
+  def pending(self, athlete_id:int):
+    """True if the entry with this id is still waiting to be flushed"""
+    with self._condition:
+      return athlete_id in self._pending_ids
+
+  def _run(self):
+    while True:
+      with self._condition:
+        if not self._closed and (self._retrying or len(self._pending) < self.batch_size):
+          self._condition.wait(self.flush_interval)
+        closed = self._closed
+      self.flush()
+      if closed:
+        return
+
+  def flush(self):
+    """Write all buffered entries
+
+    Returns:
+        int: number of entries written
+    """
+    with self._flush_lock:
+      with self._condition:
+        batch, self._pending = self._pending, []
+      if not batch:
+        return 0
+      started = time.perf_counter()
+      shards = {}
+      for db_athlete in batch:
+        shards.setdefault(self.router.shard(db_athlete.noc).writer(), []).append(db_athlete)
+      # one transaction per shard, so a failing shard does not write the others twice
+      written, retry = [], []
+      for engine, athletes in shards.items():
+        try:
+          written += self._write(engine, athletes)
+        except TRANSIENT_ERRORS as error:
+          retry += athletes
+          logger.warning("Batch insert failed, retrying on the next flush",
+                         extra={'entries': len(athletes), 'error': str(error)})
+        except Exception:  # isolate the failing entries
+          logger.exception("Batch insert failed, retrying entry by entry",
+                           extra={'entries': len(athletes)})
+          for position, db_athlete in enumerate(athletes):
+            try:
+              written += self._write(engine, [db_athlete])
+            except DATA_ERRORS as error:
+              self._quarantine(db_athlete, error)
+            except Exception as error:
+              retry += athletes[position:]
+              logger.warning("Entry insert failed, retrying on the next flush",
+                             extra={'entries': len(athletes) - position, 'error': str(error)})
+              break
+      retried = {db_athlete.id for db_athlete in retry}
+      with self._condition:
+        # buffered again ahead of the entries put meanwhile, keeping their ids
+        self._pending[:0] = retry
+        self._retrying = bool(retry)
+        self._pending_ids.difference_update(db_athlete.id for db_athlete in batch
+                                            if db_athlete.id not in retried)
+        metrics.set('ingest_pending', len(self._pending))
+      metrics.inc('ingest_retried_total', len(retry))
+      metrics.inc('ingest_flushed_total', len(written))
+      metrics.inc('ingest_flush_seconds_total', time.perf_counter() - started)
+      if written and self.on_flush:
+        self.on_flush(written)
+      return len(written)
+
+  def _quarantine(self, db_athlete, error):
+    metrics.inc('ingest_failed_total')
+    logger.error("Quarantined buffered athlete", extra={'id': db_athlete.id, 'error': str(error)})
+    if self.quarantine_directory is None:
+      return
+    os.makedirs(self.quarantine_directory, exist_ok=True)
+    with open(os.path.join(self.quarantine_directory, 'ingest.jsonl'), 'a') as quarantine:
+      quarantine.write(json.dumps({'error': str(error.orig if hasattr(error, 'orig') else error).strip(),
+                                   'athlete': json.loads(db_athlete.json())}) + '\n')
+
+  def _write(self, engine, athletes):
+    tables = {}
+    for db_athlete in athletes:
+      tables.setdefault(type(db_athlete), []).append(db_athlete.dict())
+    with Session(engine) as session:
+      for model, rows in tables.items():
+        session.execute(insert(model.__table__), rows)
+      record_medals(session, athletes)
+      log_changes(session, added=[(season_of(db_athlete), db_athlete) for db_athlete in athletes])
+      session.commit()
+    return athletes
+
+  def close(self):
+    """Stop the flusher thread after a last flush"""
+    with self._condition:
+      if self._closed:
+        return
+      self._closed = True
+      self._condition.notify()
+    if self._thread is not None:
+      self._thread.join(timeout=30)
+    self.flush()
@@ -0,0 +1,163 @@
+"""
+Background jobs for heavy exports and recomputations
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .metrics import metrics
+
+# options of the [jobs] section in database.ini
+JOBS_DEFAULTS = {'threads': 2, 'processes': 1, 'max_pending': 100, 'directory': 'jobs',
+                 'keep': 3600.0}
+
+
+def timed(fn, *args):
+  """Run a job function, returning its start time with its result, for jobs run in worker processes"""
+  return time.time(), fn(*args)
+
+
+class Job:
+  """One submitted job, its state and the path of its result artifact"""
+  def __init__(self, kind:str):
+    self.id = uuid.uuid4().hex
+    self.kind = kind
+    self.state = None
+    self.future = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+    self.error = None
+    self.result = None
+    self.artifact = None
+
+  @property
+  def status(self):
+    """queued, running, done, failed or cancelled"""
+    if self.state:
+      return self.state
+    return 'running' if self.future is not None and self.future.running() else 'queued'
+
+  def to_dict(self):
+    return {'id': self.id, 'kind': self.kind, 'status': self.status,
+            'submitted': self.submitted, 'started': self.started, 'finished': self.finished,
+            'error': self.error, 'result': self.result}
+
+
+class JobQueue:
+  """Bounded pools running jobs outside of the request handlers
+
+  I/O-bound jobs run in a thread pool, CPU-bound jobs in a process pool started
+  with spawn, so they neither hold a request thread nor compete with requests for
+  the GIL. Finished jobs and their artifacts are dropped after `keep` seconds.
+
+  Args:
+      directory (str): directory of the result artifacts
+      threads (int, optional): concurrent I/O-bound jobs. Defaults to 2.
+      processes (int, optional): concurrent CPU-bound jobs. Defaults to 1.
+      max_pending (int, optional): queued or running jobs before submit is refused. Defaults to 100.
+      keep (float, optional): seconds finished jobs are kept. Defaults to 3600.
+  """
+  def __init__(self, directory:str, threads:int = 2, processes:int = 1, max_pending:int = 100,
+               keep:float = 3600.0):
+    self.directory = directory
+    self.max_pending = max_pending
+    self.keep = keep
+    self._threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job')
+    self._processes_count = processes
+    self._processes = None
+    self._jobs = {}
+    self._lock = threading.Lock()
+
+  def _process_pool(self):
+    with self._lock:
+      if self._processes is None:
+        self._processes = ProcessPoolExecutor(max_workers=self._processes_count,
+                                              mp_context=multiprocessing.get_context('spawn'))
+      return self._processes
+
+  def pending(self):
+    """Number of queued or running jobs"""
+    with self._lock:
+      return sum(job.status in ('queued', 'running') for job in self._jobs.values())
+
+  def submit(self, kind:str, fn, *args, cpu:bool = False, artifact:str = None, on_done=None):
+    """Queue a job
+
+    Args:
+        kind (str): kind of job, used in the status and the metrics
+        fn: function run with `args`, and with the artifact path first if `artifact` is set.
+            Its return value is the result of the job. CPU-bound functions must be picklable.
+        cpu (bool, optional): run in the process pool. Defaults to False.
+        artifact (str, optional): file name of the result artifact in the job directory
+        on_done (optional): function called in this process with the return value of `fn`,
+            its own return value becomes the result of the job
+
+    Returns:
+        Job: the queued job, None if `max_pending` jobs are already queued or running
+    """
+    self._expire()
+    if self.pending() >= self.max_pending:
+      metrics.inc('jobs_refused_total', kind=kind)
+      return None
+    job = Job(kind)
+    if artifact:
+      os.makedirs(self.directory, exist_ok=True)
+      job.artifact = os.path.join(self.directory, f'{job.id}-{artifact}')
+      args = (job.artifact, *args)
+    with self._lock:
+      self._jobs[job.id] = job
+    metrics.inc('jobs_submitted_total', kind=kind)
+
+    def run(*args):
+      job.started = time.time()
+      return fn(*args)
+
+    def finish(future):
+      try:
+        if future.cancelled():
+          job.state = 'cancelled'
+          return
+        result = future.result()
+        if cpu:
+          job.started, result = result
+        job.result = on_done(result) if on_done else result
+        job.state = 'done'
+      except Exception as error:  # reported through the job status
+        job.error, job.state = str(error) or type(error).__name__, 'failed'
+      finally:
+        job.finished = time.time()
+        metrics.inc('jobs_finished_total', kind=kind, status=job.state)
+        metrics.inc('job_seconds_total', job.finished - (job.started or job.submitted), kind=kind)
+
+    if cpu:
+      job.future = self._process_pool().submit(timed, fn, *args)
+    else:
+      job.future = self._threads.submit(run, *args)
+    job.future.add_done_callback(finish)
+    return job
+
+  def get(self, job_id:str):
+    """Job with this id, None if it is unknown or expired"""
+    with self._lock:
+      return self._jobs.get(job_id)
+
+  def _expire(self):
+    limit = time.time() - self.keep
+    with self._lock:
+      expired = [job for job in self._jobs.values() if job.finished and job.finished < limit]
+      for job in expired:
+        del self._jobs[job.id]
+    for job in expired:
+      if job.artifact and os.path.exists(job.artifact):
+        os.remove(job.artifact)
+
+  def shutdown(self):
+    """Stop the pools, dropping queued jobs"""
+    self._threads.shutdown(wait=False, cancel_futures=True)
+    if self._processes is not None:
+      self._processes.shutdown(wait=False, cancel_futures=True)
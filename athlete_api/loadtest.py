@@ -0,0 +1,368 @@
+"""
+In-process load generator driven by workload profiles
+
+Virtual users send requests back to back, without think time, following the
+operation weights of a workload profile. Parameters are drawn from the data:
+NOCs and countries proportionally to their number of entries, athlete name
+fragments and sports from a sample of the tables. Every concurrency step runs for
+a fixed duration and records throughput, latency percentiles, error rate, the
+rate of rejected requests and the share of requests shed by admission control.
+
+By default the application is driven in-process through its ASGI interface, with
+every request coming from one of `clients` simulated client addresses so the per
+client rate limit behaves as with real traffic. --url targets a running server:
+every request then comes from the address of the load generator, and carries
+the simulated address in X-Forwarded-For instead. The server only tells the
+virtual users apart with trust_forwarded=true in the [admission] section,
+otherwise they share one token bucket and most requests are shed with 429.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m athlete_api.loadtest --profile production --steps 1,2,4,8,16 \
+        --duration 10 --baseline loadtest_baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+from sqlmodel import Session, text
+
+# operation weights in percent
+PROFILES = {
+  'production': {'noc': 35, 'country': 35, 'athletes': 20, 'detail': 5, 'write': 5},
+  'read_only': {'noc': 40, 'country': 40, 'athletes': 20},
+  'detail_heavy': {'noc': 25, 'country': 25, 'athletes': 20, 'detail': 30},
+}
+
+# responses of admission control, counted as shed rather than as errors
+SHED_STATUSES = (429, 503)
+
+
+class Parameters:
+  """Request parameter distributions sampled from the database
+
+  Args:
+      engine: engine to sample the athlete and region tables from
+      sample_size (int, optional): athlete names sampled for searches. Defaults to 500.
+  """
+  def __init__(self, engine, sample_size:int = 500):
+    with Session(engine) as session:
+      counts = session.execute(text(
+        "SELECT noc, region, count(*) FROM (SELECT noc FROM athletes_summer "
+        "UNION ALL SELECT noc FROM athletes_winter) athletes "
+        "JOIN regions USING (noc) GROUP BY noc, region")).fetchall()
+      names = session.execute(text(
+        "SELECT name FROM athletes_summer ORDER BY random() LIMIT :size"),
+        {'size': sample_size}).scalars().all()
+      sports = session.execute(text(
+        "SELECT DISTINCT sport FROM athletes_summer")).scalars().all()
+      first, last = session.execute(text(
+        "SELECT min(year), max(year) FROM athletes_summer")).one()
+    self.nocs = [noc for noc, _, _ in counts]
+    self.noc_weights = [count for _, _, count in counts]
+    self.regions = [region for _, region, _ in counts if region]
+    self.region_weights = [count for _, region, count in counts if region]
+    self.names = [name.split()[-1] for name in names if name and name.split()]
+    self.sports = sports
+    self.years = (first or 1896, last or 2016)
+
+  def noc(self, rng):
+    return rng.choices(self.nocs, self.noc_weights)[0]
+
+  def country(self, rng):
+    return rng.choices(self.regions, self.region_weights)[0]
+
+  def filters(self, rng):
+    """Query parameters narrowing a summary: a period, a sport or both"""
+    start = rng.randint(*self.years)
+    period = {'start_date': start, 'end_date': start + rng.choice((4, 20, 50))}
+    sport = {'sport': rng.choice(self.sports)}
+    return rng.choice((period, sport, {**period, **sport}))
+
+
+async def _noc(client, params, rng, created, detail=False):
+  response = await client.get(f'/noc/{params.noc(rng)}',
+                              params={**params.filters(rng), 'detail': detail})
+  return response.status_code
+
+
+async def _country(client, params, rng, created, detail=False):
+  response = await client.get(f'/country/{params.country(rng)}',
+                              params={**params.filters(rng), 'detail': detail})
+  return response.status_code
+
+
+async def _athletes(client, params, rng, created, detail=False):
+  response = await client.get(f'/athletes/{rng.choice(params.names)}',
+                              params={'exact': False, 'detail': detail})
+  return response.status_code
+
+
+async def _detail(client, params, rng, created):
+  return await rng.choice((_noc, _country, _athletes))(client, params, rng, created, detail=True)
+
+
+async def _write(client, params, rng, created):
+  """Add an athlete, update or delete one added before by the same virtual user"""
+  if created and rng.random() < 0.5:
+    response = await client.delete(f'/delete_athlete/{created.pop()}')
+  elif created:
+    response = await client.patch(f'/update_athlete/{rng.choice(created)}',
+                                  json={'medal': rng.choice(('Gold', 'Silver', 'Bronze'))})
+  else:
+    year = rng.randint(*params.years) // 4 * 4
+    noc = params.noc(rng)
+    response = await client.post('/add_athlete/', json={
+      'name': 'Loadtest Athlete', 'sex': rng.choice('MF'), 'age': rng.randint(16, 40),
+      'team': noc, 'noc': noc, 'games': f'{year} Summer', 'year': year, 'season': 'Summer',
+      'city': 'Loadtest', 'sport': rng.choice(params.sports), 'event': 'Loadtest'})
+    if response.status_code == 200:
+      created.append(response.json()['id'])
+  return response.status_code
+
+
+OPERATIONS = {'noc': _noc, 'country': _country, 'athletes': _athletes,
+              'detail': _detail, 'write': _write}
+
+
+def percentile(values, fraction:float):
+  """Nearest-rank percentile of a list of numbers, 0 for an empty list"""
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def summarize(samples, concurrency:int, elapsed:float):
+  """Aggregate the (operation, seconds, status) samples of a step
+
+  Statuses of None stand for requests that raised, e.g. timed out. Errors are
+  those and the 5xx responses other than shed ones. Rejected requests, the 4xx
+  responses other than 404s and shed ones, are counted apart: they point at the
+  generated requests rather than at the server. 404s of searches without matches
+  count as successes.
+
+  Returns:
+      dict: throughput in requests/s, latency percentiles in ms, error, rejection and shed rates
+  """
+  def is_error(status):
+    return status is None or (status >= 500 and status not in SHED_STATUSES)
+
+  def is_rejected(status):
+    return status is not None and 400 <= status < 500 and status not in (404, *SHED_STATUSES)
+
+  def stats(latencies, statuses):
+    return {'requests': len(statuses),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'error_rate': round(sum(map(is_error, statuses)) / max(len(statuses), 1), 4),
+            'rejected_rate': round(sum(map(is_rejected, statuses)) / max(len(statuses), 1), 4),
+            'shed_rate': round(sum(s in SHED_STATUSES for s in statuses) / max(len(statuses), 1), 4)}
+
+  by_operation = defaultdict(lambda: ([], []))
+  for operation, seconds, status in samples:
+    by_operation[operation][0].append(seconds)
+    by_operation[operation][1].append(status)
+  result = {'concurrency': concurrency,
+            'throughput': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+            **stats([s for _, s, _ in samples], [s for _, _, s in samples])}
+  result['operations'] = {operation: stats(*values)
+                          for operation, values in sorted(by_operation.items())}
+  return result
+
+
+async def run_step(make_client, profile:dict, params:Parameters, concurrency:int,
+                   duration:float, seed:int = 0):
+  """Run `concurrency` virtual users for `duration` seconds
+
+  Args:
+      make_client: function of the user number returning an httpx.AsyncClient
+      profile (dict): operation -> weight
+      params (Parameters): request parameter distributions
+      concurrency (int): number of virtual users
+      duration (float): seconds to run
+      seed (int, optional): seed of the random generators. Defaults to 0.
+
+  Returns:
+      dict: summary of the step, see summarize
+  """
+  operations, weights = zip(*profile.items())
+  samples = []
+  deadline = time.perf_counter() + duration
+
+  async def user(number):
+    rng = random.Random(seed * 100003 + number)
+    created = []
+    async with make_client(number) as client:
+      while time.perf_counter() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        started = time.perf_counter()
+        try:
+          status = await OPERATIONS[operation](client, params, rng, created)
+        except Exception:  # counted as an error of the operation
+          status = None
+        samples.append((operation, time.perf_counter() - started, status))
+      for athlete_id in created:
+        await client.delete(f'/delete_athlete/{athlete_id}')
+
+  started = time.perf_counter()
+  await asyncio.gather(*(user(number) for number in range(concurrency)))
+  return summarize(samples, concurrency, time.perf_counter() - started)
+
+
+def find_saturation(results, min_gain:float = 0.1, max_error_rate:float = 0.01):
+  """Concurrency beyond which throughput stops growing
+
+  Returns:
+      int: concurrency of the last step that still gained at least `min_gain` throughput
+      over the best step before it without exceeding `max_error_rate`, None if
+      every step kept scaling
+  """
+  best = None
+  for result in results:
+    if best is not None and (result['throughput'] < best['throughput'] * (1 + min_gain)
+                             or result['error_rate'] > max_error_rate):
+      return best['concurrency']
+    if result['error_rate'] <= max_error_rate:
+      best = result
+  return None
+
+
+def compare(results, baseline, tolerance:float = 0.2):
+  """Regressions of a run against a baseline run of the same steps
+
+  Args:
+      results (list): step summaries of this run
+      baseline (list): step summaries of the baseline run
+      tolerance (float, optional): allowed relative change. Defaults to 0.2.
+
+  Returns:
+      list: one message per regressed metric, empty if the run is within tolerance
+  """
+  regressions = []
+  expected = {step['concurrency']: step for step in baseline}
+  for result in results:
+    step = expected.get(result['concurrency'])
+    if step is None:
+      continue
+    prefix = f"concurrency {result['concurrency']}:"
+    if result['throughput'] < step['throughput'] * (1 - tolerance):
+      regressions.append(f"{prefix} throughput {result['throughput']} < baseline {step['throughput']}")
+    if result['p99_ms'] > step['p99_ms'] * (1 + tolerance):
+      regressions.append(f"{prefix} p99 {result['p99_ms']} ms > baseline {step['p99_ms']} ms")
+    if result['error_rate'] > step['error_rate'] + 0.01:
+      regressions.append(f"{prefix} error rate {result['error_rate']} > baseline {step['error_rate']}")
+  return regressions
+
+
+def client_address(number:int):
+  """Simulated client address of a number"""
+  return f'10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}'
+
+
+async def _run(args, profile):
+  if args.url:
+    from .services import connect
+    engine = connect(filename=os.getenv('FILE_NAME'), section=os.getenv('SECTION_NAME'))
+    startup = shutdown = None
+
+    def make_client(number):
+      client = httpx.AsyncClient(base_url=args.url, timeout=60)
+      rng = random.Random(number)
+
+      async def pick_client(request):
+        request.headers['X-Forwarded-For'] = client_address(rng.randrange(args.clients))
+      client.event_hooks['request'].append(pick_client)
+      return client
+  else:
+    from . import main
+    engine = main.router.reader()
+    startup, shutdown = main.app.router.startup, main.app.router.shutdown
+
+    def make_client(number):
+      transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+      client = httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=60)
+      rng = random.Random(number)
+
+      async def pick_client(request):
+        transport.client = (client_address(rng.randrange(args.clients)), 4000)
+      client.event_hooks['request'].append(pick_client)
+      return client
+
+  params = Parameters(engine)
+  if startup:
+    await startup()
+  results = []
+  try:
+    for concurrency in args.steps:
+      result = await run_step(make_client, profile, params, concurrency, args.duration, args.seed)
+      results.append(result)
+      print(f"{concurrency:5d} users {result['throughput']:9.1f} req/s  p50 {result['p50_ms']:8.1f} ms"
+            f"  p95 {result['p95_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms"
+            f"  errors {result['error_rate']:6.2%}  rejected {result['rejected_rate']:6.2%}"
+            f"  shed {result['shed_rate']:6.2%}", flush=True)
+  finally:
+    if shutdown:
+      await shutdown()
+  return results
+
+
+def main_cli(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+  parser.add_argument('--profile', default='production',
+                      help=f"one of {', '.join(PROFILES)} or a JSON file of operation weights")
+  parser.add_argument('--steps', default='1,2,4,8,16',
+                      type=lambda steps: [int(step) for step in steps.split(',')])
+  parser.add_argument('--duration', type=float, default=10.0, help='seconds per step')
+  parser.add_argument('--clients', type=int, default=1000,
+                      help='simulated client addresses, sent in X-Forwarded-For with --url')
+  parser.add_argument('--url', help='base URL of a running server instead of in-process')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--min-gain', type=float, default=0.1,
+                      help='throughput gain below which a step counts as saturated')
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--baseline', help='JSON results to compare against')
+  parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+  parser.add_argument('--tolerance', type=float, default=0.2)
+  args = parser.parse_args(argv)
+
+  if args.profile in PROFILES:
+    profile = PROFILES[args.profile]
+  else:
+    with open(args.profile, encoding='utf-8') as file:
+      profile = json.load(file)
+  unknown = set(profile) - set(OPERATIONS)
+  if unknown:
+    parser.error(f"unknown operations {', '.join(sorted(unknown))}")
+
+  results = asyncio.run(_run(args, profile))
+  saturation = find_saturation(results, args.min_gain)
+  print(f"saturation: {saturation} users" if saturation else 'saturation: not reached')
+  report = {'profile': profile, 'duration': args.duration, 'saturation': saturation,
+            'steps': results}
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as file:
+      json.dump(report, file, indent=2)
+  if args.baseline and args.save_baseline:
+    with open(args.baseline, 'w', encoding='utf-8') as file:
+      json.dump(report, file, indent=2)
+  elif args.baseline:
+    with open(args.baseline, encoding='utf-8') as file:
+      regressions = compare(results, json.load(file)['steps'], args.tolerance)
+    for regression in regressions:
+      print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main_cli())
@@ -0,0 +1,106 @@
+"""
+Structured, sampled logging through a background queue
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+from .config import settings
+from .metrics import metrics
+
+# options of the [logging] section in database.ini, levels per subsystem
+LOGGING_DEFAULTS = {'level': 'INFO', 'main': 'INFO', 'config': 'INFO', 'utils': 'INFO',
+                    'data_loader': 'INFO', 'snapshot': 'INFO', 'sql': 'WARNING',
+                    'debug_sample_rate': 0.01, 'queue_size': 10000}
+
+SQL_LOGGER = 'sqlalchemy.engine'
+SUBSYSTEMS = ('main', 'config', 'utils', 'data_loader', 'snapshot', 'sql')
+
+# attributes of every LogRecord, anything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def subsystem_logger(subsystem:str):
+  """Logger of a subsystem, 'sql' is the SQLAlchemy engine logger"""
+  return logging.getLogger(SQL_LOGGER if subsystem == 'sql' else f'athlete_api.{subsystem}')
+
+
+class JsonFormatter(logging.Formatter):
+  """Formats records as one JSON object per line, including the fields passed with `extra`"""
+  def format(self, record):
+    entry = {'time': self.formatTime(record), 'level': record.levelname,
+             'logger': record.name, 'message': record.getMessage()}
+    entry.update((key, value) for key, value in vars(record).items()
+                 if key not in _RECORD_ATTRIBUTES)
+    return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+  """Passes only a fraction of the DEBUG records, records of higher levels always pass
+
+  Args:
+      rate (float): fraction of DEBUG records to keep, between 0 and 1
+  """
+  def __init__(self, rate:float):
+    super().__init__()
+    self.rate = rate
+
+  def filter(self, record):
+    return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  """Queue handler that drops records instead of blocking when the queue is full"""
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      metrics.inc('log_dropped_total')
+
+
+def setup_logging(filename:str, stream=None):
+  """Route the application and SQL logs through a queue to a JSON stream handler
+
+  Request threads only put records on a bounded queue, a listener thread formats
+  and writes them, so slow log I/O does not add to request latency.
+
+  Args:
+      filename (str): config file with an optional [logging] section
+      stream (optional): stream to write to. Defaults to stdout.
+
+  Returns:
+      QueueListener: started listener, stop it on shutdown to flush the queue
+  """
+  options = settings(filename, 'logging', LOGGING_DEFAULTS)
+
+  output = logging.StreamHandler(stream or sys.stdout)
+  output.setFormatter(JsonFormatter())
+  handler = DroppingQueueHandler(queue.Queue(options['queue_size']))
+  handler.addFilter(SamplingFilter(options['debug_sample_rate']))
+  listener = logging.handlers.QueueListener(handler.queue, output)
+
+  for logger in (logging.getLogger('athlete_api'), logging.getLogger(SQL_LOGGER)):
+    for previous in [h for h in logger.handlers if isinstance(h, DroppingQueueHandler)]:
+      logger.removeHandler(previous)
+    logger.addHandler(handler)
+    logger.propagate = False
+  logging.getLogger('athlete_api').setLevel(options['level'].upper())
+  for subsystem in SUBSYSTEMS:
+    subsystem_logger(subsystem).setLevel(options[subsystem].upper())
+  listener.start()
+  return listener
+
+
+def set_level(subsystem:str, level:str):
+  """Change the level of a subsystem at runtime, e.g. set_level('sql', 'INFO') to echo SQL"""
+  subsystem_logger(subsystem).setLevel(level.upper())
+
+
+def levels():
+  """Current level of every subsystem"""
+  return {subsystem: logging.getLevelName(subsystem_logger(subsystem).getEffectiveLevel())
+          for subsystem in SUBSYSTEMS}
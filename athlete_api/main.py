@@ -2,29 +2,216 @@
 Main entry function for API
 """
 
+import csv
+import json
+import math
 import os
-from collections import defaultdict
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from itertools import groupby
+from types import SimpleNamespace
+from typing import List
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlmodel import Session, SQLModel, create_engine, inspect, select, union
+from fastapi.responses import FileResponse, PlainTextResponse
+from sqlalchemy import BigInteger, and_, bindparam, case, cast, delete, true, update
+from sqlalchemy.dialects.postgresql import array
+from sqlmodel import Session, SQLModel, column, create_engine, func, inspect, select
 
-from .models import (AthleteBase, AthleteSummer, AthleteUpdate, AthleteWinter,
-                     Region, RegionBase, RegionUpdate, Seasons)
-from .services import connect
-from .utils import add_where, verify_params
+from .admin import require_admin
+from .admission import ADMISSION_DEFAULTS, AdmissionMiddleware
+from .changes import (ATHLETES, CHANGES_DEFAULTS, REGIONS, ChangeFeed, bump, create_tables as create_change_tables,
+                      generation, log_changes)
+from .coalesce import coalesce, observe
+from .compression import COMPRESSION_DEFAULTS, CompressionMiddleware
+from .config import settings
+from .ingest import INGEST_DEFAULTS, BufferFull, IngestBuffer
+from .guard import GUARD_DEFAULTS, CardinalityIndex, CostGuard
+from .jobs import JOBS_DEFAULTS, JobQueue
+from .log import SUBSYSTEMS, levels, set_level, setup_logging
+from .metrics import metrics
+from .medals import event_medal_count, record_medal, record_medals
+from .models import (AthleteBase, AthleteBulkDelete, AthleteBulkUpdate, AthleteSummer,
+                     AthleteUpdate, AthleteWinter, CountModes,
+                     Dimensions, EventMedal, ExportFormats, Region, RegionBase, RegionUpdate,
+                     Seasons)
+from .profiler import PROFILER_DEFAULTS, Profiler, ProfileMiddleware
+from .profiles import AthleteProfiles, load_profiles, season_of
+from .regions import RegionIndex
+from .services import ReadYourWritesMiddleware, connect_router
+from .snapshot import SnapshotRefresher, SnapshotStore, write_snapshot
+from .timeouts import TIMEOUT_DEFAULTS, DisconnectMiddleware, query_session
+from .warmup import WARMUP_DEFAULTS, WarmUp
+from .utils import (StatementCache, add_where, clause_params, clause_shape, parse_fields,
+                    project, season_statement, select_columns, verify_params)
 from .data_loader import data_loader
 
-engine = connect(filename=os.getenv('FILE_NAME'), section=os.getenv('SECTION_NAME'), echo=True)
-data_loader()
+log_listener = setup_logging(os.getenv('FILE_NAME'))
+# SQL echo is off, enable it at runtime with PUT /admin/logging?subsystem=sql&level=INFO
+router = connect_router(filename=os.getenv('FILE_NAME'), section=os.getenv('SECTION_NAME'))
+engine = router.writer()
+
+def load_data():
+    """Create and load the tables of every node, the athletes only on the shard owning their NOC"""
+    shards = router.shards()
+    for shard in shards:
+        # read by the change feed of every worker
+        create_change_tables(shard.writer())
+    if shards == [router]:
+        data_loader()
+        return
+    router.prepare_sequences()
+    data_loader(owns=lambda noc: router.shard(noc).writer() is engine)
+    for shard in shards:
+        if shard.writer() is not engine:
+            data_loader(target=shard.writer(), owns=lambda noc, shard=shard: router.shard(noc) is shard)
+
+load_data()
+profiles = AthleteProfiles()
+regions = RegionIndex()
+snapshot_options = settings(filename=os.getenv('FILE_NAME'), section='snapshot',
+                            defaults={'directory': '', 'refresh_interval': 30.0, 'rewrite_delay': 300.0})
+snapshots = SnapshotStore(snapshot_options['directory'])
+
+def cache_generations():
+    """Cache generations of the tables in the databases, as recorded in the snapshot header"""
+    athletes = []
+    for shard in router.shards():
+        with Session(shard.writer()) as session:
+            athletes.append(generation(session, ATHLETES))
+    with Session(engine) as session:
+        return {'athletes': athletes, 'regions': generation(session, REGIONS)}
+
+refresher = SnapshotRefresher(snapshot_options['directory'], lambda directory: write_snapshot(router, directory),
+                              cache_generations, delay=snapshot_options['rewrite_delay'])
+refresh_snapshots = snapshot_options['directory'] and snapshot_options['rewrite_delay'] > 0
+guard_options = settings(filename=os.getenv('FILE_NAME'), section='guard', defaults=GUARD_DEFAULTS)
+cardinality = CardinalityIndex(guard_options.pop('ngram'))
+changes = ChangeFeed(router, profiles, regions, on_change=refresher.changed if refresh_snapshots else None,
+                     cardinality=cardinality,
+                     **settings(filename=os.getenv('FILE_NAME'), section='changes', defaults=CHANGES_DEFAULTS))
 
 #debug
 # table_names = inspect(engine)
 # print(table_names.get_table_names())
 
+# columns fetched by the read endpoints, detail queries fetch every column
+COUNTRY_COLUMNS = ('name', 'noc', 'games', 'year', 'medal')
+NOC_COLUMNS = ('name', 'season', 'year', 'medal')
+ATHLETE_COLUMNS = ('name', 'team', 'games', 'year', 'sport', 'medal')
+DETAIL_COLUMNS = tuple(AthleteSummer.__fields__)
+COUNTRY_FIELDS = DETAIL_COLUMNS + ('region', 'notes')
+
+
+def detail_columns(summary_columns, fields):
+    """Columns of a detail query: the summary columns plus the requested fields"""
+    if fields is None:
+        return DETAIL_COLUMNS
+    return tuple(c for c in DETAIL_COLUMNS if c in summary_columns or c in fields)
+
+
+def event_medal_counts(session, group: str, clauses: List, season: Seasons):
+    """Medals per group value and colour from event_medals, a team medal counts once, see event_medal_count"""
+    # NOCs are stored as the upper-case region keys: compared as they are, the (noc, year)
+    # index serves the filter, which it can not for the lower(noc) of an equal clause
+    clauses = [('noc', [value.upper()], 'in') if attr == 'noc' and relation == 'equal' and value
+               else (attr, value, relation) for (attr, value, relation) in clauses]
+    if season != Seasons.UNION:
+        clauses = clauses + [('season', season.value, 'equal')]
+
+    def build():
+        statement = select_columns(EventMedal, (group, 'medal')).add_columns(
+            func.sum(event_medal_count()).label('count'))
+        return add_where(statement, clauses, bind=True).group_by(column(group), EventMedal.medal)
+
+    statement = event_medal_statements.get((group, clause_shape(clauses)), build)
+    rows = session.exec(statement, params=clause_params(clauses)).fetchall()
+    counts = defaultdict(Counter)
+    for row in rows:
+        counts[getattr(row, group)][row.medal] += row.count
+    return counts
+
+
+def clause_shards(clauses: List):
+    """Shards holding the rows matching the clauses: the owners of the NOCs of a noc clause, else all"""
+    for (attr, value, relation) in clauses:
+        if attr == 'noc' and value and relation == 'equal':
+            return router.shards([value])
+        if attr == 'noc' and value and relation == 'in':
+            return router.shards(value)
+    return router.shards()
+
+
+@contextmanager
+def shard_session(session: Session, shard):
+    """Session on a shard, the request session when the shard is the home database"""
+    if shard.writer() is session.get_bind():
+        yield session
+    else:
+        with Session(shard.writer()) as shard_session:
+            yield shard_session
+
+
+@contextmanager
+def athlete_session(session: Session, athlete_id: int):
+    """Session of the shard holding an athlete and the athlete, None if no shard holds the id"""
+    for shard in router.owners(athlete_id):
+        with shard_session(session, shard) as session_of_shard:
+            db_athlete = session_of_shard.get(AthleteSummer, athlete_id)
+            if not db_athlete:
+                db_athlete = session_of_shard.get(AthleteWinter, athlete_id)
+            if db_athlete:
+                yield session_of_shard, db_athlete
+                return
+    yield session, None
+
+
+def medal_count(medals: Counter):
+    return {
+        'total': sum(count for medal, count in medals.items() if medal),
+        'gold': medals['Gold'],
+        'silver': medals['Silver'],
+        'bronze': medals['Bronze'],
+        }
+
+country_statements = StatementCache('country')
+noc_statements = StatementCache('noc')
+athlete_statements = StatementCache('athletes')
+compare_statements = StatementCache('compare')
+stats_statements = StatementCache('stats')
+histogram_statements = StatementCache('histogram')
+export_statements = StatementCache('export')
+event_medal_statements = StatementCache('event_medals')
+timeseries_statements = StatementCache('timeseries')
+
+# percentiles of the age statistics
+PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
 #We create an instance of FastAPI
 app = FastAPI()
+app.add_middleware(AdmissionMiddleware,
+                   **settings(filename=os.getenv('FILE_NAME'), section='admission',
+                              defaults=ADMISSION_DEFAULTS))
+app.add_middleware(DisconnectMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+compression_options = settings(filename=os.getenv('FILE_NAME'), section='compression',
+                               defaults=COMPRESSION_DEFAULTS)
+app.add_middleware(CompressionMiddleware, **compression_options)
+profiler = Profiler(**settings(filename=os.getenv('FILE_NAME'), section='profiler',
+                               defaults=PROFILER_DEFAULTS))
+app.add_middleware(ProfileMiddleware, profiler=profiler)
+timeouts = settings(filename=os.getenv('FILE_NAME'), section='timeouts', defaults=TIMEOUT_DEFAULTS)
+jobs = JobQueue(**settings(filename=os.getenv('FILE_NAME'), section='jobs', defaults=JOBS_DEFAULTS))
+guard = CostGuard(cardinality, **guard_options)
+ingest_options = settings(filename=os.getenv('FILE_NAME'), section='ingest', defaults=INGEST_DEFAULTS)
+
+def on_ingest_flush(athletes):
+    router.mark_write()
+    changes.catch_up(router.shards([db_athlete.noc for db_athlete in athletes]))
+
+ingest = IngestBuffer(router, on_flush=on_ingest_flush,
+                      **{key: value for key, value in ingest_options.items() if key != 'buffered'})
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
@@ -33,20 +220,123 @@ def get_session():
     with Session(engine) as session:
         yield session
 
+def load_snapshot(snapshot):
+    regions.build_from_snapshot(snapshot)
+    # served with the changes logged since the snapshot was written
+    loaded = AthleteProfiles()
+    loaded.build_from_snapshot(snapshot)
+    cardinality.build_from_snapshot(snapshot)
+    changes.install(loaded)
+
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    if snapshot_options['directory'] and snapshots.available():
+        load_snapshot(snapshots.current())
+        snapshots.watch(load_snapshot, snapshot_options['refresh_interval'])
+    else:
+        regions.build(router.reader())
+        profiles.build(*(shard.reader() for shard in router.shards()))
+        cardinality.build(*(shard.reader() for shard in router.shards()))
+    changes.start()
+    ingest.start()
+    warmup.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    warmup.stop()
+    ingest.close()
+    changes.stop()
+    jobs.shutdown()
+    log_listener.stop()
 
 @app.get("/")
 async def read_root():
     return {"start":"API to query athletes/countries in Olympics"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Service metrics in Prometheus text format
+    """
+    return metrics.render()
+
+@app.get("/ready")
+def get_ready(response: Response):
+    """
+    Readiness check, 503 until the hottest recorded queries were replayed after startup
+    """
+    if not warmup.ready.is_set():
+        response.status_code = 503
+    return {"ready": warmup.ready.is_set(), "warmup": warmup.status}
+
+@app.get("/admin/logging", dependencies=[Depends(require_admin)])
+def get_logging():
+    """
+    Current log level of every subsystem
+    """
+    return levels()
+
+@app.put("/admin/logging", dependencies=[Depends(require_admin)])
+def put_logging(subsystem: str, level: str):
+    """
+    Change the log level of a subsystem at runtime
+
+    Args:
+        subsystem: one of main, config, utils, data_loader, snapshot or sql
+        level: DEBUG, INFO, WARNING, ERROR or CRITICAL, sql=INFO echoes every statement
+    Returns:
+        Current log level of every subsystem
+    """
+    if subsystem not in SUBSYSTEMS:
+        raise HTTPException(status_code=400, detail=f"Unknown subsystem {subsystem}")
+    if level.upper() not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        raise HTTPException(status_code=400, detail=f"Unknown level {level}")
+    set_level(subsystem, level)
+    return levels()
+
+def collapsed_response(profile_id, sampler):
+    return PlainTextResponse(sampler.collapsed(), headers={
+        'Content-Disposition': f'attachment; filename="profile-{profile_id}.folded"',
+        'X-Profile-Id': profile_id,
+        'X-Profile-Samples': str(sampler.samples),
+        'X-Profile-Seconds': f'{sampler.seconds:.3f}'})
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def get_profile(seconds: float = 5.0, idle: bool = False):
+    """
+    Sample the stacks of every thread of this worker for some seconds
+
+    Args:
+        seconds: duration of the profile, at most max_seconds of the [profiler] section
+        idle: keep the stacks of threads waiting for work
+    Returns:
+        Collapsed stacks, one 'frame;frame;frame count' line per stack, for flamegraph.pl or speedscope
+    """
+    return collapsed_response(*profiler.sample_worker(seconds, idle))
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_saved_profile(profile_id: str):
+    """
+    Download a recent profile, e.g. of a request sent with profile=true
+
+    Args:
+        profile_id: X-Profile-Id header of the profiled response
+    Returns:
+        Collapsed stacks, one 'frame;frame;frame count' line per stack
+    """
+    sampler = profiler.get(profile_id)
+    if sampler is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return collapsed_response(profile_id, sampler)
+
 
 #add try/except
 # search in regions and notes eg: newfoundland
-# add rate limit https://sqlmodel.tiangolo.com/tutorial/fastapi/limit-and-offset/
+# rate limit: done, see admission.py
 # error documentation 400
 @app.get("/country/{country}", response_model= dict)
+@coalesce
 def get_country_data(country: str,
 
                  sport: str = None,
@@ -54,7 +344,9 @@ def get_country_data(country: str,
                  end_date: int = None,
                  detail: bool = False,
                  season: Seasons = Seasons.UNION,
-                 exact: bool = True):
+                 exact: bool = True,
+                 fields: str = None,
+                 count_mode: CountModes = CountModes.ENTRY):
     """
     Get data for a country. 
     
@@ -66,65 +358,80 @@ def get_country_data(country: str,
         detail: If True return detailed data about the query
         season: Seasons to use when searching for data
         exact: If True return exact matches of country names instead of partial matches
+        fields: Comma separated fields of the detail entries e.g. 'name,year,event,medal'
+        count_mode: entry counts every medal-winning entry, event counts a team medal once
     Returns: 
       A dict with keys'country'
     """
     try:
         verify = verify_params(country, sport, start_date, end_date)
         assert verify is True
+        fields = parse_fields(fields, COUNTRY_FIELDS)
     except (AssertionError, ValueError) as error:
         raise HTTPException(status_code=400, detail=str(error)) from error
 
-    with Session(engine) as session:
-        statement_1 = select(AthleteSummer, Region.region, Region.notes)\
-                        .where(AthleteSummer.noc == Region.noc)
-        statement_1 = add_where(statement=statement_1,
-                                clauses=[
-                                    ('region', country, 'equal' if exact else 'contain'),
-                                    ('sport', sport, 'equal'),
-                                    ('year', start_date, 'gte'),
-                                    ('year', end_date, 'lte')]
-                                )
-        statement_2 = select(AthleteWinter, Region.region, Region.notes)\
-                        .where(AthleteWinter.noc == Region.noc)
-        statement_2 = add_where(statement=statement_2,
-                                clauses=[
-                                    ('region', country, 'equal' if exact else 'contain'),
-                                    ('sport', sport, 'equal'),
-                                    ('year', start_date, 'gte'),
-                                    ('year', end_date, 'lte')]
-                                )
-
-        if season == Seasons.SUMMER:
-            statement = union(statement_1, statement_1)
-        elif season == Seasons.WINTER:
-            statement = union(statement_2, statement_2)
-        elif season == Seasons.UNION:
-            statement = union(statement_1, statement_2)
-
-        athletes = session.exec(statement).fetchall()
-        
-        #adding secondary key to ensure ordering for next step groupby
-        sorted_athletes = sorted(athletes, 
-                                 key=lambda x: (x.region.lower().find(country), x.region, x.year))
-        grouped_data = groupby(sorted_athletes, key=lambda x: x.region)
-        result = defaultdict(lambda: defaultdict())
+    if not regions.ready:
+        regions.build(router.reader())
+    # resolve the country to its NOCs up front instead of joining regions
+    matches = regions.resolve(country, exact=exact)
+    if not matches:
+        return {}
+    guard.check('country', cardinality.noc_rows(matches, start_date, end_date, sport), detail,
+                hint="Use exact=true, a sport or a shorter period.")
 
-        # Returns a dictionary of group data for each group in grouped_data.
-        for country_name, group in grouped_data:
-            group = list(group)
-            result[country_name]['total_entries'] = len(group)
-            result[country_name]['unique_participants'] = len({g.name for g in group})
-            result[country_name]['medal_count'] = {
-                'total': len([g for g in group if g.medal]),
-                'gold':len([g for g in group if g.medal=='Gold']),
-                'silver':len([g for g in group if g.medal=='Silver']),
-                'bronze':len([g for g in group if g.medal=='Bronze']),
-                }# if group else 0
-            result[country_name]['games'] = sorted({g.games for g in group})
-            if detail:
-                result[country_name]['entries'] = group
-        return result
+    clauses = [('noc', sorted(matches), 'in'),
+               ('sport', sport, 'equal'),
+               ('year', start_date, 'gte'),
+               ('year', end_date, 'lte')]
+    columns = detail_columns(COUNTRY_COLUMNS, fields) if detail else COUNTRY_COLUMNS
+
+    def build():
+        statement_1 = add_where(statement=select_columns(AthleteSummer, columns),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, columns),
+                                clauses=clauses, bind=True)
+        return season_statement(season, statement_1, statement_2)
+
+    endpoint = 'detail' if detail else 'country'
+    statement = country_statements.get((columns, season, clause_shape(clauses)), build)
+
+    def query(shard):
+        with query_session(shard, endpoint, timeouts[endpoint]) as session:
+            rows = session.exec(statement, params=clause_params(clauses)).fetchall()
+            if count_mode == CountModes.EVENT:
+                return rows, event_medal_counts(session, 'noc', clauses, season)
+            return rows, {}
+
+    # every shard answers for its own NOCs, the rows and medal counts are merged here
+    athletes, event_medals = [], defaultdict(Counter)
+    for rows, counts in router.scatter(query, clause_shards(clauses)):
+        athletes += rows
+        for noc, medals in counts.items():
+            event_medals[matches[noc][0]].update(medals)
+
+    #adding secondary key to ensure ordering for next step groupby
+    sorted_athletes = sorted(athletes,
+                             key=lambda x: (matches[x.noc][0].lower().find(country.lower()),
+                                            matches[x.noc][0], x.year))
+    grouped_data = groupby(sorted_athletes, key=lambda x: matches[x.noc][0])
+    result = defaultdict(lambda: defaultdict())
+
+    # Returns a dictionary of group data for each group in grouped_data.
+    for country_name, group in grouped_data:
+        group = list(group)
+        result[country_name]['total_entries'] = len(group)
+        result[country_name]['unique_participants'] = len({g.name for g in group})
+        medals = Counter(g.medal for g in group)
+        if count_mode == CountModes.EVENT:
+            medals = event_medals[country_name]
+        result[country_name]['medal_count'] = medal_count(medals)
+        result[country_name]['games'] = sorted({g.games for g in group})
+        if detail:
+            # region names come from the index
+            result[country_name]['entries'] = project(
+                [{**g._asdict(), 'region': matches[g.noc][0], 'notes': matches[g.noc][1]}
+                 for g in group], fields)
+    return result
 
 #TODO 
 # union winter: done
@@ -132,12 +439,15 @@ def get_country_data(country: str,
 # custom where functions: done
 # sort by diff keys param
 @app.get("/noc/{noc}", response_model= dict)
+@coalesce
 def get_noc_data(noc: str,
                  sport: str = None,
                  start_date: int = None,
                  end_date: int = None,
                  detail: bool = False,
-                 season: Seasons = Seasons.UNION):
+                 season: Seasons = Seasons.UNION,
+                 fields: str = None,
+                 count_mode: CountModes = CountModes.ENTRY):
     """
     Get Athlete data for a given NoC.
     
@@ -148,6 +458,8 @@ def get_noc_data(noc: str,
         end_date: The end year of the date range to query
         detail: If True return detailed data about the data in the form of a dict.
         season: Seasons to filter by. Defaults to union.
+        fields: Comma separated fields of the detail entries e.g. 'name,year,event,medal'
+        count_mode: entry counts every medal-winning entry, event counts a team medal once
 
     Returns: 
         A dict with keys'noc'
@@ -155,33 +467,29 @@ def get_noc_data(noc: str,
     try:
         verify = verify_params(noc, sport, start_date, end_date)
         assert verify is True
+        fields = parse_fields(fields, DETAIL_COLUMNS)
     except (AssertionError, ValueError) as error:
         raise HTTPException(status_code=400, detail=str(error)) from error
 
-    with Session(engine) as session:
-        statement_1 = select(AthleteSummer)
-        statement_1 = add_where(statement=statement_1,
-                                clauses=[
-                                    ('noc', noc, 'equal'),
-                                    ('sport', sport, 'equal'),
-                                    ('year', start_date, 'gte'),
-                                    ('year', end_date, 'lte')])
-        statement_2 = select(AthleteWinter)
-        statement_2 = add_where(statement=statement_2,
-                                clauses=[
-                                    ('noc', noc, 'equal'),
-                                    ('sport', sport, 'equal'),
-                                    ('year', start_date, 'gte'),
-                                    ('year', end_date, 'lte')])
-
-        if season == Seasons.SUMMER:
-            statement = union(statement_1, statement_1)
-        elif season == Seasons.WINTER:
-            statement = union(statement_2, statement_2)
-        elif season == Seasons.UNION:
-            statement = union(statement_1, statement_2)
-
-        athletes = session.exec(statement).fetchall()
+    clauses = [('noc', noc, 'equal'),
+               ('sport', sport, 'equal'),
+               ('year', start_date, 'gte'),
+               ('year', end_date, 'lte')]
+    columns = detail_columns(NOC_COLUMNS, fields) if detail else NOC_COLUMNS
+
+    def build():
+        statement_1 = add_where(statement=select_columns(AthleteSummer, columns),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, columns),
+                                clauses=clauses, bind=True)
+        return season_statement(season, statement_1, statement_2)
+
+    endpoint = 'detail' if detail else 'noc'
+    with query_session(router.shard(noc), endpoint, timeouts[endpoint]) as session:
+        statement = noc_statements.get((columns, season, clause_shape(clauses)), build)
+        athletes = session.exec(statement, params=clause_params(clauses)).fetchall()
+        if count_mode == CountModes.EVENT:
+            event_medals = event_medal_counts(session, 'year', clauses, season)
         #adding secondary key to ensure ordering for next step groupby
         sorted_athletes = sorted(athletes, key=lambda x: x.year)
 
@@ -194,17 +502,619 @@ def get_noc_data(noc: str,
             result[year]['season'] = {g.season for g in group}
             result[year]['total_entries'] = len(group)
             result[year]['unique_participants'] = len({g.name for g in group}) if group else 0
-            result[year]['medal_count'] = {
-                'total': len([g for g in group if g.medal]),
-                'gold':len([g for g in group if g.medal=='Gold']),
-                'silver':len([g for g in group if g.medal=='Silver']),
-                'bronze':len([g for g in group if g.medal=='Bronze']),
-                }
+            medals = Counter(g.medal for g in group)
+            if count_mode == CountModes.EVENT:
+                medals = event_medals[year]
+            result[year]['medal_count'] = medal_count(medals)
             if detail:
-                result[year]['entries'] = group
+                result[year]['entries'] = project(group, fields)
         return result
 
 
+@app.get("/compare", response_model=dict)
+@coalesce
+def get_compare_data(countries: List[str] = Query(None),
+                     nocs: List[str] = Query(None),
+                     sport: str = None,
+                     start_date: int = None,
+                     end_date: int = None,
+                     season: Seasons = Seasons.UNION):
+    """
+    Compare the entries and medals of several countries or NOCs year by year.
+
+    All series come from one query grouped by NOC and year, instead of one /country call each.
+
+    Args:
+        countries: Country names, exact matches e.g. countries=Finland&countries=Sweden
+        nocs: NOCs e.g. nocs=NOR
+        sport: Name of the sport to query.
+        start_date: The start year of the date range to query
+        end_date: The end year of the date range to query
+        season: Seasons to filter by. Defaults to union.
+
+    Returns:
+        A dict with the sorted years and per country or NOC the list of entries, participants
+        and medal counts of every year, 0 for years without entries. Participants are counted
+        per NOC.
+    """
+    if not countries and not nocs:
+        raise HTTPException(status_code=400, detail="At least one country or NOC is mandatory")
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="Start date should be less than end date")
+    if not regions.ready:
+        regions.build(router.reader())
+
+    series = {}
+    unknown = []
+    for country in countries or []:
+        matches = regions.resolve(country, exact=True)
+        if matches:
+            series[next(iter(matches.values()))[0]] = sorted(matches)
+        else:
+            unknown.append(country)
+    for noc in nocs or []:
+        if regions.get(noc) is None:
+            unknown.append(noc)
+        else:
+            series[noc.upper()] = [noc.upper()]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown countries or NOCs: {', '.join(unknown)}")
+
+    clauses = [('noc', sorted({noc for members in series.values() for noc in members}), 'in'),
+               ('sport', sport, 'equal'),
+               ('year', start_date, 'gte'),
+               ('year', end_date, 'lte')]
+
+    def build():
+        columns = ('noc', 'year', 'name', 'medal')
+        statement_1 = add_where(statement=select_columns(AthleteSummer, columns),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, columns),
+                                clauses=clauses, bind=True)
+        entries = season_statement(season, statement_1, statement_2).subquery()
+        return select(entries.c.noc, entries.c.year,
+                      func.count().label('entries'),
+                      func.count(entries.c.name.distinct()).label('participants'),
+                      func.count(entries.c.medal).label('medals'),
+                      *(func.count().filter(entries.c.medal == medal).label(medal.lower())
+                        for medal in ('Gold', 'Silver', 'Bronze'))
+                      ).group_by(entries.c.noc, entries.c.year)
+
+    statement = compare_statements.get((season, clause_shape(clauses)), build)
+
+    def query(shard):
+        with query_session(shard, 'compare', timeouts['compare']) as session:
+            return session.exec(statement, params=clause_params(clauses)).fetchall()
+
+    # rows are grouped by NOC, so the rows of different shards never overlap
+    rows = [row for part in router.scatter(query, clause_shards(clauses)) for row in part]
+
+    counts = ('entries', 'participants', 'medals', 'gold', 'silver', 'bronze')
+    years = sorted({row.year for row in rows})
+    index = {year: position for position, year in enumerate(years)}
+    result = {'years': years, 'series': {}}
+    by_noc = defaultdict(list)
+    for row in rows:
+        by_noc[row.noc].append(row)
+    for name, members in series.items():
+        matrix = {count: [0] * len(years) for count in counts}
+        for row in (row for noc in members for row in by_noc[noc]):
+            for count in counts:
+                matrix[count][index[row.year]] += getattr(row, count)
+        result['series'][name] = {'nocs': members, **matrix}
+    return result
+
+
+# medal colours of the time series, in the order of the medal table ranking
+MEDAL_ORDER = ('gold', 'silver', 'bronze')
+
+
+def games_medals_statement(clauses: List, count_mode: CountModes):
+    """Medals of every NOC at every Games from event_medals, filtered by the clauses"""
+    # the medals of a row are computed once, not once per colour
+    medals = event_medal_count() if count_mode == CountModes.EVENT else EventMedal.entries
+    rows = add_where(select(EventMedal.noc, EventMedal.games, EventMedal.year, EventMedal.season,
+                            EventMedal.medal, medals.label('medals')),
+                     clauses, bind=True).subquery()
+    count = func.sum(rows.c.medals)
+    statement = select(rows.c.noc, rows.c.games, rows.c.year, rows.c.season,
+                       *(func.coalesce(count.filter(rows.c.medal == medal.capitalize()), 0)
+                         .label(medal) for medal in MEDAL_ORDER),
+                       func.coalesce(count, 0).label('total'))
+    return statement.group_by(rows.c.noc, rows.c.games, rows.c.year, rows.c.season)
+
+
+def timeseries_statement(clauses: List, noc_clauses: List, year_clauses: List, count_mode: CountModes):
+    """
+    Medal time series of some NOCs in one statement over event_medals
+
+    The medals of every NOC at every Games are ranked per Games, then every requested
+    NOC gets a row for every Games, 0 medals where it won none. Running totals and
+    deltas from the previous Games of the same season are window functions over these
+    rows. The year range is applied last, so they count from the first Games.
+    """
+    medals = games_medals_statement(clauses, count_mode).subquery()
+    ranked = select(medals, func.rank().over(
+        partition_by=medals.c.games,
+        order_by=[medals.c[medal].desc() for medal in MEDAL_ORDER]).label('rank')).subquery()
+    games = select(medals.c.games, medals.c.year, medals.c.season).distinct().subquery()
+    nocs = add_where(select(Region.noc), noc_clauses, bind=True).subquery()
+    grid = select(nocs.c.noc, games.c.games, games.c.year, games.c.season,
+                  *(func.coalesce(ranked.c[count], 0).label(count) for count in (*MEDAL_ORDER, 'total')),
+                  ranked.c.rank
+                  ).select_from(nocs.join(games, true()).outerjoin(
+                      ranked, and_(ranked.c.noc == nocs.c.noc, ranked.c.games == games.c.games))
+                  ).subquery()
+    series = dict(partition_by=(grid.c.noc, grid.c.season), order_by=grid.c.year)
+    windowed = select(grid.c.noc, grid.c.games, grid.c.year, grid.c.season,
+                      *(grid.c[count] for count in (*MEDAL_ORDER, 'total')),
+                      cast(func.sum(grid.c.total).over(**series), BigInteger).label('cumulative'),
+                      grid.c.rank,
+                      (grid.c.total - func.lag(grid.c.total).over(**series)).label('delta')
+                      ).subquery()
+    return add_where(select(*windowed.c), year_clauses, bind=True)
+
+
+def merge_timeseries(parts: List, nocs: List, start_date: int = None, end_date: int = None):
+    """
+    Rows of the /timeseries statement computed from the Games medal rows of several shards
+
+    Shards only hold the medals of their own NOCs, so the Games are ranked here once
+    the rows of all NOCs are gathered.
+
+    Returns:
+        rows with the attributes of the rows of timeseries_statement
+    """
+    rows = [row for part in parts for row in part]
+    by_games = defaultdict(list)
+    for row in rows:
+        by_games[row.games].append(row)
+    ranks = {}
+    for games, members in by_games.items():
+        scores = sorted((tuple(getattr(row, medal) for medal in MEDAL_ORDER) for row in members), reverse=True)
+        for row in members:
+            score = tuple(getattr(row, medal) for medal in MEDAL_ORDER)
+            ranks[row.noc, games] = scores.index(score) + 1
+    medals = {(row.noc, row.games): row for row in rows}
+    games = sorted({(row.year, row.season, row.games) for row in rows})
+    result = []
+    for noc in nocs:
+        cumulative, previous = {}, {}
+        for year, season, name in games:
+            row = medals.get((noc, name))
+            counts = {count: getattr(row, count) if row else 0 for count in (*MEDAL_ORDER, 'total')}
+            cumulative[season] = cumulative.get(season, 0) + counts['total']
+            delta = counts['total'] - previous[season] if season in previous else None
+            previous[season] = counts['total']
+            if (start_date and year < start_date) or (end_date and year > end_date):
+                continue
+            result.append(SimpleNamespace(noc=noc, games=name, year=year, season=season, **counts,
+                                          cumulative=cumulative[season], rank=ranks.get((noc, name)),
+                                          delta=delta))
+    return result
+
+
+@app.get("/timeseries", response_model=dict)
+@coalesce
+def get_timeseries(nocs: List[str] = Query(None),
+                   sport: str = None,
+                   start_date: int = None,
+                   end_date: int = None,
+                   season: Seasons = Seasons.UNION,
+                   count_mode: CountModes = CountModes.EVENT):
+    """
+    Medal time series of one or several NOCs, Games by Games.
+
+    Computed in one statement with window functions over the precomputed event_medals
+    table, instead of regrouping athlete entries: running totals and deltas over the
+    Games of each NOC, and the rank of each NOC at each Games.
+
+    Args:
+        nocs: NOCs e.g. nocs=NOR&nocs=SWE
+        sport: Name of the sport to count the medals of.
+        start_date: The start year of the date range to return
+        end_date: The end year of the date range to return
+        season: Seasons to filter by. Defaults to union.
+        count_mode: event counts a team medal once, entry counts every medal-winning entry
+
+    Returns:
+        A dict with per NOC the list of its Games in order, each with the year, season,
+        gold, silver, bronze and total medals, the cumulative total and the delta from
+        the previous Games of the same season, and the rank in the medal table of the
+        Games (gold first, then silver and bronze), None without medals. Cumulative
+        totals count from the first Games whatever the date range.
+    """
+    if not nocs:
+        raise HTTPException(status_code=400, detail="At least one NOC is mandatory")
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="Start date should be less than end date")
+    if not regions.ready:
+        regions.build(router.reader())
+    nocs = sorted({noc.upper() for noc in nocs})
+    unknown = [noc for noc in nocs if regions.get(noc) is None]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown NOCs: {', '.join(unknown)}")
+
+    clauses = [('sport', sport, 'equal'),
+               ('season', None if season == Seasons.UNION else season.value, 'equal')]
+    noc_clauses = [('noc', nocs, 'in')]
+    year_clauses = [('year', start_date, 'gte'),
+                    ('year', end_date, 'lte')]
+    shards = router.shards()
+
+    if len(shards) == 1:
+        def build():
+            return timeseries_statement(clauses, noc_clauses, year_clauses, count_mode)
+
+        shape = (count_mode, clause_shape(clauses), clause_shape(year_clauses))
+        statement = timeseries_statements.get(shape, build)
+        with query_session(shards[0], 'timeseries', timeouts['timeseries']) as session:
+            rows = session.exec(statement, params=clause_params(clauses + noc_clauses + year_clauses)).fetchall()
+    else:
+        # a Games is ranked over the NOCs of every shard
+        statement = timeseries_statements.get(
+            ('shards', count_mode, clause_shape(clauses)),
+            lambda: games_medals_statement(clauses, count_mode))
+
+        def query(shard):
+            with query_session(shard, 'timeseries', timeouts['timeseries']) as session:
+                return session.exec(statement, params=clause_params(clauses)).fetchall()
+
+        rows = merge_timeseries(router.scatter(query, shards), nocs, start_date, end_date)
+
+    result = {noc: [] for noc in nocs}
+    for row in sorted(rows, key=lambda row: (row.noc, row.year, row.season)):
+        result[row.noc].append({'games': row.games, 'year': row.year, 'season': row.season,
+                                **{count: int(getattr(row, count)) for count in (*MEDAL_ORDER, 'total', 'cumulative')},
+                                'rank': row.rank,
+                                'delta': int(row.delta) if row.delta is not None else None})
+    return result
+
+
+@app.get("/stats/age", response_model=dict)
+@coalesce
+def get_age_stats(group_by: Dimensions = Dimensions.SPORT,
+                  noc: str = None,
+                  sport: str = None,
+                  start_date: int = None,
+                  end_date: int = None,
+                  season: Seasons = Seasons.UNION,
+                  min_age: int = 10,
+                  max_age: int = 70,
+                  bins: int = 12):
+    """
+    Age distribution and participation by sex, grouped by a dimension.
+
+    Everything is aggregated in the database: count, mean, standard deviation,
+    percentiles and a histogram with equal-width bins between min_age and max_age.
+
+    Args:
+        group_by: sport, noc, games, year or season. Defaults to sport.
+        noc: NOC to filter by e.g. 'FIN'
+        sport: Name of the sport to filter by
+        start_date: The start year of the date range to query
+        end_date: The end year of the date range to query
+        season: Seasons to filter by. Defaults to union.
+        min_age: lower edge of the histogram. Defaults to 10.
+        max_age: upper edge of the histogram. Defaults to 70.
+        bins: number of histogram bins. Defaults to 12.
+
+    Returns:
+        A dict with the bin edges and per group the entries, sex counts and age statistics.
+        Histograms count ages below min_age and from max_age on separately.
+    """
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="Start date should be less than end date")
+    if min_age >= max_age or not 0 < bins <= 200:
+        raise HTTPException(status_code=400,
+                            detail="min_age must be less than max_age and bins between 1 and 200")
+
+    clauses = [('noc', noc, 'equal'),
+               ('sport', sport, 'equal'),
+               ('year', start_date, 'gte'),
+               ('year', end_date, 'lte')]
+    dimension = group_by.value
+
+    def entries():
+        columns = tuple(dict.fromkeys((dimension, 'sex', 'age')))
+        statement_1 = add_where(statement=select_columns(AthleteSummer, columns),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, columns),
+                                clauses=clauses, bind=True)
+        return season_statement(season, statement_1, statement_2).subquery()
+
+    def valid_age(rows):
+        # ages missing in the source files are NULL or NaN, aggregates skip NULLs
+        return func.nullif(rows.c.age, float('nan'))
+
+    def build_stats():
+        rows = entries()
+        age, group = valid_age(rows), rows.c[dimension]
+        return select(group.label('group'),
+                      func.count().label('entries'),
+                      func.count().filter(rows.c.sex == 'M').label('male'),
+                      func.count().filter(rows.c.sex == 'F').label('female'),
+                      func.count(age).label('ages'),
+                      func.avg(age).label('mean'),
+                      func.stddev_samp(age).label('std'),
+                      func.min(age).label('min'),
+                      func.max(age).label('max'),
+                      func.percentile_cont(array(PERCENTILES)).within_group(age).label('percentiles'),
+                      ).group_by(group)
+
+    def build_histogram():
+        rows = entries()
+        age = valid_age(rows)
+        bucket = func.width_bucket(age, bindparam('min_age'), bindparam('max_age'),
+                                   bindparam('bins'))
+        return select(rows.c[dimension].label('group'), bucket.label('bucket'),
+                      func.count().label('count')
+                      ).where(age.isnot(None)).group_by(rows.c[dimension], bucket)
+
+    def build_ages():
+        rows = entries()
+        age = valid_age(rows).label('age')
+        return select(rows.c[dimension].label('group'), rows.c.sex, age,
+                      func.count().label('count')).group_by(rows.c[dimension], rows.c.sex, age)
+
+    params = clause_params(clauses)
+    key = (dimension, season, clause_shape(clauses))
+
+    def query(shard):
+        with query_session(shard, 'stats', timeouts['stats']) as session:
+            stats = session.exec(stats_statements.get(key, build_stats), params=params).fetchall()
+            histogram = session.exec(histogram_statements.get(key, build_histogram),
+                                     params={**params, 'min_age': min_age, 'max_age': max_age,
+                                             'bins': bins}).fetchall()
+        return stats, histogram
+
+    def query_ages(shard):
+        with query_session(shard, 'stats', timeouts['stats']) as session:
+            return session.exec(stats_statements.get(('ages',) + key, build_ages),
+                                params=params).fetchall()
+
+    shards = clause_shards(clauses)
+    if len(shards) == 1 or group_by == Dimensions.NOC:
+        # groups do not span shards
+        parts = router.scatter(query, shards)
+        stats = [row for part, _ in parts for row in part]
+        histogram = [row for _, part in parts for row in part]
+    else:
+        # percentiles of several shards can not be merged, the age counts can
+        stats, histogram = merge_age_counts(router.scatter(query_ages, shards), min_age, max_age, bins)
+
+    width = (max_age - min_age) / bins
+    result = {'group_by': dimension,
+              'edges': [min_age + width * step for step in range(bins + 1)],
+              'groups': {}}
+    counts = defaultdict(lambda: [0] * (bins + 2))
+    for row in histogram:
+        counts[row.group][row.bucket] = row.count
+    for row in sorted(stats, key=lambda row: (row.group is None, row.group)):
+        result['groups'][row.group] = {
+            'entries': row.entries,
+            'sex': {'M': row.male, 'F': row.female},
+            'age': {
+                'count': row.ages,
+                'mean': row.mean,
+                'std': row.std,
+                'min': row.min,
+                'max': row.max,
+                'percentiles': dict(zip((f'p{round(p * 100)}' for p in PERCENTILES),
+                                        row.percentiles or [None] * len(PERCENTILES))),
+                'histogram': counts[row.group][1:-1],
+                'below': counts[row.group][0],
+                'above': counts[row.group][-1],
+                },
+            }
+    return result
+
+
+def percentile_cont(ages: List, count: int, fraction: float):
+    """Percentile of sorted (age, count) pairs interpolated like percentile_cont in Postgres"""
+    def nth(index):
+        for age, repeat in ages:
+            if index < repeat:
+                return age
+            index -= repeat
+        return None
+
+    position = fraction * (count - 1)
+    lower, upper = nth(math.floor(position)), nth(math.ceil(position))
+    return lower + (upper - lower) * (position - math.floor(position))
+
+
+def merge_age_counts(parts: List, min_age: int, max_age: int, bins: int):
+    """
+    Rows of the /stats/age aggregates computed from the (group, sex, age, count) rows of several shards
+
+    Returns:
+        stats rows and histogram rows with the attributes of the SQL aggregates
+    """
+    groups = defaultdict(lambda: {'entries': 0, 'male': 0, 'female': 0, 'ages': Counter()})
+    for row in (row for part in parts for row in part):
+        group = groups[row.group]
+        group['entries'] += row.count
+        group['male'] += row.count if row.sex == 'M' else 0
+        group['female'] += row.count if row.sex == 'F' else 0
+        if row.age is not None:
+            group['ages'][row.age] += row.count
+    width = (max_age - min_age) / bins
+    stats, histogram = [], []
+    for name, group in groups.items():
+        ages = sorted(group['ages'].items())
+        count = sum(repeat for _, repeat in ages)
+        mean = sum(age * repeat for age, repeat in ages) / count if count else None
+        std = (math.sqrt(sum(repeat * (age - mean) ** 2 for age, repeat in ages) / (count - 1))
+               if count > 1 else None)
+        stats.append(SimpleNamespace(
+            group=name, entries=group['entries'], male=group['male'], female=group['female'],
+            ages=count, mean=mean, std=std,
+            min=ages[0][0] if ages else None, max=ages[-1][0] if ages else None,
+            percentiles=[percentile_cont(ages, count, p) for p in PERCENTILES] if count else None))
+        buckets = Counter()
+        for age, repeat in ages:
+            # width_bucket: 0 below min_age, bins + 1 from max_age on
+            buckets[0 if age < min_age else bins + 1 if age >= max_age
+                    else int((age - min_age) / width) + 1] += repeat
+        histogram += [SimpleNamespace(group=name, bucket=bucket, count=repeat)
+                      for bucket, repeat in buckets.items()]
+    return stats, histogram
+
+
+def json_value(value):
+    """Value of a row in a JSON document, None for the NaN of ages missing in the source files"""
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def export_entries(path: str, clauses: List, season: Seasons, output: ExportFormats):
+    """
+    Write the entries matching the clauses to a file, streamed with a server-side cursor.
+
+    Args:
+        path: file to write
+        clauses: list of tuples ( attr value relation )
+        season: Seasons to export
+        output: csv or jsonl
+
+    Returns:
+        A dict with the number of rows and bytes written
+    """
+    def build():
+        statement_1 = add_where(statement=select_columns(AthleteSummer, DETAIL_COLUMNS),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, DETAIL_COLUMNS),
+                                clauses=clauses, bind=True)
+        return season_statement(season, statement_1, statement_2).execution_options(stream_results=True)
+
+    rows = 0
+    statement = export_statements.get((season, clause_shape(clauses)), build)
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        if output == ExportFormats.CSV:
+            writer.writerow(DETAIL_COLUMNS)
+        # shards are streamed one after the other into the same file
+        for shard in clause_shards(clauses):
+            with query_session(shard, 'export', timeouts['export']) as session:
+                result = session.execute(statement, clause_params(clauses))
+                for partition in result.partitions(5000):
+                    if output == ExportFormats.CSV:
+                        writer.writerows(partition)
+                    else:
+                        file.writelines(json.dumps({key: json_value(value) for key, value in row._asdict().items()},
+                                                   allow_nan=False) + '\n'
+                                        for row in partition)
+                    rows += len(partition)
+    return {'rows': rows, 'bytes': os.path.getsize(path)}
+
+
+def install_profiles(rebuilt: AthleteProfiles):
+    """
+    Serve profiles rebuilt by a job, with the writes logged since the job read the tables
+    """
+    changes.install(rebuilt)
+    regions.build(router.writer())
+    return {'athletes': len(profiles)}
+
+
+def job_response(job):
+    """
+    Status of a job with the URLs to poll and to fetch its result
+    """
+    return {**job.to_dict(), 'status_url': f'/jobs/{job.id}', 'result_url': f'/jobs/{job.id}/result'}
+
+
+@app.post("/jobs/export", status_code=202)
+def submit_export(noc: str = None,
+                  country: str = None,
+                  sport: str = None,
+                  start_date: int = None,
+                  end_date: int = None,
+                  season: Seasons = Seasons.UNION,
+                  output: ExportFormats = ExportFormats.CSV):
+    """
+    Export the detail entries of a NOC, a country or the full history in the background.
+
+    Args:
+        noc: NOC to export e.g. 'FIN'
+        country: Country to export, exact match of the region name
+        sport: Name of the sport to export
+        start_date: The start year of the date range to export
+        end_date: The end year of the date range to export
+        season: Seasons to export. Defaults to union.
+        output: csv or jsonl. Defaults to csv.
+
+    Returns:
+        The queued job, poll status_url until it is done and fetch the file from result_url
+    """
+    if noc and country:
+        raise HTTPException(status_code=400, detail="Either noc or country, not both")
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="Start date should be less than end date")
+    nocs = None
+    if country:
+        if not regions.ready:
+            regions.build(router.reader())
+        nocs = sorted(regions.resolve(country, exact=True))
+        if not nocs:
+            raise HTTPException(status_code=404, detail=f"Unknown country {country}")
+    clauses = [('noc', noc, 'equal'),
+               ('noc', nocs, 'in'),
+               ('sport', sport, 'equal'),
+               ('year', start_date, 'gte'),
+               ('year', end_date, 'lte')]
+    job = jobs.submit('export', export_entries, clauses, season, output,
+                      artifact=f'entries.{output.value}')
+    if job is None:
+        raise HTTPException(status_code=503, detail="Too many pending jobs")
+    return job_response(job)
+
+
+@app.post("/jobs/rebuild", status_code=202, dependencies=[Depends(require_admin)])
+def submit_rebuild():
+    """
+    Rebuild the athlete profiles and the region index from the database in a worker process.
+
+    Returns:
+        The queued job
+    """
+    job = jobs.submit('rebuild', load_profiles, os.getenv('FILE_NAME'), os.getenv('SECTION_NAME'),
+                      cpu=True, on_done=install_profiles)
+    if job is None:
+        raise HTTPException(status_code=503, detail="Too many pending jobs")
+    return job_response(job)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Status of a job: queued, running, done or failed
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """
+    Result artifact of a finished job, or its result for jobs without artifact
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == 'failed':
+        raise HTTPException(status_code=409, detail=f"Job failed: {job.error}")
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if job.artifact is None:
+        return job.result
+    media_type = 'text/csv' if job.artifact.endswith('.csv') else 'application/x-ndjson'
+    return FileResponse(job.artifact, media_type=media_type,
+                        filename=os.path.basename(job.artifact))
+
+
 #TODO
 # correct season union
 # union winter :done
@@ -212,6 +1122,7 @@ def get_noc_data(noc: str,
 # add  games, country: done
 # add_medal : done
 @app.get("/athletes/{athlete_name}", response_model=dict)
+@coalesce
 def get_athlete_data(athlete_name: str,
 
                     #  medal_winner:bool = False, 
@@ -219,6 +1130,7 @@ def get_athlete_data(athlete_name: str,
                      detail: bool = False,
                      season: Seasons = Seasons.UNION,
                     #  sort:str = 'name'
+                     fields: str = None,
                     ):
     """
     Get data for a specific athlete. 
@@ -228,54 +1140,79 @@ def get_athlete_data(athlete_name: str,
       exact: If True the name must contain exactly the letters in the name
       detail: If True returns entries of the athlete in several games
       season
+      fields: Comma separated fields of the detail entries e.g. 'name,year,event,medal'
 
     Returns: 
       A dict with key 'athlete_name'
   """
-    with Session(engine) as session:
-        statement_1 = select(AthleteSummer)
-        statement_1 = add_where(statement=statement_1,
-                                clauses=[
-                                    ('name', athlete_name, 'equal' if exact else 'contain'),
-                                    ])
-        statement_2 = select(AthleteWinter)
-        statement_2 = add_where(statement=statement_2,
-                                clauses=[('name', athlete_name, 'equal' if exact else 'contain')])
-
-        if season == Seasons.SUMMER:
-            statement = union(statement_1, statement_1)
-        elif season == Seasons.WINTER:
-            statement = union(statement_2, statement_2)
-        elif season == Seasons.UNION:
-            statement = union(statement_1, statement_2)
-
-        athletes = session.exec(statement).fetchall()
-        sorted_athletes = sorted(athletes,
-                                 key=lambda x: (x.name.lower().find(athlete_name), x.name, x.year))
-
-        ## group by
-        grouped_data = groupby(sorted_athletes, key=lambda x: x.name)
-        result = defaultdict(lambda: defaultdict())
-        for name, group in grouped_data:
-            group = list(group)
-            result[name]['medal_count'] = len([g for g in group if g.medal])
-            result[name]['teams'] = sorted({g.team for g in group})
-            result[name]['games'] = sorted({g.games for g in group})
-            result[name]['sports'] = sorted({g.sport for g in group})
-            if detail:
-                result[name]['entries'] = group
-        return result
+    try:
+        fields = parse_fields(fields, DETAIL_COLUMNS)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+
+    # summaries are served from the precomputed profiles, without touching the database
+    if not detail and profiles.ready:
+        return profiles.search(athlete_name, exact=exact, season=season)
+
+    guard.check('athletes', cardinality.name_rows(athlete_name, exact), detail,
+                hint="Use a longer name or exact=true.")
+
+    clauses = [('name', athlete_name, 'equal' if exact else 'contain')]
+    columns = detail_columns(ATHLETE_COLUMNS, fields) if detail else ATHLETE_COLUMNS
+
+    def build():
+        statement_1 = add_where(statement=select_columns(AthleteSummer, columns),
+                                clauses=clauses, bind=True)
+        statement_2 = add_where(statement=select_columns(AthleteWinter, columns),
+                                clauses=clauses, bind=True)
+        return season_statement(season, statement_1, statement_2)
+
+    endpoint = 'detail' if detail else 'athletes'
+    statement = athlete_statements.get((columns, season, clause_shape(clauses)), build)
+
+    def query(shard):
+        with query_session(shard, endpoint, timeouts[endpoint]) as session:
+            return session.exec(statement, params=clause_params(clauses)).fetchall()
+
+    # an athlete can have entries for several NOCs, so every shard is asked
+    athletes = [row for part in router.scatter(query, router.shards()) for row in part]
+    sorted_athletes = sorted(athletes,
+                             key=lambda x: (x.name.lower().find(athlete_name.lower()), x.name, x.year))
+
+    ## group by
+    grouped_data = groupby(sorted_athletes, key=lambda x: x.name)
+    result = defaultdict(lambda: defaultdict())
+    for name, group in grouped_data:
+        group = list(group)
+        result[name]['medal_count'] = len([g for g in group if g.medal])
+        result[name]['teams'] = sorted({g.team for g in group})
+        result[name]['games'] = sorted({g.games for g in group})
+        result[name]['sports'] = sorted({g.sport for g in group})
+        if detail:
+            result[name]['entries'] = project(group, fields)
+    return result
+
+
+# the hottest /country, /noc and /athletes requests are replayed after a restart,
+# except /athletes summaries, served from the profiles
+warmup = WarmUp({'get_country_data': get_country_data, 'get_noc_data': get_noc_data,
+                 'get_athlete_data': get_athlete_data},
+                skip=lambda name, params: name == 'get_athlete_data' and not params['detail'],
+                **settings(filename=os.getenv('FILE_NAME'), section='warmup', defaults=WARMUP_DEFAULTS))
+observe(warmup.record)
 
 
 #propogate errors
 #return types
 @app.post("/add_athlete/")
-def add_athlete(*, session: Session = Depends(get_session), athlete: AthleteBase):
+def add_athlete(*, session: Session = Depends(get_session), athlete: AthleteBase,
+                buffered: bool = None, response: Response):
     """
      Add athlete to database. 
      
      Args:
      	 athlete: athlete model
+     	 buffered: acknowledge with 202 and insert in the next batch, defaults to the ingest configuration
      
      Returns: 
      	 Athlete
@@ -288,12 +1225,27 @@ def add_athlete(*, session: Session = Depends(get_session), athlete: AthleteBase
             db_athlete = AthleteWinter.from_orm(athlete)
         case _:
             raise HTTPException(status_code=422, detail="Invalid Season. 'Winter' or 'Summer'")
+    if ingest_options['buffered'] if buffered is None else buffered:
+        if regions.get(db_athlete.noc) is None:
+            raise HTTPException(status_code=422, detail=f"Unknown NOC {db_athlete.noc}")
+        try:
+            ingest.put(db_athlete)
+        except BufferFull as error:
+            raise HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "1"}) from error
+        router.mark_write()
+        response.status_code = 202
+        return db_athlete
     try:
-        session.add(db_athlete)
-        session.commit()
-        session.refresh(db_athlete)
+        with shard_session(session, router.shard(db_athlete.noc)) as session:
+            session.add(db_athlete)
+            record_medal(session, db_athlete, 1)
+            log_changes(session, added=[(season_of(db_athlete), db_athlete)])
+            session.commit()
+            router.mark_write()
+            session.refresh(db_athlete)
     except Exception as error:
         raise HTTPException(status_code=422, detail=str(error)) from error
+    changes.catch_up(router.shards([db_athlete.noc]))
     return db_athlete
 
 
@@ -314,19 +1266,28 @@ def update_athlete(*, session: Session = Depends(get_session), athlete_id: int,
      Returns: 
      	 Athlete
     """
-    db_athlete = session.get(AthleteSummer, athlete_id)
-    if not db_athlete:
-        db_athlete = session.get(AthleteWinter, athlete_id)
-    if not db_athlete:
-        raise HTTPException(status_code=404, detail="Athlete not found")
-    for field, value in athlete_update.dict(exclude_unset=True).items():
-        setattr(db_athlete, field, value)
-    try:
-        session.add(db_athlete)
-        session.commit()
-        session.refresh(db_athlete)
-    except Exception as error:
-        raise HTTPException(status_code=422, detail=str(error)) from error
+    if ingest.pending(athlete_id):
+        ingest.flush()
+    with athlete_session(session, athlete_id) as (session, db_athlete):
+        if not db_athlete:
+            raise HTTPException(status_code=404, detail="Athlete not found")
+        previous = SimpleNamespace(**db_athlete.dict())
+        for field, value in athlete_update.dict(exclude_unset=True).items():
+            setattr(db_athlete, field, value)
+        if router.shard(db_athlete.noc) is not router.shard(previous.noc):
+            raise HTTPException(status_code=422, detail="NOC of another shard, delete and add the athlete")
+        try:
+            session.add(db_athlete)
+            record_medal(session, previous, -1)
+            record_medal(session, db_athlete, 1)
+            log_changes(session, added=[(season_of(db_athlete), db_athlete)],
+                        removed=[(season_of(db_athlete), previous)])
+            session.commit()
+            router.mark_write()
+            session.refresh(db_athlete)
+        except Exception as error:
+            raise HTTPException(status_code=422, detail=str(error)) from error
+    changes.catch_up(router.shards([db_athlete.noc]))
     return db_athlete
 
 
@@ -341,16 +1302,218 @@ def delete_athlete(*, session: Session = Depends(get_session), athlete_id: int):
      Returns: 
      	 {"Deleted": True}
     """
-    db_athlete = session.get(AthleteSummer, athlete_id)
-    if not db_athlete:
-        db_athlete = session.get(AthleteWinter, athlete_id)
-    if not db_athlete:
-        raise HTTPException(status_code=404, detail="Athlete not found")
-    session.delete(db_athlete)
-    session.commit()
+    if ingest.pending(athlete_id):
+        ingest.flush()
+    with athlete_session(session, athlete_id) as (session, db_athlete):
+        if not db_athlete:
+            raise HTTPException(status_code=404, detail="Athlete not found")
+        previous = SimpleNamespace(**db_athlete.dict())
+        session.delete(db_athlete)
+        record_medal(session, previous, -1)
+        log_changes(session, removed=[(season_of(db_athlete), previous)])
+        session.commit()
+        router.mark_write()
+    changes.catch_up(router.shards([previous.noc]))
     return {"Deleted": True}
 
 
+# relations of the bulk filter clauses per value type, for text and for numeric attributes
+BULK_TEXT_RELATIONS = {'str': ('equal', 'contain'), 'list': ('in',)}
+BULK_NUMBER_RELATIONS = {'int': ('equal', 'unequal', 'gt', 'gte', 'lt', 'lte'),
+                         'float': ('equal', 'unequal', 'gt', 'gte', 'lt', 'lte'), 'list': ('in',)}
+
+def bulk_relations(attr: str):
+    """Relations add_where supports per value type for an attribute, None for unknown attributes"""
+    if attr == 'id':
+        return {'int': BULK_NUMBER_RELATIONS['int'], 'list': ('in',)}
+    field = AthleteBase.__fields__.get(attr)
+    if field is None:
+        return None
+    return BULK_TEXT_RELATIONS if issubclass(field.type_, str) else BULK_NUMBER_RELATIONS
+
+def bulk_clauses(selection: AthleteBulkDelete):
+    """
+     Clauses selecting the athletes of a bulk request
+
+     Args:
+     	 selection: ids or [attr, value, relation] filter clauses
+
+     Returns:
+     	 list of tuples ( attr value relation ) for add_where
+    """
+    if bool(selection.ids) == bool(selection.where):
+        raise HTTPException(status_code=422, detail="Either ids or where is needed")
+    if selection.ids:
+        return [('id', selection.ids, 'in')]
+    for (attr, value, relation) in selection.where:
+        relations = bulk_relations(attr)
+        if relations is None:
+            raise HTTPException(status_code=422, detail=f"Unknown attribute {attr}")
+        # a clause add_where can not apply would leave the statement without its filter
+        kind = type(value).__name__
+        items = {type(item).__name__ for item in value} if isinstance(value, list) else set()
+        scalars = {'str'} if relations is BULK_TEXT_RELATIONS else set(relations) - {'list'}
+        if relation not in relations.get(kind, ()) or not items <= scalars:
+            raise HTTPException(status_code=422,
+                                detail=f"Relation {relation} is not supported for {attr} and value {value!r}")
+    if not clause_shape(selection.where):
+        raise HTTPException(status_code=422, detail="Filter selects every athlete")
+    return [tuple(clause) for clause in selection.where]
+
+def filtered(statement):
+    """The statement of a bulk request, refused if it has no WHERE clause and would change every athlete"""
+    if statement.whereclause is None:
+        raise HTTPException(status_code=422, detail="Filter selects every athlete")
+    return statement
+
+def bulk_change(session: Session, statement, values: dict = None):
+    """
+     Run a set-based update or delete returning the previous rows, then maintain the event
+     medals in the same transaction
+
+     Returns:
+     	 list of ( previous current ) entries, current is None for deleted rows
+    """
+    previous = [SimpleNamespace(**row._mapping) for row in session.execute(statement)]
+    current = [SimpleNamespace(**{**vars(row), **values}) for row in previous] if values is not None else []
+    record_medals(session, previous, -1)
+    record_medals(session, current, 1)
+    return list(zip(previous, current or [None] * len(previous)))
+
+
+@app.patch("/update_athletes/")
+def update_athletes(*, session: Session = Depends(get_session), bulk: AthleteBulkUpdate):
+    """
+     Update every athlete selected by ids or filter clauses with one statement per season table
+     
+     Args:
+      bulk: AthleteBulkUpdate model, ids or where and the values to set
+     
+     Returns: 
+     	 {"Updated": total, "summer": count, "winter": count}
+    """
+    clauses = bulk_clauses(bulk)
+    values = {field: getattr(value, 'value', value)
+              for field, value in bulk.values.dict(exclude_unset=True).items()}
+    if not values:
+        raise HTTPException(status_code=422, detail="No values to update")
+    if 'season' in values:
+        raise HTTPException(status_code=422, detail="Season can not be changed in bulk")
+    if 'noc' in values and len(router.shards()) > 1:
+        raise HTTPException(status_code=422, detail="NOC can not be changed in bulk across shards")
+    statements = {}
+    for season, model in ((Seasons.SUMMER, AthleteSummer), (Seasons.WINTER, AthleteWinter)):
+        table = model.__table__
+        old = filtered(add_where(select(table), clauses)).with_for_update().subquery('old')
+        statements[season] = update(table).where(table.c.id == old.c.id).values(**values).returning(*old.c)
+    ingest.flush()
+
+    def change(shard):
+        with shard_session(session, shard) as session_of_shard:
+            changed = {}
+            for season, statement in statements.items():
+                changed[season] = bulk_change(session_of_shard, statement, values)
+            log_changes(session_of_shard,
+                        added=[(season, current) for season, rows in changed.items() for _, current in rows],
+                        removed=[(season, previous) for season, rows in changed.items() for previous, _ in rows])
+            session_of_shard.commit()
+            return changed
+
+    # one transaction per shard
+    changed = defaultdict(list)
+    try:
+        for part in router.scatter(change, clause_shards(clauses)):
+            for season, rows in part.items():
+                changed[season] += rows
+        router.mark_write()
+    except Exception as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    changes.catch_up(clause_shards(clauses))
+    return {"Updated": sum(map(len, changed.values())),
+            **{season.value: len(rows) for season, rows in changed.items()}}
+
+
+@app.post("/delete_athletes/")
+def delete_athletes(*, session: Session = Depends(get_session), bulk: AthleteBulkDelete):
+    """
+     Delete every athlete selected by ids or filter clauses with one statement per season table
+     
+     Args:
+      bulk: AthleteBulkDelete model, ids or where
+     
+     Returns: 
+     	 {"Deleted": total, "summer": count, "winter": count}
+    """
+    clauses = bulk_clauses(bulk)
+    statements = {season: filtered(add_where(delete(model.__table__), clauses)).returning(*model.__table__.c)
+                  for season, model in ((Seasons.SUMMER, AthleteSummer), (Seasons.WINTER, AthleteWinter))}
+    ingest.flush()
+
+    def change(shard):
+        with shard_session(session, shard) as session_of_shard:
+            changed = {}
+            for season, statement in statements.items():
+                changed[season] = bulk_change(session_of_shard, statement)
+            log_changes(session_of_shard,
+                        removed=[(season, previous) for season, rows in changed.items() for previous, _ in rows])
+            session_of_shard.commit()
+            return changed
+
+    # one transaction per shard
+    changed = defaultdict(list)
+    try:
+        for part in router.scatter(change, clause_shards(clauses)):
+            for season, rows in part.items():
+                changed[season] += rows
+        router.mark_write()
+    except Exception as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    changes.catch_up(clause_shards(clauses))
+    return {"Deleted": sum(map(len, changed.values())),
+            **{season.value: len(rows) for season, rows in changed.items()}}
+
+
+def set_shard_region(shard, noc: str, db_region: Region = None):
+    """Set the copy of a region on a shard, deleting it when db_region is None"""
+    with Session(shard.writer()) as session:
+        shard_region = session.get(Region, noc)
+        if db_region is None:
+            if shard_region:
+                session.delete(shard_region)
+                # the athletes of the region are deleted by the foreign key cascade
+                log_changes(session, rebuild=True)
+        elif shard_region:
+            for field, value in db_region.dict().items():
+                setattr(shard_region, field, value)
+        else:
+            session.add(Region(**db_region.dict()))
+        session.commit()
+
+
+def copy_region(noc: str, db_region: Region = None, previous: Region = None):
+    """
+     Apply a region change to the shards, they keep a copy of the regions for their foreign keys.
+     When a shard fails, the shards already changed get the previous region back and the error
+     is raised, so the caller can undo the change on the home database.
+
+     Args:
+     	 noc: noc of the region before the change
+     	 db_region: region after the change, None if it is deleted
+     	 previous: region before the change, None if it is added
+    """
+    changed = []
+    try:
+        for shard in router.shards():
+            if shard.writer() is engine:
+                continue
+            set_shard_region(shard, noc, db_region)
+            changed.append(shard)
+    except Exception:
+        for shard in changed:
+            set_shard_region(shard, db_region.noc if db_region else noc, previous)
+        raise
+
+
 #propogate errors
 #return types
 @app.post("/add_region/", response_model=Region)
@@ -367,10 +1530,21 @@ def add_region(*, session: Session = Depends(get_session), region: RegionBase):
     db_region = Region.from_orm(region)
     try:
         session.add(db_region)
+        bump(session, REGIONS)
         session.commit()
+        router.mark_write()
         session.refresh(db_region)
     except Exception as error:
         raise HTTPException(status_code=422, detail=str(error)) from error
+    try:
+        copy_region(db_region.noc, db_region)
+    except Exception as error:
+        # the region is only added once every shard has it
+        session.delete(db_region)
+        bump(session, REGIONS)
+        session.commit()
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    regions.add(db_region)
     return db_region
 
 
@@ -389,20 +1563,35 @@ def update_region(*, session: Session = Depends(get_session), noc: str, region_u
     db_region = session.get(Region, noc)
     if not db_region:
         raise HTTPException(status_code=404, detail="Region not found")
+    previous = Region(**db_region.dict())
     for field, value in region_update.dict(exclude_unset=True).items():
         setattr(db_region, field, value)
     try:
+        bump(session, REGIONS)
         session.commit()
+        router.mark_write()
         session.refresh(db_region)
     except Exception as error:
         raise HTTPException(status_code=422, detail=str(error)) from error
+    try:
+        copy_region(noc, db_region, previous)
+    except Exception as error:
+        # the region is only updated once every shard has the update
+        for field, value in previous.dict().items():
+            setattr(db_region, field, value)
+        bump(session, REGIONS)
+        session.commit()
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    regions.remove(noc)
+    regions.add(db_region)
     return db_region
 
 
 @app.delete("/delete_region/{noc}")
 def delete_region(*, session: Session = Depends(get_session), noc: str):
     """
-     Delete region
+     Delete region, from the shards first: the athletes of a shard are gone with its copy of the
+     region, so a failing shard leaves the region on the home database and a retry finishes the delete
      
      Args:
      	 noc: value of noc to delete
@@ -414,6 +1603,16 @@ def delete_region(*, session: Session = Depends(get_session), noc: str):
     if not db_region:
         raise HTTPException(status_code=404, detail="Region not found")
 
+    try:
+        copy_region(noc)
+    except Exception as error:
+        raise HTTPException(status_code=422, detail=f"Region deleted on some shards only, retry: {error}") from error
     session.delete(db_region)
+    bump(session, REGIONS)
+    # athletes and event medals of the region are deleted by the foreign key cascade
+    log_changes(session, rebuild=True)
     session.commit()
+    router.mark_write()
+    regions.remove(noc)
+    changes.catch_up()
     return {"Deleted": True}
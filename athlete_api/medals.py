@@ -0,0 +1,111 @@
+"""
+Maintenance of the event_medals table
+"""
+
+from sqlalchemy import and_, bindparam, case, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import delete, update
+
+from .models import EventMedal
+
+# rebuilds event_medals from the athlete tables, one row per (games, event, noc, medal)
+REBUILD_EVENT_MEDALS = """
+    INSERT INTO event_medals (games, event, noc, medal, year, season, sport, entries)
+    SELECT games, event, noc, medal, min(year), min(season), min(sport), count(*)
+    FROM (SELECT games, event, noc, medal, year, season, sport FROM athletes_summer
+          UNION ALL
+          SELECT games, event, noc, medal, year, season, sport FROM athletes_winter) athletes
+    WHERE medal IS NOT NULL AND games IS NOT NULL AND event IS NOT NULL AND noc IS NOT NULL
+    GROUP BY games, event, noc, medal
+"""
+
+
+def event_medal_count():
+  """Medals an event_medals row stands for when a team medal counts once
+
+  A row sums the entries of one NOC sharing a medal of an event. A gold or silver
+  row with several entries, or any row with more than two, is a team medal: an
+  individual event awards one gold, one silver and at most two bronzes. A bronze
+  row of two entries is either a team of two or two individual bronzes, as in
+  judo or boxing, and counts as two medals unless a team of the same event won a
+  gold or silver with more than one entry at any Games. With the athletes
+  sharded by NOC, only the rows of the same shard are seen.
+
+  Returns:
+      SQL expression of the number of medals of a row
+  """
+  table = EventMedal.__table__
+  shared = table.alias('shared_medals')
+  team_events = select(shared.c.event).where(shared.c.medal.in_(('Gold', 'Silver')), shared.c.entries > 1)
+  individual = and_(table.c.medal == 'Bronze', table.c.entries == 2, ~table.c.event.in_(team_events))
+  return case((individual, 2), else_=1)
+
+
+def _medal(athlete):
+  medal = athlete.medal
+  return getattr(medal, 'value', medal)
+
+
+def record_medal(session, athlete, sign:int):
+  """Count (sign=1) or uncount (sign=-1) the medal of an athlete entry
+
+  Runs in the transaction of the session, so the table changes with the entry.
+  Entries without medal, games, event or NOC are not part of the table.
+
+  Args:
+      session: session of the athlete change
+      athlete: entry with games, event, noc, medal, year, season and sport attributes
+      sign (int): 1 for an added entry, -1 for a removed one
+  """
+  medal = _medal(athlete)
+  if not (medal and athlete.games and athlete.event and athlete.noc):
+    return
+  key = (EventMedal.games == athlete.games, EventMedal.event == athlete.event,
+         EventMedal.noc == athlete.noc, EventMedal.medal == medal)
+  if sign > 0:
+    statement = insert(EventMedal.__table__).values(
+      games=athlete.games, event=athlete.event, noc=athlete.noc, medal=medal,
+      year=athlete.year, season=athlete.season, sport=athlete.sport, entries=1)
+    session.execute(statement.on_conflict_do_update(
+      index_elements=['games', 'event', 'noc', 'medal'],
+      set_={'entries': EventMedal.__table__.c.entries + 1}))
+  else:
+    session.execute(update(EventMedal).where(*key).values(entries=EventMedal.entries - 1))
+    session.execute(delete(EventMedal).where(*key, EventMedal.entries <= 0))
+
+
+def record_medals(session, athletes, sign:int = 1):
+  """Count (sign=1) or uncount (sign=-1) the medals of many entries with set-based statements
+
+  Args:
+      session: session of the athlete changes
+      athletes: entries with games, event, noc, medal, year, season and sport attributes
+      sign (int, optional): 1 for added entries, -1 for removed ones. Defaults to 1.
+  """
+  rows = {}
+  for athlete in athletes:
+    medal = _medal(athlete)
+    if not (medal and athlete.games and athlete.event and athlete.noc):
+      continue
+    key = (athlete.games, athlete.event, athlete.noc, medal)
+    if key in rows:
+      rows[key]['entries'] += 1
+    else:
+      rows[key] = {'games': athlete.games, 'event': athlete.event, 'noc': athlete.noc, 'medal': medal,
+                   'year': athlete.year, 'season': athlete.season, 'sport': athlete.sport, 'entries': 1}
+  if not rows:
+    return
+  table = EventMedal.__table__
+  if sign > 0:
+    statement = insert(table).values(list(rows.values()))
+    session.execute(statement.on_conflict_do_update(
+      index_elements=['games', 'event', 'noc', 'medal'],
+      set_={'entries': table.c.entries + statement.excluded.entries}))
+    return
+  key = [table.c.games == bindparam('b_games'), table.c.event == bindparam('b_event'),
+         table.c.noc == bindparam('b_noc'), table.c.medal == bindparam('b_medal')]
+  params = [{f'b_{name}': row[name] for name in ('games', 'event', 'noc', 'medal', 'entries')}
+            for row in rows.values()]
+  session.execute(table.update().where(*key).values(entries=table.c.entries - bindparam('b_entries')),
+                  params)
+  session.execute(table.delete().where(*key, table.c.entries <= 0), params)
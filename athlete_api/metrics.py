@@ -0,0 +1,63 @@
+"""
+Metrics registry
+"""
+
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+  """In-process counters and gauges exported in Prometheus text format
+
+  Every metric is identified by its name and a sorted tuple of label pairs.
+  """
+  def __init__(self):
+    self._counters = defaultdict(float)
+    self._gauges = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _key(name:str, labels:dict):
+    return (name, tuple(sorted(labels.items())))
+
+  def inc(self, name:str, value:float = 1, **labels):
+    """Increment a counter
+
+    Args:
+        name (str): metric name e.g. 'admission_shed_total'
+        value (float, optional): increment. Defaults to 1.
+        labels: label values of the series
+    """
+    with self._lock:
+      self._counters[self._key(name, labels)] += value
+
+  def set(self, name:str, value:float, **labels):
+    """Set a gauge
+
+    Args:
+        name (str): metric name
+        value (float): current value
+        labels: label values of the series
+    """
+    with self._lock:
+      self._gauges[self._key(name, labels)] = value
+
+  def get(self, name:str, **labels):
+    """Current value of a counter or gauge, 0 if never recorded"""
+    key = self._key(name, labels)
+    with self._lock:
+      return self._gauges.get(key, self._counters.get(key, 0))
+
+  def render(self):
+    """Render all series in Prometheus text exposition format"""
+    lines = []
+    with self._lock:
+      series = sorted({**self._counters, **self._gauges}.items())
+    for (name, labels), value in series:
+      value = int(value) if float(value).is_integer() else value
+      label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+      lines.append(f'{name}{{{label_text}}} {value}' if labels else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
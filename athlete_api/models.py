@@ -2,7 +2,7 @@
 Model classes for postgresql db
 """
 from enum import Enum
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from sqlmodel import Field, SQLModel
 
@@ -13,6 +13,21 @@ class Seasons(str, Enum):
   WINTER = 'winter'
   UNION = 'union'
 
+class Dimensions(str, Enum):
+  SPORT = 'sport'
+  NOC = 'noc'
+  GAMES = 'games'
+  YEAR = 'year'
+  SEASON = 'season'
+
+class ExportFormats(str, Enum):
+  CSV = 'csv'
+  JSONL = 'jsonl'
+
+class CountModes(str, Enum):
+  ENTRY = 'entry'
+  EVENT = 'event'
+
 class Medals(str, Enum):
   GOLD = 'Gold'
   SILVER = 'Silver'
@@ -81,6 +96,23 @@ class AthleteUpdate(AthleteBase):
   event: Optional[str]
   medal: Optional[Medals] = None
 
+class AthleteBulkDelete(SQLModel):
+  """Selection of the athletes changed by a bulk request, either ids or filter clauses
+
+  Args:
+      SQLModel (_type_): where holds [attr, value, relation] clauses as taken by add_where
+  """
+  ids: Optional[List[int]] = None
+  where: Optional[List[Tuple[str, Any, str]]] = None
+
+class AthleteBulkUpdate(AthleteBulkDelete):
+  """Bulk update model for athletes
+
+  Args:
+      AthleteBulkDelete (_type_): values are set on every selected athlete
+  """
+  values: AthleteUpdate
+
 class AthleteSummer(AthleteBase,  table=True):
   """Custom model for Summer table with tablename
 
@@ -101,3 +133,53 @@ class AthleteWinter(AthleteBase,  table=True):
   """
   __tablename__ = 'athletes_winter'
   id: Optional[int] = Field(default=None, primary_key=True)
+
+
+class EventMedal(SQLModel, table=True):
+  """Medals won per event and NOC, a team medal is one row whatever the team size
+
+  Args:
+      SQLModel (_type_): entries is the number of athlete rows sharing the medal
+  """
+  __tablename__ = 'event_medals'
+  games: str = Field(primary_key=True)
+  event: str = Field(primary_key=True)
+  noc: str = Field(primary_key=True, foreign_key="regions.noc")
+  medal: str = Field(primary_key=True)
+  year: Optional[int] = None
+  season: Optional[str] = None
+  sport: Optional[str] = None
+  entries: int = 0
+
+
+class CacheGeneration(SQLModel, table=True):
+  """Number of committed changes of a table cached by the workers
+
+  Args:
+      SQLModel (_type_): name of the cache, generation is bumped in the transaction of every change
+  """
+  __tablename__ = 'cache_generations'
+  name: str = Field(primary_key=True)
+  generation: int = 0
+
+
+class AthleteChange(SQLModel, table=True):
+  """Athlete entry added (sign 1) or removed (sign -1) by a change, sign 0 asks for a rebuild
+
+  Args:
+      SQLModel (_type_): generation of the change and the fields of the entry used by the profiles
+        and the cardinality estimates
+  """
+  __tablename__ = 'athlete_changes'
+  id: Optional[int] = Field(default=None, primary_key=True)
+  generation: int = Field(index=True)
+  created: float
+  sign: int
+  season: Optional[str] = None
+  name: Optional[str] = None
+  team: Optional[str] = None
+  games: Optional[str] = None
+  sport: Optional[str] = None
+  medal: Optional[str] = None
+  noc: Optional[str] = None
+  year: Optional[int] = None
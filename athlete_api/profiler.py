@@ -0,0 +1,238 @@
+"""
+Sampling profiler of live workers, with collapsed stack output for flame graphs
+"""
+
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from .admin import require_admin
+from .metrics import metrics
+
+# options of the [profiler] section in database.ini
+PROFILER_DEFAULTS = {'interval': 0.005, 'max_seconds': 60.0, 'keep': 20}
+
+# sampler of the profiled request being handled, None when the request is not profiled
+current_sampler = ContextVar('current_sampler', default=None)
+
+# innermost frames of threads waiting for work, left out of the profiles unless asked for
+IDLE_FRAMES = {('threading', 'wait'), ('threading', '_wait_for_tstate_lock'),
+               ('selectors', 'select'), ('queue', 'get'), ('concurrent.futures.thread', '_worker')}
+
+
+def frame_label(frame):
+  """module:function label of a frame, without the ';' separating the frames of a stack"""
+  code = frame.f_code
+  return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}".replace(';', ',')
+
+
+def tracked(fn):
+  """Wrap a function so the sampler of the profiled request, if any, samples the thread running it"""
+  def run(*args, **kwargs):
+    sampler = current_sampler.get()
+    if sampler is None:
+      return fn(*args, **kwargs)
+    with sampler.track():
+      return fn(*args, **kwargs)
+  return run
+
+
+class Sampler:
+  """Samples the Python stacks of the threads of this process at a fixed interval
+
+  Stacks are counted in the collapsed format of flamegraph.pl and speedscope, one
+  line per distinct stack, rooted at the name of the thread. Nothing runs unless
+  a sampler is started, so profiling costs nothing when it is off.
+
+  Args:
+      interval (float, optional): seconds between samples. Defaults to 0.005.
+      threads (set, optional): idents of the sampled threads. Defaults to all threads.
+      idle (bool, optional): keep the stacks of threads waiting for work. Defaults to False.
+  """
+  def __init__(self, interval:float = 0.005, threads:set = None, idle:bool = False):
+    self.interval = interval
+    self.threads = threads
+    self.idle = idle
+    # the sampling thread and threads waiting for a profile are never sampled
+    self.excluded = set()
+    self.stacks = Counter()
+    self.samples = 0
+    self.seconds = 0.0
+    self._started = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Start sampling in a background thread"""
+    self._started = time.perf_counter()
+    self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    """Stop sampling and wait for the last sample"""
+    if self._thread is not None and not self._stop.is_set():
+      self._stop.set()
+      self._thread.join()
+      self.seconds = time.perf_counter() - self._started
+    return self
+
+  @contextmanager
+  def track(self):
+    """Sample the current thread while the block runs"""
+    ident = threading.get_ident()
+    self.threads.add(ident)
+    try:
+      yield
+    finally:
+      self.threads.discard(ident)
+
+  def _run(self):
+    self.excluded.add(threading.get_ident())
+    while not self._stop.wait(self.interval):
+      self.sample()
+
+  def sample(self):
+    """Count the current stack of every sampled thread once"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+      if ident in self.excluded or (self.threads is not None and ident not in self.threads):
+        continue
+      if not self.idle and (frame.f_globals.get('__name__'), frame.f_code.co_name) in IDLE_FRAMES:
+        continue
+      stack = []
+      while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+      stack.append(names.get(ident, 'thread').replace(';', ','))
+      self.stacks[';'.join(reversed(stack))] += 1
+    self.samples += 1
+
+  def collapsed(self):
+    """Counted stacks in the collapsed format, one 'frame;frame;frame count' line per stack"""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+
+class Profiler:
+  """Runs whole-worker and per-request samplers and keeps their latest profiles
+
+  Args:
+      interval (float, optional): seconds between samples. Defaults to 0.005.
+      max_seconds (float, optional): longest whole-worker profile. Defaults to 60.
+      keep (int, optional): profiles kept for download. Defaults to 20.
+  """
+  def __init__(self, interval:float = 0.005, max_seconds:float = 60.0, keep:int = 20):
+    self.interval = interval
+    self.max_seconds = max_seconds
+    self.keep = keep
+    self.profiles = OrderedDict()
+    self._lock = threading.Lock()
+    self._worker = threading.Lock()
+
+  def store(self, sampler):
+    """Keep a finished profile, dropping the oldest beyond `keep`
+
+    Returns:
+        str: id of the profile
+    """
+    profile_id = uuid.uuid4().hex[:12]
+    with self._lock:
+      self.profiles[profile_id] = sampler
+      while len(self.profiles) > self.keep:
+        self.profiles.popitem(last=False)
+    return profile_id
+
+  def get(self, profile_id:str):
+    """Kept profile, None if unknown or dropped"""
+    with self._lock:
+      return self.profiles.get(profile_id)
+
+  def sample_worker(self, seconds:float, idle:bool = False):
+    """Sample every thread of this worker for some seconds, one profile at a time
+
+    Args:
+        seconds (float): duration, at most `max_seconds`
+        idle (bool, optional): keep the stacks of threads waiting for work. Defaults to False.
+
+    Returns:
+        tuple: id of the profile and its Sampler
+    """
+    if not 0 < seconds <= self.max_seconds:
+      raise HTTPException(status_code=400, detail=f"seconds must be in (0, {self.max_seconds}]")
+    if not self._worker.acquire(blocking=False):
+      raise HTTPException(status_code=409, detail="A worker profile is already running")
+    try:
+      sampler = Sampler(self.interval, idle=idle)
+      sampler.excluded.add(threading.get_ident())
+      sampler.start()
+      time.sleep(seconds)
+      sampler.stop()
+    finally:
+      self._worker.release()
+    metrics.inc('profiles_total', mode='worker')
+    return self.store(sampler), sampler
+
+
+class ProfileMiddleware:
+  """ASGI middleware profiling the requests sent with profile=true and the admin token
+
+  The sampler follows the event loop thread, for routing, validation and
+  serialization, and the worker thread running the endpoint, which coalesced
+  endpoints register with Sampler.track, as well as the threads querying the
+  shards of a scattered query. A profiled request is not coalesced, so
+  its profile shows its own work. Sampling stops when the response starts, and
+  the response carries the profile id in the X-Profile-Id header for download
+  from /admin/profiles/{profile_id}. Other requests only pay for a substring
+  test of the query string.
+
+  Args:
+      app: ASGI application
+      profiler (Profiler): keeps the profiles
+  """
+  def __init__(self, app, profiler):
+    self.app = app
+    self.profiler = profiler
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or b'profile=' not in scope.get('query_string', b''):
+      await self.app(scope, receive, send)
+      return
+    flag = parse_qs(scope['query_string'].decode('latin-1')).get('profile', [''])[-1]
+    if flag.lower() not in ('true', '1', 'yes', 'on'):
+      await self.app(scope, receive, send)
+      return
+    token = dict(scope['headers']).get(b'x-admin-token')
+    try:
+      require_admin(token.decode('latin-1') if token is not None else None)
+    except HTTPException as error:
+      await JSONResponse({'detail': error.detail}, status_code=error.status_code)(scope, receive, send)
+      return
+
+    sampler = Sampler(self.profiler.interval, threads={threading.get_ident()})
+    profile_id = None
+
+    async def send_profiled(message):
+      nonlocal profile_id
+      if message['type'] == 'http.response.start':
+        sampler.stop()
+        profile_id = self.profiler.store(sampler)
+        message = {**message, 'headers': [*message.get('headers', []),
+                                          (b'x-profile-id', profile_id.encode())]}
+      await send(message)
+
+    context_token = current_sampler.set(sampler)
+    sampler.start()
+    try:
+      await self.app(scope, receive, send_profiled)
+    finally:
+      sampler.stop()
+      current_sampler.reset(context_token)
+      metrics.inc('profiles_total', mode='request')
@@ -0,0 +1,214 @@
+"""
+Precomputed athlete profiles for /athletes
+"""
+
+import threading
+from collections import defaultdict, namedtuple
+
+from sqlmodel import Session, select
+
+from .changes import ATHLETES, generation, repeatable_read
+from .models import AthleteSummer, AthleteWinter, Seasons
+from .services import connect_router
+
+SEASON_MODELS = ((Seasons.SUMMER, AthleteSummer), (Seasons.WINTER, AthleteWinter))
+
+# fields of an entry used by the profiles
+Entry = namedtuple('Entry', ['name', 'team', 'games', 'sport', 'medal'])
+
+
+def season_of(db_athlete):
+  """Season of the table an athlete entry is stored in"""
+  return Seasons.SUMMER if isinstance(db_athlete, AthleteSummer) else Seasons.WINTER
+
+
+class Profile:
+  """Aggregates of one athlete in one season
+
+  Teams, games and sports are kept as value -> number of entries so a removed
+  entry only drops a value once no other entry refers to it.
+  """
+  __slots__ = ('entries', 'medals', 'teams', 'games', 'sports')
+
+  def __init__(self):
+    self.entries = 0
+    self.medals = 0
+    self.teams = {}
+    self.games = {}
+    self.sports = {}
+
+  def update(self, athlete, sign:int):
+    """Add (sign=1) or remove (sign=-1) one entry of the athlete"""
+    self.entries += sign
+    self.medals += sign if athlete.medal else 0
+    for counts, value in ((self.teams, athlete.team), (self.games, athlete.games),
+                          (self.sports, athlete.sport)):
+      counts[value] = counts.get(value, 0) + sign
+      if counts[value] <= 0:
+        del counts[value]
+
+
+class AthleteProfiles:
+  """In-memory index of athlete profiles keyed by athlete name
+
+  The index is built once from the database and kept current with `add` and
+  `remove` by the ChangeFeed of the worker, which applies the logged changes of
+  every worker past `generations`, the generation of each shard the index holds.
+  """
+  def __init__(self):
+    self.ready = False
+    self.generations = None
+    self._profiles = {}
+    self._names = defaultdict(set)
+    self._lock = threading.RLock()
+
+  def build(self, *engines):
+    """Load the profiles of all athletes from the database
+
+    Each shard is read in one transaction with the generation of its athlete
+    tables, so the change feed continues from the state read.
+
+    Args:
+        engines: engines to read the athlete tables from, one per shard, in the order of the shards
+    """
+    profiles = AthleteProfiles()
+    profiles.generations = []
+    for engine in engines:
+      with repeatable_read(Session(engine)) as session:
+        profiles.generations.append(generation(session, ATHLETES))
+        for season, model in SEASON_MODELS:
+          statement = select(model.name, model.team, model.games, model.sport, model.medal)
+          for athlete in session.execute(statement):
+            profiles.add(season, athlete)
+    self.replace(profiles)
+
+  def __len__(self):
+    """Number of athletes"""
+    return len(self._profiles)
+
+  def replace(self, other):
+    """Serve the profiles of another index, e.g. one built in a worker process
+
+    Args:
+        other (AthleteProfiles): index to take the profiles from
+    """
+    with self._lock:
+      self._profiles, self._names = other._profiles, other._names
+      self.generations = None if other.generations is None else list(other.generations)
+      self.ready = True
+
+  def __getstate__(self):
+    with self._lock:
+      return {'ready': self.ready, 'generations': self.generations, '_profiles': self._profiles,
+              '_names': self._names}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.RLock()
+
+  def build_from_snapshot(self, snapshot):
+    """Load the profiles of all athletes from a memory-mapped snapshot
+
+    Every entry is read, the profiles are built in the memory of this worker.
+
+    Args:
+        snapshot (Snapshot): snapshot holding the athlete tables
+    """
+    profiles = AthleteProfiles()
+    if snapshot.cache_generations:
+      profiles.generations = list(snapshot.cache_generations['athletes'])
+    for season, model in SEASON_MODELS:
+      columns = [snapshot.values(model.__tablename__, field) for field in Entry._fields]
+      for athlete in map(Entry._make, zip(*columns)):
+        profiles.add(season, athlete)
+    self.replace(profiles)
+
+  def add(self, season:Seasons, athlete):
+    """Add an entry of an athlete
+
+    Args:
+        season (Seasons): season table of the entry
+        athlete: entry with name, team, games, sport and medal attributes
+    """
+    with self._lock:
+      seasons = self._profiles.setdefault(athlete.name, {})
+      if season not in seasons:
+        seasons[season] = Profile()
+        self._names[athlete.name.lower()].add(athlete.name)
+      seasons[season].update(athlete, 1)
+
+  def remove(self, season:Seasons, athlete):
+    """Remove an entry of an athlete
+
+    Args:
+        season (Seasons): season table of the entry
+        athlete: entry with name, team, games, sport and medal attributes
+    """
+    with self._lock:
+      seasons = self._profiles.get(athlete.name, {})
+      profile = seasons.get(season)
+      if profile is None:
+        return
+      profile.update(athlete, -1)
+      if profile.entries <= 0:
+        del seasons[season]
+      if not seasons:
+        self._profiles.pop(athlete.name, None)
+        self._names[athlete.name.lower()].discard(athlete.name)
+        if not self._names[athlete.name.lower()]:
+          del self._names[athlete.name.lower()]
+
+  def search(self, athlete_name:str, exact:bool = False, season:Seasons = Seasons.UNION):
+    """Profiles of the athletes matching a name, in the order of /athletes
+
+    Args:
+        athlete_name (str): name or part of the name to search
+        exact (bool, optional): match the whole name. Defaults to False.
+        season (Seasons, optional): season to aggregate. Defaults to Seasons.UNION.
+
+    Returns:
+        dict: name -> medal_count, teams, games and sports
+    """
+    query = athlete_name.lower()
+    seasons = [Seasons.SUMMER, Seasons.WINTER] if season == Seasons.UNION else [season]
+    with self._lock:
+      if exact:
+        names = list(self._names.get(query, ()))
+      else:
+        names = [name for lower, group in self._names.items() if query in lower for name in group]
+      matches = []
+      for name in names:
+        profiles = [self._profiles[name][s] for s in seasons if s in self._profiles[name]]
+        if profiles:
+          matches.append((name, profiles))
+
+      result = {}
+      for name, profiles in sorted(matches, key=lambda x: (x[0].lower().find(query), x[0])):
+        result[name] = {
+          'medal_count': sum(p.medals for p in profiles),
+          'teams': sorted({team for p in profiles for team in p.teams}),
+          'games': sorted({games for p in profiles for games in p.games}),
+          'sports': sorted({sport for p in profiles for sport in p.sports}),
+          }
+    return result
+
+
+def load_profiles(filename:str, section:str):
+  """Build profiles with an engine of their own, used by rebuild jobs in worker processes
+
+  Args:
+      filename (str): config file of the database
+      section (str): section of the database in the config file
+
+  Returns:
+      AthleteProfiles: the built index
+  """
+  router = connect_router(filename=filename, section=section)
+  engines = [shard.reader() for shard in router.shards()]
+  try:
+    profiles = AthleteProfiles()
+    profiles.build(*engines)
+    return profiles
+  finally:
+    for engine in engines:
+      engine.dispose()
@@ -0,0 +1,90 @@
+"""
+In-memory region index resolving country names to NOCs
+"""
+
+import threading
+
+from sqlmodel import Session, select
+
+from .changes import REGIONS, generation, repeatable_read
+from .models import Region
+
+
+class RegionIndex:
+  """Index of the regions table by NOC
+
+  The table has a few hundred rows and rarely changes, so /country resolves the
+  country parameter here and queries the athlete tables by NOC without joining
+  regions. The region CRUD endpoints keep the index current, and the ChangeFeed
+  rebuilds it when another worker changed the regions, seen as a `generation` of
+  the table other than the one the index was built at. NOCs are looked up
+  case-insensitively, and resolved to the NOC as stored, which the athlete rows
+  reference.
+  """
+  def __init__(self):
+    self.ready = False
+    self.generation = None
+    self._regions = {}
+    self._lock = threading.Lock()
+
+  def build(self, engine):
+    """Load all regions from the database
+
+    Args:
+        engine: engine to read the regions table from
+    """
+    with repeatable_read(Session(engine)) as session:
+      number = generation(session, REGIONS)
+      regions = {row.noc.upper(): (row.noc, row.region, row.notes)
+                 for row in session.execute(select(Region.noc, Region.region, Region.notes))}
+    with self._lock:
+      self._regions = regions
+      self.generation = number
+      self.ready = True
+
+  def build_from_snapshot(self, snapshot):
+    """Load all regions from a memory-mapped snapshot into the memory of this worker
+
+    Args:
+        snapshot (Snapshot): snapshot holding the regions table
+    """
+    columns = [snapshot.values('regions', name) for name in ('noc', 'region', 'notes')]
+    with self._lock:
+      self._regions = {noc.upper(): (noc, region, notes) for noc, region, notes in zip(*columns)}
+      self.generation = snapshot.cache_generations['regions'] if snapshot.cache_generations else None
+      self.ready = True
+
+  def add(self, region):
+    """Add or replace a region
+
+    Args:
+        region: region with noc, region and notes attributes
+    """
+    with self._lock:
+      self._regions[region.noc.upper()] = (region.noc, region.region, region.notes)
+
+  def remove(self, noc:str):
+    """Remove the region of a NOC"""
+    with self._lock:
+      self._regions.pop(noc.upper(), None)
+
+  def get(self, noc:str):
+    """(region, notes) of a NOC, None if the NOC is unknown"""
+    with self._lock:
+      entry = self._regions.get(noc.upper())
+    return entry[1:] if entry is not None else None
+
+  def resolve(self, country:str, exact:bool = True):
+    """NOCs of the regions matching a country name, case-insensitive
+
+    Args:
+        country (str): region name or part of it
+        exact (bool, optional): match the whole region name. Defaults to True.
+
+    Returns:
+        dict: noc as stored -> (region, notes) of the matching regions
+    """
+    query = country.lower()
+    with self._lock:
+      return {noc: (region, notes) for noc, region, notes in self._regions.values()
+              if region and (region.lower() == query if exact else query in region.lower())}
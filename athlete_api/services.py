@@ -2,9 +2,37 @@
 Engine creation function
 """
 
-from sqlmodel import create_engine
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from http.cookies import SimpleCookie
+from itertools import cycle
+from typing import Dict, List
 
-from .config import config
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import create_engine, text
+
+from .config import config, sections, settings
+from .profiler import tracked
+
+# writes of the client of the current request, None outside of requests
+current_client = ContextVar('current_client', default=None)
+
+
+def database_url(params:dict):
+  """Build a postgresql url from config parameters
+
+  Args:
+      params (dict): parameters read from a database.ini section
+
+  Returns:
+      str: postgresql connection url
+  """
+  return (f"postgresql://{params['user']}:{params['password']}"
+          f"@{params['host']}:{params['port']}"
+          f"/{params['database']}")
 
 
 def connect(filename:str,
@@ -18,13 +46,338 @@ def connect(filename:str,
       echo (bool, optional): echo steps in engine. Defaults to False.
 
   Returns:
-      engine: sqlmodel engine 
+      engine: sqlmodel engine
   """
   params = config(filename=filename, section=section)
-  DATABASE_URL = (f"postgresql://{params['user']}:{params['password']}"
-                  f"@{params['host']}:{params['port']}"
-                  f"/{params['database']}")
+  DATABASE_URL = database_url(params)
   #to stop multiple threads and concurrency lock
   connect_args = {"check_same_thread": False}
   engine = create_engine(DATABASE_URL, echo=echo)
   return engine
+
+
+class ClientWrites:
+  """Time of the last write of one client, carried between its requests by ReadYourWritesMiddleware"""
+  def __init__(self, last_write:float = float('-inf')):
+    self.last_write = last_write
+    self.wrote = False
+
+
+class ReadYourWritesMiddleware:
+  """ASGI middleware telling the routers when the client of a request last wrote
+
+  The time comes from the X-Last-Write header or the last_write cookie, and the
+  response to a request that wrote sets both, so a client reads from the primary
+  shortly after its own writes whichever worker served them. Times are wall clock
+  seconds, the workers of a deployment share a clock.
+
+  Args:
+      app: ASGI application
+  """
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      await self.app(scope, receive, send)
+      return
+    headers = dict(scope['headers'])
+    value = headers.get(b'x-last-write')
+    if value is None and b'cookie' in headers:
+      morsel = SimpleCookie(headers[b'cookie'].decode('latin-1')).get('last_write')
+      value = morsel.value if morsel else None
+    try:
+      client = ClientWrites(float(value))
+    except (TypeError, ValueError):
+      client = ClientWrites()
+
+    async def send_marked(message):
+      if message['type'] == 'http.response.start' and client.wrote:
+        written = f'{client.last_write:.3f}'
+        message = {**message, 'headers': [*message.get('headers', []), (b'x-last-write', written.encode()),
+                                          (b'set-cookie', f'last_write={written}; Path=/'.encode())]}
+      await send(message)
+
+    token = current_client.set(client)
+    try:
+      await self.app(scope, receive, send_marked)
+    finally:
+      current_client.reset(token)
+
+
+class EngineRouter:
+  """Routes reads across replica engines and writes to the primary engine
+
+  Replicas are used round-robin. A background thread, started by the first read,
+  checks the health of the replicas every `health_interval` seconds, and a replica
+  failing a check or a query is skipped until it passes a check again. Reads fall
+  back to the primary when no replica is healthy. For `read_your_writes` seconds
+  after a client wrote, the reads of that client go to the primary so it never
+  misses its own CRUD change because of replication lag; other clients keep
+  reading the replicas.
+
+  Args:
+      primary: engine used for writes and as fallback for reads
+      replicas (List, optional): read-only engines. Defaults to no replicas.
+      health_interval (float, optional): seconds between health checks of a replica. Defaults to 5.
+      read_your_writes (float, optional): seconds reads stay on the primary after a write. Defaults to 0.
+  """
+  def __init__(self, primary, replicas:List = (), health_interval:float = 5.0,
+               read_your_writes:float = 0.0):
+    self.primary = primary
+    self.replicas = list(replicas)
+    self.health_interval = health_interval
+    self.read_your_writes = read_your_writes
+    self._order = cycle(range(len(self.replicas)))
+    self._healthy = [True] * len(self.replicas)
+    self._checker = None
+    self._lock = threading.Lock()
+
+  def writer(self):
+    """Engine for writes, always the primary"""
+    return self.primary
+
+  def reader(self, fresh:bool = False):
+    """Engine for read-only queries
+
+    Args:
+        fresh (bool, optional): force the primary to read the latest writes. Defaults to False.
+
+    Returns:
+        engine: next healthy replica, or the primary
+    """
+    if fresh or not self.replicas:
+      return self.primary
+    client = current_client.get()
+    if client is not None and time.time() - client.last_write < self.read_your_writes:
+      return self.primary
+    if self._checker is None:
+      self._start_checker()
+    for _ in range(len(self.replicas)):
+      with self._lock:
+        index = next(self._order)
+      if self._healthy[index]:
+        return self.replicas[index]
+    return self.primary
+
+  def mark_write(self):
+    """Record a committed write of the client of the current request for read-your-writes routing"""
+    client = current_client.get()
+    if client is not None:
+      client.last_write = time.time()
+      client.wrote = True
+
+  def mark_down(self, engine):
+    """Take a replica out of rotation until it passes a health check
+
+    Args:
+        engine: replica engine that failed a query
+    """
+    for index, replica in enumerate(self.replicas):
+      if replica is engine:
+        self._healthy[index] = False
+
+  def is_healthy(self, index:int):
+    """Health of a replica as last checked"""
+    return self._healthy[index]
+
+  def check(self):
+    """Check the health of every replica with `SELECT 1`"""
+    for index, replica in enumerate(self.replicas):
+      try:
+        with replica.connect() as connection:
+          connection.execute(text("SELECT 1"))
+        self._healthy[index] = True
+      except SQLAlchemyError:
+        self._healthy[index] = False
+
+  def _start_checker(self):
+    with self._lock:
+      if self._checker is not None:
+        return
+      self._checker = threading.Thread(target=self._run_checks, name='replica-health', daemon=True)
+    self._checker.start()
+
+  def _run_checks(self):
+    while True:
+      self.check()
+      time.sleep(self.health_interval)
+
+  def status(self):
+    """Health of every replica as last checked"""
+    return [{'replica': index, 'healthy': healthy}
+            for index, healthy in enumerate(self._healthy)]
+
+  # an unsharded database is its own single shard, see ShardRouter
+  def shard(self, noc:str):
+    """Router of the shard owning a NOC"""
+    return self
+
+  def shards(self, nocs=None):
+    """Routers of the shards owning some NOCs, all shards when `nocs` is None"""
+    return [self]
+
+  def owners(self, athlete_id:int):
+    """Routers of the shards that may hold an athlete id, most likely first"""
+    return [self]
+
+  def scatter(self, fn, routers:List):
+    """Call `fn` with every router and return the results in order"""
+    return [fn(router) for router in routers]
+
+  def prepare_sequences(self, sequence:str = 'athletes_id_seq'):
+    """Make the id sequences of the shards disjoint, nothing to do without shards"""
+
+
+class ShardRouter:
+  """Routes athlete rows to shards by NOC, the home router keeps everything else
+
+  Every shard is an EngineRouter with its own primary and replicas. A NOC belongs to
+  the shard named in the shard map, other NOCs are placed by a CRC32 hash so every
+  node agrees on the owner without a lookup. Shards keep a copy of the regions for
+  their foreign keys. Queries over several shards are scattered in parallel and
+  their rows gathered by the caller. Shard sequences step by the number of shards
+  from disjoint offsets, so ids stay unique across shards and new ids point to
+  their shard.
+
+  Args:
+      home: EngineRouter of the regions and the other unsharded tables
+      shards (Dict): shard name -> EngineRouter, in a fixed order
+      shard_map (Dict, optional): NOC -> shard name of the pinned NOCs. Defaults to none.
+      workers (int, optional): concurrent shard queries of a scatter. Defaults to 8.
+  """
+  def __init__(self, home, shards:Dict, shard_map:Dict = None, workers:int = 8):
+    self.home = home
+    self.names = list(shards)
+    self.routers = dict(shards)
+    self.shard_map = {noc.upper(): name for noc, name in (shard_map or {}).items()}
+    unknown = set(self.shard_map.values()) - set(self.names)
+    if unknown:
+      raise ValueError(f"Unknown shards in the shard map: {', '.join(sorted(unknown))}")
+    self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard')
+
+  @property
+  def primary(self):
+    return self.home.primary
+
+  @property
+  def replicas(self):
+    return self.home.replicas
+
+  def writer(self):
+    """Engine for writes of the unsharded tables"""
+    return self.home.writer()
+
+  def reader(self, fresh:bool = False):
+    """Engine for reads of the unsharded tables"""
+    return self.home.reader(fresh)
+
+  def mark_write(self):
+    """Record a committed write of the client of the current request, for the reads of every node"""
+    self.home.mark_write()
+
+  def mark_down(self, engine):
+    """Take a replica of any node out of rotation until its next health check"""
+    for router in (self.home, *self.routers.values()):
+      router.mark_down(engine)
+
+  def status(self):
+    """Health of the replicas of the home and of every shard"""
+    return {'home': self.home.status(),
+            **{name: router.status() for name, router in self.routers.items()}}
+
+  def shard(self, noc:str):
+    """Router of the shard owning a NOC"""
+    noc = (noc or '').upper()
+    name = self.shard_map.get(noc)
+    if name is None:
+      name = self.names[zlib.crc32(noc.encode()) % len(self.names)]
+    return self.routers[name]
+
+  def shards(self, nocs=None):
+    """Routers of the shards owning some NOCs, all shards when `nocs` is None"""
+    if nocs is None:
+      return list(self.routers.values())
+    return list({id(router): router for router in map(self.shard, nocs)}.values())
+
+  def owners(self, athlete_id:int):
+    """Routers of the shards that may hold an athlete id, most likely first
+
+    Ids given after prepare_sequences point to their shard, ids loaded before
+    sharding can be on any shard.
+    """
+    routers = list(self.routers.values())
+    first = (athlete_id - 1) % len(routers)
+    return routers[first:] + routers[:first]
+
+  def scatter(self, fn, routers:List):
+    """Call `fn` with every router in parallel and return the results in order
+
+    Calls run in the context of the caller, e.g. with its request cancel scope, and
+    are sampled with the request when it is profiled.
+    """
+    if len(routers) == 1:
+      return [fn(routers[0])]
+    futures = [self._pool.submit(copy_context().run, tracked(fn), router) for router in routers]
+    return [future.result() for future in futures]
+
+  def prepare_sequences(self, sequence:str = 'athletes_id_seq'):
+    """Step the id sequence of shard i by the number of shards from an offset i + 1
+
+    The sequences restart above the largest id given on any shard, run it before
+    loading the shards so their rows get disjoint ids. Missing sequences are
+    created, shards whose sequence already steps by the number of shards are left alone.
+    """
+    count = len(self.names)
+    states = []
+    for router in self.routers.values():
+      with router.writer().begin() as connection:
+        connection.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {sequence}"))
+        states.append(connection.execute(text(
+          "SELECT coalesce(last_value, 0), increment_by FROM pg_sequences WHERE sequencename = :name"),
+          {'name': sequence}).one())
+    if all(increment == count for _, increment in states):
+      return
+    base = (max(last for last, _ in states) // count + 1) * count
+    for index, router in enumerate(self.routers.values()):
+      with router.writer().begin() as connection:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {count} "
+                                f"RESTART WITH {base + index + 1}"))
+
+
+def connect_router(filename:str,
+                   section:str,
+                   echo:bool = False):
+  """Connect to the primary and replica databases, and to the shards if any
+
+  Replicas are the sections named `<section>_replica...` in the config file,
+  e.g. `[postgresql_replica_1]`, with the same keys as the primary section.
+  Routing options are read from an optional `[<section>_routing]` section.
+  Shards are the sections listed in `shards` of an optional `[<section>_sharding]`
+  section, each connected like the primary with its own replicas. NOCs pinned to
+  a shard are listed in an optional `[<section>_shard_map]` section as NOC=shard.
+
+  Args:
+      filename (str): filename of database.ini config to look for
+      section (str): section of the primary in .ini file
+      echo (bool, optional): echo steps in engines. Defaults to False.
+
+  Returns:
+      EngineRouter: router over the primary and replica engines, ShardRouter with shards
+  """
+  options = settings(filename=filename, section=f'{section}_routing',
+                     defaults={'health_interval': 5.0, 'read_your_writes': 2.0})
+  primary = connect(filename=filename, section=section, echo=echo)
+  replicas = [connect(filename=filename, section=name, echo=echo)
+              for name in sections(filename=filename, prefix=f'{section}_replica')]
+  home = EngineRouter(primary, replicas, **options)
+  sharding = settings(filename=filename, section=f'{section}_sharding',
+                      defaults={'shards': '', 'workers': 8})
+  names = [name.strip() for name in sharding['shards'].split(',') if name.strip()]
+  if not names:
+    return home
+  shards = {name: home if name == section else connect_router(filename=filename, section=name, echo=echo)
+            for name in names}
+  shard_map = (config(filename=filename, section=f'{section}_shard_map')
+               if sections(filename=filename, prefix=f'{section}_shard_map') else {})
+  return ShardRouter(home, shards, shard_map, workers=sharding['workers'])
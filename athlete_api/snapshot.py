@@ -0,0 +1,382 @@
+"""
+Memory-mapped binary snapshot of the athlete and region tables
+
+A snapshot is a column-oriented file written from the database. String columns are
+dictionary encoded (uint32 codes into a per-column string dictionary), integer
+columns are int32 and float columns float64. A JSON header describing the blocks
+and its length close the file. Workers map the file read-only and decode the
+columns from the mapped pages while they are read.
+
+A snapshot only makes startup faster: a worker builds its profiles, regions and
+cardinality estimates from the file instead of querying the database. It still
+reads every row, and the indexes it builds are Python objects private to the
+worker, so the memory of a host still grows with its number of workers. Only the
+mapped file itself is shared through the OS page cache. Serving the lookups from
+the mapped columns would share that memory, but the change feed updates the
+indexes in place and read-only columns would need a layer of changes on top.
+
+Snapshots are versioned by a generation number. `snapshot.<generation>.bin` files
+live in one directory next to a `CURRENT` file naming the generation to serve, which
+is swapped atomically once a new snapshot is complete. The header records the
+cache generations of the tables it was read at, so workers apply the changes
+logged since, and a SnapshotRefresher writes a new snapshot some time after the
+tables changed.
+
+Usage:
+    python -m athlete_api.snapshot write <directory>
+"""
+
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from sqlmodel import Session, select
+
+from .changes import ATHLETES, REGIONS, generation as cache_generation, repeatable_read
+from .metrics import metrics
+from .models import AthleteSummer, AthleteWinter, Region
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ATHSNAP1'
+NULL_CODE = 0xFFFFFFFF
+TABLES = {'athletes_summer': AthleteSummer, 'athletes_winter': AthleteWinter, 'regions': Region}
+# tables spread over the shards, the others are read from the home database
+ATHLETE_TABLES = ('athletes_summer', 'athletes_winter')
+TYPECODES = {'str': 'I', 'int': 'i', 'float': 'd'}
+
+
+def column_type(model, name:str):
+  """Snapshot type of a model column: 'str', 'int' or 'float'"""
+  python_type = model.__fields__[name].type_
+  if python_type is float:
+    return 'float'
+  if python_type is int:
+    return 'int'
+  return 'str'
+
+
+class StringDictionary:
+  """Read-only view of a string dictionary stored in the snapshot
+
+  Args:
+      buffer: memoryview of the mapped file
+      offset (int): start of the dictionary block
+      count (int): number of strings
+  """
+  def __init__(self, buffer, offset:int, count:int):
+    self._offsets = buffer[offset:offset + 4 * (count + 1)].cast('I')
+    self._blob = buffer[offset + 4 * (count + 1):]
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, code:int):
+    if code == NULL_CODE:
+      return None
+    return str(self._blob[self._offsets[code]:self._offsets[code + 1]], 'utf-8')
+
+
+class ColumnValues:
+  """Values of a snapshot column, decoded from the mapped file as they are read
+
+  Args:
+      data: memoryview of the raw column
+      kind (str): 'str', 'int' or 'float'
+      dictionary (StringDictionary, optional): dictionary of a string column
+  """
+  def __init__(self, data, kind:str, dictionary:StringDictionary = None):
+    self._data = data
+    self._kind = kind
+    self._dictionary = dictionary
+
+  def __len__(self):
+    return len(self._data)
+
+  def __getitem__(self, index:int):
+    value = self._data[index]
+    if self._kind == 'str':
+      return self._dictionary[value]
+    if self._kind == 'float' and math.isnan(value):
+      return None
+    return value
+
+  def __iter__(self):
+    if self._kind == 'int':
+      yield from self._data
+    elif self._kind == 'float':
+      for value in self._data:
+        yield None if math.isnan(value) else value
+    else:
+      # strings repeated in the column are decoded once per pass
+      decoded = {}
+      for code in self._data:
+        value = decoded.get(code)
+        if value is None and code != NULL_CODE:
+          value = decoded[code] = self._dictionary[code]
+        yield value
+
+
+class Snapshot:
+  """Read-only memory map of one snapshot file
+
+  Args:
+      path (str): snapshot file to map
+  """
+  def __init__(self, path:str):
+    self.path = path
+    with open(path, 'rb') as file:
+      self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    self._buffer = memoryview(self._mmap)
+    if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+      raise ValueError(f'{path} is not an athlete snapshot')
+    header_length, = struct.unpack_from('<Q', self._buffer, len(self._buffer) - 8)
+    self.header = json.loads(bytes(self._buffer[-8 - header_length:-8]))
+    self.generation = self.header['generation']
+
+  @property
+  def cache_generations(self):
+    """Cache generations of the tables the snapshot was read at, None for older snapshots"""
+    return self.header.get('cache_generations')
+
+  def rows(self, table:str):
+    """Number of rows of a table"""
+    return self.header['tables'][table]['rows']
+
+  def column(self, table:str, name:str):
+    """Raw column values: uint32 dictionary codes for strings, int32 or float64 values otherwise"""
+    meta = self.header['tables'][table]['columns'][name]
+    return self._buffer[meta['offset']:meta['offset'] + meta['length']].cast(TYPECODES[meta['type']])
+
+  def dictionary(self, table:str, name:str):
+    """String dictionary of a string column"""
+    meta = self.header['tables'][table]['columns'][name]
+    return StringDictionary(self._buffer, meta['dict_offset'], meta['dict_count'])
+
+  def values(self, table:str, name:str):
+    """Values of a column decoded while they are read, None for nulls"""
+    meta = self.header['tables'][table]['columns'][name]
+    dictionary = self.dictionary(table, name) if meta['type'] == 'str' else None
+    return ColumnValues(self.column(table, name), meta['type'], dictionary)
+
+
+def _columns(model):
+  return [getattr(model, name) for name in model.__fields__]
+
+
+def _encode(values:list, kind:str):
+  """Encode column values as (data bytes, dictionary bytes, dictionary size)"""
+  if kind == 'int':
+    return array('i', [0 if value is None else value for value in values]).tobytes(), b'', 0
+  if kind == 'float':
+    return array('d', [math.nan if value is None else value for value in values]).tobytes(), b'', 0
+  codes = {}
+  data = array('I', [NULL_CODE if value is None else codes.setdefault(value, len(codes))
+                     for value in values])
+  encoded = [value.encode() for value in codes]
+  offsets = array('I', [0])
+  for item in encoded:
+    offsets.append(offsets[-1] + len(item))
+  return data.tobytes(), offsets.tobytes() + b''.join(encoded), len(encoded)
+
+
+def _pad(length:int):
+  return b'\0' * (-length % 8)
+
+
+def current_generation(directory:str):
+  """Generation named by the CURRENT file of a snapshot directory, 0 if none"""
+  try:
+    with open(os.path.join(directory, 'CURRENT'), encoding='utf-8') as file:
+      return int(file.read().strip())
+  except FileNotFoundError:
+    return 0
+
+
+def snapshot_path(directory:str, generation:int):
+  """Path of the snapshot file of a generation"""
+  return os.path.join(directory, f'snapshot.{generation}.bin')
+
+
+def write_snapshot(router, directory:str, keep:int = 2):
+  """Write a new snapshot generation from the database and make it current
+
+  The athlete tables are gathered from every shard, each read in one transaction
+  with its cache generation, the regions from the home database.
+
+  Args:
+      router: EngineRouter or ShardRouter of the databases to read
+      directory (str): snapshot directory
+      keep (int, optional): generations kept on disk, older ones are removed. Defaults to 2.
+
+  Returns:
+      str: path of the new snapshot
+  """
+  os.makedirs(directory, exist_ok=True)
+  generation = current_generation(directory) + 1
+  rows = {table: [] for table in TABLES}
+  cache_generations = {'athletes': [], 'regions': 0}
+  for shard in router.shards():
+    with repeatable_read(Session(shard.reader())) as session:
+      cache_generations['athletes'].append(cache_generation(session, ATHLETES))
+      for table in ATHLETE_TABLES:
+        rows[table] += session.execute(select(*_columns(TABLES[table]))).all()
+  with repeatable_read(Session(router.reader())) as session:
+    cache_generations['regions'] = cache_generation(session, REGIONS)
+    rows['regions'] = session.execute(select(*_columns(Region))).all()
+
+  blocks, tables = [], {}
+  for table, model in TABLES.items():
+    columns = {}
+    for index, name in enumerate(model.__fields__):
+      kind = column_type(model, name)
+      data, dictionary, count = _encode([row[index] for row in rows[table]], kind)
+      columns[name] = {'type': kind, 'length': len(data), 'dict_count': count}
+      blocks.append((columns[name], data, dictionary))
+    tables[table] = {'rows': len(rows[table]), 'columns': columns}
+
+  header = {'generation': generation, 'created': time.time(), 'cache_generations': cache_generations,
+            'tables': tables}
+  path = snapshot_path(directory, generation)
+  with open(path + '.tmp', 'wb') as file:
+    file.write(MAGIC)
+    position = len(MAGIC)
+    for meta, data, dictionary in blocks:
+      meta['offset'] = position
+      meta['dict_offset'] = position + len(data) + len(_pad(len(data)))
+      file.write(data + _pad(len(data)) + dictionary + _pad(len(dictionary)))
+      position = meta['dict_offset'] + len(dictionary) + len(_pad(len(dictionary)))
+    header_bytes = json.dumps(header).encode()
+    file.write(header_bytes + struct.pack('<Q', len(header_bytes)))
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(path + '.tmp', path)
+  with open(os.path.join(directory, 'CURRENT.tmp'), 'w', encoding='utf-8') as file:
+    file.write(str(generation))
+  os.replace(os.path.join(directory, 'CURRENT.tmp'), os.path.join(directory, 'CURRENT'))
+
+  for old in range(generation - keep, 0, -1):
+    if not os.path.exists(snapshot_path(directory, old)):
+      break
+    os.remove(snapshot_path(directory, old))
+  return path
+
+
+class SnapshotRefresher:
+  """Writes a new snapshot `delay` seconds after the tables changed
+
+  Writers call `changed` once their changes are applied, the first call starts a
+  timer so a burst of changes is written once. Workers of a host share the
+  directory: the snapshot is written under an exclusive lock of the directory and
+  skipped when the current snapshot already holds the changes, so every change is
+  written by one worker.
+
+  Args:
+      directory (str): snapshot directory
+      write: function writing a snapshot into the directory
+      current: function returning the cache generations of the tables in the database
+      delay (float, optional): seconds between a change and the new snapshot. Defaults to 300.
+  """
+  def __init__(self, directory:str, write, current, delay:float = 300.0):
+    self.directory = directory
+    self.write = write
+    self.current = current
+    self.delay = delay
+    self._timer = None
+    self._lock = threading.Lock()
+
+  def changed(self):
+    """Schedule a new snapshot, unless one is already scheduled"""
+    with self._lock:
+      if self._timer is not None:
+        return
+      self._timer = threading.Timer(self.delay, self.refresh)
+      self._timer.daemon = True
+      self._timer.start()
+
+  def refresh(self):
+    """Write a new snapshot if the current one misses changes and no other worker is writing one
+
+    Returns:
+        str: path of the new snapshot, None if none was written
+    """
+    with self._lock:
+      self._timer = None
+    os.makedirs(self.directory, exist_ok=True)
+    with open(os.path.join(self.directory, 'LOCK'), 'w', encoding='utf-8') as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return None
+      try:
+        generation = current_generation(self.directory)
+        if generation and Snapshot(snapshot_path(self.directory, generation)).cache_generations == self.current():
+          return None
+        path = self.write(self.directory)
+        metrics.inc('snapshot_refreshes_total')
+        logger.info("Wrote snapshot", extra={'path': path})
+        return path
+      except Exception:
+        logger.exception("Writing the snapshot failed")
+        return None
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class SnapshotStore:
+  """Current snapshot of a directory, remapped when a new generation is made current
+
+  Args:
+      directory (str): snapshot directory
+  """
+  def __init__(self, directory:str):
+    self.directory = directory
+    self._snapshot = None
+    self._lock = threading.Lock()
+
+  def available(self):
+    """True if the directory holds a current snapshot"""
+    return current_generation(self.directory) > 0
+
+  def current(self):
+    """Snapshot of the current generation, mapping it on first use or after a swap"""
+    generation = current_generation(self.directory)
+    with self._lock:
+      if self._snapshot is None or self._snapshot.generation != generation:
+        self._snapshot = Snapshot(snapshot_path(self.directory, generation))
+      return self._snapshot
+
+  def watch(self, callback, interval:float):
+    """Call `callback(snapshot)` from a daemon thread whenever the generation changes
+
+    Args:
+        callback: function receiving the new Snapshot
+        interval (float): seconds between checks of the CURRENT file
+    """
+    def run():
+      generation = current_generation(self.directory)
+      while True:
+        time.sleep(interval)
+        if current_generation(self.directory) != generation:
+          snapshot = self.current()
+          generation = snapshot.generation
+          logger.info("Loading snapshot", extra={'generation': generation})
+          callback(snapshot)
+    threading.Thread(target=run, name='snapshot-watch', daemon=True).start()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3 or sys.argv[1] != 'write':
+    sys.exit('Usage: python -m athlete_api.snapshot write <directory>')
+  from .services import connect_router
+  print(write_snapshot(connect_router(filename=os.getenv('FILE_NAME', './athlete_api/database.ini'),
+                                      section=os.getenv('SECTION_NAME', 'postgresql')), sys.argv[2]))
@@ -0,0 +1,160 @@
+"""
+Statement timeouts and query cancellation on client disconnect
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+from psycopg2.errors import QueryCanceled
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, text
+
+from .metrics import metrics
+
+# options of the [timeouts] section in database.ini, statement timeouts in milliseconds
+TIMEOUT_DEFAULTS = {'country': 5000, 'noc': 5000, 'athletes': 5000, 'compare': 5000,
+                    'stats': 5000, 'timeseries': 5000, 'detail': 30000, 'export': 600000}
+
+current_scope = ContextVar('current_scope', default=None)
+
+
+class CancelScope:
+  """Database connections working for one request, cancelled when its client disconnects
+
+  Scopes of requests sharing one coalesced execution form a group, and the running
+  query is only cancelled once every client of the group has disconnected.
+  """
+  def __init__(self):
+    self.cancelled = False
+    self.group = [self]
+    self._connections = []
+    self._lock = threading.Lock()
+
+  def join(self, leader):
+    """Share the execution of another scope, e.g. as a follower of a coalesced call"""
+    with leader._lock:
+      leader.group.append(self)
+      self.group = leader.group
+
+  def attach(self, dbapi_connection):
+    """Register a connection running a query for this scope"""
+    with self._lock:
+      self._connections.append(dbapi_connection)
+
+  def detach(self, dbapi_connection):
+    """Unregister a connection once its query is done"""
+    with self._lock:
+      self._connections.remove(dbapi_connection)
+
+  def cancel(self):
+    """Mark the client gone and cancel the running queries if the whole group is gone"""
+    self.cancelled = True
+    if not all(scope.cancelled for scope in self.group):
+      return
+    for scope in self.group:
+      with scope._lock:
+        for connection in scope._connections:
+          connection.cancel()
+
+
+class DisconnectMiddleware:
+  """ASGI middleware giving every HTTP request a CancelScope
+
+  The middleware reads the ASGI receive channel on behalf of the application and
+  cancels the scope as soon as the client disconnects.
+
+  Args:
+      app: ASGI application
+  """
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      await self.app(scope, receive, send)
+      return
+
+    cancel_scope = CancelScope()
+    token = current_scope.set(cancel_scope)
+    messages = asyncio.Queue()
+
+    async def watch():
+      while True:
+        message = await receive()
+        await messages.put(message)
+        if message['type'] == 'http.disconnect':
+          cancel_scope.cancel()
+          return
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+      await self.app(scope, messages.get, send)
+    finally:
+      watcher.cancel()
+      current_scope.reset(token)
+
+
+def _open_session(engine, timeout:int):
+  session = Session(engine)
+  try:
+    session.execute(text(f"SET LOCAL statement_timeout = {int(timeout)}"))
+  except Exception:
+    session.close()
+    raise
+  return session
+
+
+@contextmanager
+def query_session(router, endpoint:str, timeout:int):
+  """Session for read-only queries on a reader of a router, with a statement timeout and cancellation
+
+  The timeout is set with SET LOCAL, so it applies to the transaction of this
+  session only. The connection is registered with the CancelScope of the request.
+  A replica failing to connect is marked down and the session opened on the
+  primary instead. A replica losing its connection during the query is marked
+  down and the request answered with 503, its retry reads from another node.
+
+  Args:
+      router: EngineRouter of the node to query
+      endpoint (str): endpoint name used to label the metrics
+      timeout (int): statement timeout in milliseconds, 0 to disable
+
+  Returns:
+      Session: session inside an open transaction
+  """
+  cancel_scope = current_scope.get()
+  engine = router.reader()
+  try:
+    session = _open_session(engine, timeout)
+  except OperationalError:
+    if engine is router.writer():
+      raise
+    router.mark_down(engine)
+    metrics.inc('replica_failures_total', endpoint=endpoint)
+    engine = router.writer()
+    session = _open_session(engine, timeout)
+  with session:
+    dbapi_connection = session.connection().connection.dbapi_connection
+    if cancel_scope:
+      cancel_scope.attach(dbapi_connection)
+    try:
+      yield session
+    except OperationalError as error:
+      if error.connection_invalidated and engine is not router.writer():
+        router.mark_down(engine)
+        metrics.inc('replica_failures_total', endpoint=endpoint)
+        raise HTTPException(status_code=503, detail="Replica lost during the query, retry",
+                            headers={"Retry-After": "1"}) from error
+      if not isinstance(error.orig, QueryCanceled):
+        raise
+      if cancel_scope and cancel_scope.cancelled:
+        metrics.inc('query_cancelled_total', endpoint=endpoint)
+        raise HTTPException(status_code=499, detail="Client disconnected") from error
+      metrics.inc('query_timeout_total', endpoint=endpoint)
+      raise HTTPException(status_code=504, detail=f"Query exceeded {timeout} ms") from error
+    finally:
+      if cancel_scope:
+        cancel_scope.detach(dbapi_connection)
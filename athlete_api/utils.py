@@ -2,11 +2,20 @@
 Helper functions
 """
 
+import logging
+import threading
+import time
 from typing import List
 
-from sqlmodel import column, func
+from sqlalchemy import bindparam
+from sqlmodel import column, func, select, union_all
 from sqlmodel.sql.expression import Select
 
+from .metrics import metrics
+from .models import Seasons
+
+logger = logging.getLogger(__name__)
+
 
 def verify_params(noc: str, sport: str, start_date: int,  end_date: int):
     """
@@ -35,86 +44,222 @@ def verify_params(noc: str, sport: str, start_date: int,  end_date: int):
         raise ValueError("Start date should be less than end date")
     return True
 
-def add_where(statement:Select, clauses:List):
+def add_where(statement:Select, clauses:List, bind:bool = False):
     """
      Add where clauses to select statement. This is a helper function to make it easier to add clauses to select statements
      
      Args:
      	 statement: select statement to add clauses to
      	 clauses: list of tuples ( attr value relation )
+     	 bind: use named bind parameters instead of the values so the statement can be cached
+     	       and reused with clause_params
      
      Returns: 
      	 statement with clauses added to it 
+
+     Raises:
+     	 ValueError: the relation is not supported for the type of the value, a clause is never
+     	             dropped silently as the statement would then select more rows
     """
     for (attr, value, relation) in clauses:
-        print(attr, value, relation)
+        logger.debug("Where clause", extra={'attr': attr, 'value': value, 'relation': relation})
         #add assertion
         # attr:str, value:str|int|float, relation:str = 'equal'):
 
         # Skips if the relation is non_null and value is None.
         if relation!='non_null' and not value:
             continue
+        operand = value.lower() if isinstance(value, str) else value
+        if bind:
+            operand = bindparam(param_name(attr, relation), expanding=isinstance(value, (list, tuple)))
 
         # Returns a SQL statement to select a relation
         # This if else ladder is used to build the SQL statement for the relation.
         if isinstance(value, str):
             if relation=='equal':
-                statement = statement.where(func.lower(column(attr))==value.lower())
+                statement = statement.where(func.lower(column(attr))==operand)
             elif relation=='contain':
-                statement = statement.where(func.lower(column(attr)).contains(value.lower()))
+                statement = statement.where(func.lower(column(attr)).contains(operand))
             elif relation=='non_null':
                 statement = statement.where(func.lower(column(attr)) is not None)
+            else:
+                raise ValueError(f"Relation {relation} is not supported for the text value of {attr}")
         elif isinstance(value, (int, float)):
             if relation=='equal':
-                statement = statement.where(column(attr)==value)
+                statement = statement.where(column(attr)==operand)
             elif relation=='unequal':
-                statement = statement.where(column(attr)!=value)
+                statement = statement.where(column(attr)!=operand)
             elif relation=='non_null':
                 statement = statement.where(column(attr) is not None)
             elif relation=='gt':
-                statement = statement.where(column(attr)>value)
+                statement = statement.where(column(attr)>operand)
             elif relation=='gte':
-                statement = statement.where(column(attr)>=value)
+                statement = statement.where(column(attr)>=operand)
             elif relation=='lt':
-                statement = statement.where(column(attr)<value)
+                statement = statement.where(column(attr)<operand)
             elif relation=='lte':
-                statement = statement.where(column(attr)<=value)
+                statement = statement.where(column(attr)<=operand)
+            else:
+                raise ValueError(f"Relation {relation} is not supported for the numeric value of {attr}")
         elif isinstance(value, bool):
             if relation=='equal':
-                statement = statement.where(column(attr)==value)
+                statement = statement.where(column(attr)==operand)
             elif relation=='unequal':
-                statement = statement.where(column(attr)!=value)
+                statement = statement.where(column(attr)!=operand)
             elif relation=='non_null':
                 statement = statement.where(column(attr) is not None)
+        elif isinstance(value, (list, tuple)):
+            if relation=='in':
+                statement = statement.where(column(attr).in_(operand))
+            else:
+                raise ValueError(f"Relation {relation} is not supported for the list value of {attr}")
+        else:
+            raise ValueError(f"Relation {relation} is not supported for the value of {attr}")
 
     return statement
 
-#TODO better looks as class
-# class Statement(Select):
-#     def __init__(self) -> None:
-#         super().__init__()
-
-#     def add_where(self, attr:str, value:str|int|float, relation:str = 'equal'):
-#         if not value:
-#             return self
-
-#         if isinstance(value, str):
-#             if relation=='equal':
-#                 self = self.where(func.lower(text(attr)) == value.lower())
-#                 self.
-#             elif relation=='contain':
-#                 self = self.where(func.lower(text(attr)).contains(value.lower()))
-#         elif isinstance(value, (int, float)):
-#             if relation=='equal':
-#                 self = self.where(text(attr)==value)
-#             elif relation=='unequal':
-#                 self = self.where(text(attr)!=value)
-#             elif relation=='gt':
-#                 self = self.where(text(attr)>value)
-#             elif relation=='gte':
-#                 self = self.where(text(attr)>=value)
-#             elif relation=='lt':
-#                 self = self.where(text(attr)<value)
-#             elif relation=='lte':
-#                 self = self.where(text(attr)<=value)
-    
+def param_name(attr:str, relation:str):
+    """
+     Name of the bind parameter of a clause in statements built with add_where(bind=True)
+    """
+    return f'{attr}_{relation}'
+
+def clause_shape(clauses:List):
+    """
+     Shape of a clause list: which clauses are present and the kind of their values. Statements
+     built with add_where(bind=True) from clause lists of the same shape are identical.
+
+     Args:
+     	 clauses: list of tuples ( attr value relation )
+
+     Returns:
+     	 tuple of ( attr relation kind ) for the clauses add_where does not skip
+    """
+    return tuple((attr, relation, type(value).__name__) for (attr, value, relation) in clauses
+                 if relation=='non_null' or value)
+
+def clause_params(clauses:List):
+    """
+     Bind parameter values of a clause list for a statement built with add_where(bind=True)
+
+     Args:
+     	 clauses: list of tuples ( attr value relation )
+
+     Returns:
+     	 dict of parameter name to value, strings lower-cased as add_where compares them
+    """
+    return {param_name(attr, relation): value.lower() if isinstance(value, str) else value
+            for (attr, value, relation) in clauses if relation!='non_null' and value}
+
+def parse_fields(fields:str, allowed):
+    """
+     Parse the fields parameter of the query endpoints, a comma separated list of column names
+
+     Args:
+     	 fields: comma separated field names e.g. 'name,year,event,medal', None for all fields
+     	 allowed: field names that may be requested
+
+     Returns:
+     	 tuple of requested field names in request order, None if fields is empty
+    """
+    if not fields:
+        return None
+    names = tuple(dict.fromkeys(name.strip().lower() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    return names or None
+
+def project(rows, fields):
+    """
+     Restrict entries to the requested fields
+
+     Args:
+     	 rows: result rows or dicts
+     	 fields: field names to keep, None to keep the entries unchanged
+
+     Returns:
+     	 list of dicts with the requested fields, or rows if fields is None
+    """
+    if fields is None:
+        return rows
+    return [{field: row[field] for field in fields}
+            for row in (getattr(row, '_mapping', row) for row in rows)]
+
+def select_columns(model, names, *extra):
+    """
+     Select only the named columns of a model instead of whole entities. Rows come back as
+     lightweight tuples sharing one column index rather than ORM objects.
+
+     Args:
+     	 model: table model to select from
+     	 names: column names of the model
+     	 extra: further columns or expressions to select
+
+     Returns:
+     	 select statement
+    """
+    return select(*[getattr(model, name) for name in names], *extra)
+
+def season_statement(season:Seasons, statement_1:Select, statement_2:Select):
+    """
+     Combine the summer and winter statements for a season. Ids of both tables come from one
+     sequence, so the union never has duplicates and UNION ALL skips the deduplication.
+
+     Args:
+     	 season: season to query
+     	 statement_1: statement on the summer table
+     	 statement_2: statement on the winter table
+
+     Returns:
+     	 statement for the season
+    """
+    if season == Seasons.SUMMER:
+        return statement_1
+    if season == Seasons.WINTER:
+        return statement_2
+    return union_all(statement_1, statement_2)
+
+class StatementCache:
+    """
+     Cache of statements built with add_where(bind=True), keyed by query shape. Query shapes
+     form a small set (endpoint x present filters x season x detail), so after warm-up every
+     request reuses a built statement and only binds its parameter values. A hit saves the
+     Python construction of the statement, counted in statement_construction_seconds_saved_total.
+     Compiling is not saved: SQLAlchemy's compiled cache reuses the SQL string of a shape with
+     or without this cache, and Postgres plans every execution since psycopg2 does not prepare
+     statements.
+
+     Args:
+     	 name: name used to label the metrics of this cache
+    """
+    def __init__(self, name:str):
+        self.name = name
+        self._statements = {}
+        self._build_time = {}
+        self._lock = threading.Lock()
+
+    def get(self, shape, build):
+        """
+         Statement for a shape, built with build() on the first request of the shape
+
+         Args:
+         	 shape: hashable query shape, e.g. including clause_shape(clauses)
+         	 build: function without arguments building the statement
+
+         Returns:
+         	 cached statement
+        """
+        statement = self._statements.get(shape)
+        if statement is not None:
+            metrics.inc('statement_cache_hits_total', cache=self.name)
+            metrics.inc('statement_construction_seconds_saved_total', self._build_time[shape],
+                        cache=self.name)
+            return statement
+        start = time.perf_counter()
+        statement = build()
+        with self._lock:
+            self._build_time[shape] = time.perf_counter() - start
+            self._statements[shape] = statement
+        metrics.inc('statement_cache_misses_total', cache=self.name)
+        return statement
@@ -0,0 +1,257 @@
+"""
+Cache warm-up from recorded traffic
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from enum import Enum
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# options of the [warmup] section in database.ini
+WARMUP_DEFAULTS = {'enabled': True, 'path': 'warmup.json', 'capacity': 500, 'replay': 100,
+                   'deadline': 120.0, 'save_interval': 60.0}
+
+
+class TopK:
+  """Bounded log of the most frequent keys, with the Space-Saving algorithm
+
+  At most `capacity` keys are counted. A new key replaces the least counted one
+  and inherits its count as overestimation, so frequent keys stay in the log
+  whatever the order of the traffic and the memory stays bounded.
+
+  Args:
+      capacity (int): number of counted keys
+  """
+  def __init__(self, capacity:int):
+    self.capacity = capacity
+    self._counts = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._counts)
+
+  def record(self, key, count:int = 1):
+    """Count an occurrence of a key"""
+    with self._lock:
+      if key in self._counts or len(self._counts) < self.capacity:
+        self._counts[key] = self._counts.get(key, 0) + count
+        return
+      smallest = min(self._counts, key=self._counts.get)
+      self._counts[key] = self._counts.pop(smallest) + count
+
+  def top(self, n:int = None):
+    """Keys with their counts, most frequent first
+
+    Args:
+        n (int, optional): number of keys. Defaults to all.
+
+    Returns:
+        list: (key, count) pairs
+    """
+    with self._lock:
+      ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+    return ranked[:n]
+
+  def total(self):
+    """Sum of the counts of the logged keys"""
+    with self._lock:
+      return sum(self._counts.values())
+
+
+class WarmUp:
+  """Records the normalized parameters of read requests and replays the hottest at startup
+
+  Every worker saves the requests it recorded to its own file, `path` with the
+  worker id before the extension, every `save_interval` seconds and on shutdown.
+  At startup a worker merges the files of all workers, so it starts from the
+  traffic of the whole previous generation, and once it saved its own log it
+  removes the files of the processes that stopped before it started. Replay runs
+  the undecorated endpoint functions in a background thread, so replayed calls
+  are neither coalesced with nor recorded as live traffic. Requests `skip` marks
+  as served from memory, which warm nothing, are neither recorded nor replayed.
+  The service is ready once the replay is done or `deadline` seconds passed.
+
+  Args:
+      endpoints (dict): endpoint name -> coalesced endpoint function to record and replay
+      path (str, optional): file of the logs. Defaults to 'warmup.json', empty to keep it in memory.
+      capacity (int, optional): request shapes kept in the log. Defaults to 500.
+      replay (int, optional): hottest requests replayed at startup. Defaults to 100.
+      deadline (float, optional): seconds after which the service is ready anyway. Defaults to 120.
+      save_interval (float, optional): seconds between saves of the log. Defaults to 60.
+      enabled (bool, optional): record and replay, else ready at once. Defaults to True.
+      skip (optional): function of the endpoint name and the request parameters, true for
+        requests not reaching the database or the statement caches
+      worker (str, optional): id of the worker in the name of its file. Defaults to the pid.
+  """
+  def __init__(self, endpoints:dict, path:str = 'warmup.json', capacity:int = 500,
+               replay:int = 100, deadline:float = 120.0, save_interval:float = 60.0,
+               enabled:bool = True, skip=None, worker:str = None):
+    self.endpoints = endpoints
+    self.path = path
+    self.file = worker_path(path, worker or str(os.getpid())) if path else ''
+    self.skip = skip
+    self.replay_count = replay
+    self.deadline = deadline
+    self.save_interval = save_interval
+    self.enabled = enabled
+    # requests recorded by this process, saved to its file
+    self.log = TopK(capacity)
+    # requests recorded by the previous processes, replayed
+    self.history = TopK(capacity)
+    self._loaded = []
+    self._started = time.time()
+    self.ready = threading.Event()
+    self.status = {'state': 'idle', 'replayed': 0, 'failed': 0, 'coverage': 0.0, 'seconds': 0.0}
+    self._stop = threading.Event()
+
+  def record(self, name:str, key):
+    """Coalesce observer counting a request of a recorded endpoint"""
+    if self.enabled and name in self.endpoints and not self._skipped(name, key):
+      self.log.record((name, key))
+
+  def _skipped(self, name:str, key):
+    return self.skip is not None and self.skip(name, dict(key))
+
+  def load(self):
+    """Merge the logs saved by the workers of previous processes, if any"""
+    if not self.path:
+      return
+    for path in worker_paths(self.path):
+      try:
+        with open(path, encoding='utf-8') as file:
+          for name, params, count in json.load(file):
+            key = tuple((param, tuple(value) if isinstance(value, list) else value)
+                        for param, value in params)
+            self.history.record((name, key), count)
+        self._loaded.append(path)
+      except (OSError, ValueError, TypeError) as error:
+        logger.warning("Ignoring unreadable warm-up log", extra={'path': path, 'error': str(error)})
+
+  def save(self):
+    """Write the log of this worker, replacing its previous file atomically
+
+    The loaded files of processes that stopped before this one started are
+    removed once the log of this worker is written, the files of live workers are
+    rewritten by them.
+    """
+    if not self.file or not len(self.log):
+      return
+    entries = [[name, [list(pair) for pair in key], count] for (name, key), count in self.log.top()]
+    temporary = f'{self.file}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+      json.dump(entries, file)
+    os.replace(temporary, self.file)
+    for path in self._loaded:
+      try:
+        if path != self.file and os.path.getmtime(path) < self._started:
+          os.remove(path)
+      except OSError:
+        pass
+    self._loaded = []
+
+  def start(self):
+    """Load the log and replay it in the background, then keep saving it"""
+    if not self.enabled:
+      self.status['state'] = 'disabled'
+      self.ready.set()
+      return
+    self.load()
+    threading.Thread(target=self._run, name='warmup', daemon=True).start()
+    timer = threading.Timer(self.deadline, self._expire)
+    timer.daemon = True
+    timer.start()
+
+  def _expire(self):
+    if not self.ready.is_set():
+      logger.warning("Warm-up deadline passed", extra={'deadline': self.deadline})
+      self.ready.set()
+
+  def _run(self):
+    try:
+      self.replay()
+    finally:
+      self.ready.set()
+    while not self._stop.wait(self.save_interval):
+      try:
+        self.save()
+      except OSError as error:
+        logger.warning("Could not save the warm-up log", extra={'error': str(error)})
+
+  def replay(self):
+    """Run the hottest recorded requests once
+
+    Returns:
+        dict: state, replayed and failed requests, coverage and seconds
+    """
+    started = time.perf_counter()
+    hottest = [(request, count) for request, count in self.history.top()
+               if not self._skipped(*request)][:self.replay_count]
+    total = self.history.total()
+    self.status['state'] = 'warming'
+    covered = 0
+    for (name, key), count in hottest:
+      if self._stop.is_set():
+        break
+      try:
+        endpoint = self.endpoints[name].__wrapped__
+        endpoint(**arguments(endpoint, key))
+        self.status['replayed'] += 1
+        covered += count
+      except Exception as error:  # a stale request must not stop the warm-up
+        self.status['failed'] += 1
+        metrics.inc('warmup_failed_total', endpoint=name)
+        logger.debug("Warm-up request failed", extra={'endpoint': name, 'error': str(error)})
+    self.status['coverage'] = covered / total if total else 1.0
+    self.status['seconds'] = time.perf_counter() - started
+    self.status['state'] = 'done'
+    metrics.set('warmup_seconds', self.status['seconds'])
+    metrics.set('warmup_coverage', self.status['coverage'])
+    metrics.set('warmup_replayed', self.status['replayed'])
+    logger.info("Warm-up done", extra=self.status)
+    return dict(self.status)
+
+  def stop(self):
+    """Stop replaying and save the log"""
+    self._stop.set()
+    if self.enabled:
+      self.save()
+
+
+def worker_path(path:str, worker:str):
+  """File of the log of a worker, 'warmup.json' -> 'warmup.<worker>.json'"""
+  stem, extension = os.path.splitext(path)
+  return f'{stem}.{worker}{extension}'
+
+
+def worker_paths(path:str):
+  """Files of the logs of all workers, and `path` itself as saved by a single process before"""
+  stem, extension = os.path.splitext(path)
+  pattern = re.compile(re.escape(os.path.basename(stem)) + r'\.[^.]+' + re.escape(extension) + '$')
+  paths = [candidate for candidate in glob.glob(f'{glob.escape(stem)}.*{extension}')
+           if pattern.match(os.path.basename(candidate))]
+  if os.path.exists(path):
+    paths.append(path)
+  return sorted(paths)
+
+
+def arguments(endpoint, key):
+  """Keyword arguments of an endpoint call from its normalized request key
+
+  Enum parameters are normalized to their values, they are turned back into members.
+  """
+  annotations = getattr(endpoint, '__annotations__', {})
+  kwargs = {}
+  for name, value in key:
+    annotation = annotations.get(name)
+    if value is not None and isinstance(annotation, type) and issubclass(annotation, Enum):
+      value = annotation(value)
+    kwargs[name] = list(value) if isinstance(value, tuple) else value
+  return kwargs
@@ -0,0 +1,60 @@
+"""
+Benchmark of request coalescing during a burst of identical /country requests
+
+Runs the endpoint function from a pool of threads, once through the coalescing
+wrapper and once calling the undecorated function, and counts the SQL statements
+executed against the database in each case.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m benchmarks.bench_coalesce --requests 200 --threads 50
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from athlete_api import main
+
+
+def run(endpoint, requests:int, threads:int, country:str):
+    """Fire `requests` concurrent calls and count the statements sent to the database"""
+    statements = 0
+    lock = threading.Lock()
+
+    def count(*_):
+        nonlocal statements
+        with lock:
+            statements += 1
+
+    engines = [main.router.primary, *main.router.replicas]
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: endpoint(country=country, sport=None, start_date=1900,
+                                         end_date=2020, detail=False), range(requests)))
+    elapsed = time.perf_counter() - start
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', count)
+    return statements, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--country', default='USA')
+    args = parser.parse_args()
+
+    for label, endpoint in [('uncoalesced', main.get_country_data.__wrapped__),
+                            ('coalesced', main.get_country_data)]:
+        statements, elapsed = run(endpoint, args.requests, args.threads, args.country)
+        print(f'{label:>12}: {statements:5d} statements, {elapsed:6.2f}s, '
+              f'{args.requests / elapsed:8.1f} req/s')
+    shared = main.metrics.get('coalesce_shared_total', endpoint='get_country_data')
+    total = main.metrics.get('coalesce_requests_total', endpoint='get_country_data')
+    print(f'coalescing ratio: {shared / total:.2%} of requests shared an in-flight execution')
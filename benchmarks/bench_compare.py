@@ -0,0 +1,60 @@
+"""
+Benchmark of /compare against one /country call per compared country
+
+Calls the undecorated endpoint functions so coalescing does not hide repeated
+work, and counts the SQL statements executed against the database.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m benchmarks.bench_compare --countries USA,Finland,Sweden,Norway,Germany,France,Italy,Japan
+"""
+
+import argparse
+import threading
+import time
+
+from sqlalchemy import event
+
+from athlete_api import main
+
+
+def run(call, repeat:int):
+    """Run `call` `repeat` times, return the statements per call and the milliseconds per call"""
+    statements = 0
+    lock = threading.Lock()
+
+    def count(*_):
+        nonlocal statements
+        with lock:
+            statements += 1
+
+    engines = [main.router.primary, *main.router.replicas]
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    elapsed = time.perf_counter() - start
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', count)
+    return statements / repeat, elapsed / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--countries', default='USA,Finland,Sweden,Norway,Germany,France,Italy,Japan')
+    parser.add_argument('--start-date', type=int, default=1900)
+    parser.add_argument('--end-date', type=int, default=2020)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    countries = args.countries.split(',')
+    period = {'sport': None, 'start_date': args.start_date, 'end_date': args.end_date}
+
+    main.regions.build(main.router.reader())
+    separate = lambda: [main.get_country_data.__wrapped__(country=country, **period)
+                        for country in countries]
+    compared = lambda: main.get_compare_data.__wrapped__(countries=countries, nocs=None, **period)
+    for label, call in [(f'{len(countries)} x /country', separate), ('/compare', compared)]:
+        call()  # warm the statement caches
+        statements, milliseconds = run(call, args.repeat)
+        print(f'{label:>14}: {statements:4.0f} statements, {milliseconds:8.1f} ms per comparison')
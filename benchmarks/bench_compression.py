@@ -0,0 +1,50 @@
+"""
+Bytes on the wire and CPU per request of the response compression codecs
+
+Renders a detail response of /country and /noc as the API sends it and compresses
+it with every codec available at the configured level.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m benchmarks.bench_compression --country USA --noc USA --runs 10
+"""
+
+import argparse
+import logging
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from athlete_api import main
+from athlete_api.compression import available_encodings
+
+
+def bodies(country:str, noc:str):
+    """JSON bodies of detail responses"""
+    country_data = main.get_country_data.__wrapped__(country=country, sport=None, start_date=1896,
+                                                     end_date=2020, detail=True)
+    noc_data = main.get_noc_data.__wrapped__(noc=noc, sport=None, start_date=1896,
+                                             end_date=2020, detail=True)
+    return {f'/country/{country}?detail=true': JSONResponse(jsonable_encoder(country_data)).body,
+            f'/noc/{noc}?detail=true': JSONResponse(jsonable_encoder(noc_data)).body}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--country', default='USA')
+    parser.add_argument('--noc', default='USA')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--level', type=int, default=main.compression_options['level'])
+    args = parser.parse_args()
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+
+    for path, body in bodies(args.country, args.noc).items():
+        print(f'{path}: {len(body) / 1024:10.1f} KiB uncompressed')
+        for name, compress in available_encodings().items():
+            start = time.thread_time()
+            for _ in range(args.runs):
+                compressed = compress(body, args.level)
+            cpu = (time.thread_time() - start) / args.runs
+            print(f'  {name:>5} level {args.level}: {len(compressed) / 1024:10.1f} KiB '
+                  f'({len(body) / len(compressed):5.1f}x), {cpu * 1000:7.1f} ms CPU')
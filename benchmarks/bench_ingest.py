@@ -0,0 +1,68 @@
+"""
+Benchmark of the sustained ingest rate of /add_athlete/, committed per entry or buffered
+
+Calls the endpoint function from `--clients` threads like the results feed does,
+waits for the buffer to be flushed and deletes the benchmark entries afterwards
+through the bulk delete endpoint, so the change log and the caches follow.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m benchmarks.bench_ingest --entries 5000 --clients 4
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import Response
+from sqlmodel import Session, delete
+
+from athlete_api import main
+from athlete_api.models import AthleteBase, AthleteBulkDelete, EventMedal
+
+EVENT = 'Ingest Benchmark Event'
+
+
+def add(number:int, buffered:bool):
+    athlete = AthleteBase(name=f'Ingest Benchmark {number}', sex='M', age=25.0, team='Norway',
+                          noc='NOR', games='2030 Summer', year=2030, season='Summer', city='Test',
+                          sport='Test', event=EVENT, medal='Gold' if number % 10 == 0 else None)
+    with Session(main.engine) as session:
+        main.add_athlete(session=session, athlete=athlete, buffered=buffered, response=Response())
+
+
+def run(entries:int, clients:int, buffered:bool):
+    """Add `entries` athletes, return the entries per second until all are committed"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(lambda number: add(number, buffered), range(entries)))
+    main.ingest.flush()
+    return entries / (time.perf_counter() - start)
+
+
+def clean():
+    """Delete the benchmark entries with the bulk delete endpoint, which logs the change for the caches"""
+    with Session(main.engine) as session:
+        main.delete_athletes(session=session, bulk=AthleteBulkDelete(where=[('event', EVENT, 'equal')]))
+    # event medals left at a count of zero
+    with Session(main.router.shard('NOR').writer()) as session:
+        session.execute(delete(EventMedal).where(EventMedal.event == EVENT))
+        session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=4)
+    args = parser.parse_args()
+
+    main.regions.build(main.router.reader())
+    main.ingest.start()
+    try:
+        for label, buffered in [('committed', False), ('buffered', True)]:
+            rate = run(args.entries, args.clients, buffered)
+            print(f'{label:>10}: {rate:8.0f} entries/s')
+            clean()
+    finally:
+        main.ingest.close()
+        clean()
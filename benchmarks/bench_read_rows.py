@@ -0,0 +1,49 @@
+"""
+Peak memory and latency of the read paths for a large /country result
+
+Calls the endpoint function directly (without request coalescing) and reports
+the tracemalloc peak of the query and regroup, and the latency over a few runs.
+
+Usage:
+    FILE_NAME=./athlete_api/database.ini SECTION_NAME=postgresql \
+        python -m benchmarks.bench_read_rows --country USA --runs 5
+"""
+
+import argparse
+import logging
+import statistics
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+
+from athlete_api import main
+
+
+def measure(detail:bool, country:str, runs:int):
+    """Peak traced memory of one call and median latency over `runs` calls"""
+    endpoint = main.get_country_data.__wrapped__
+    tracemalloc.start()
+    endpoint(country=country, sport=None, start_date=1896, end_date=2020, detail=detail)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        jsonable_encoder(endpoint(country=country, sport=None, start_date=1896,
+                                  end_date=2020, detail=detail))
+        latencies.append(time.perf_counter() - start)
+    return peak, statistics.median(latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--country', default='USA')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+
+    for detail in (False, True):
+        peak, latency = measure(detail, args.country, args.runs)
+        print(f'/country/{args.country}?detail={str(detail).lower():5}: '
+              f'peak {peak / 2**20:7.2f} MiB, median {latency * 1000:8.1f} ms')
@@ -0,0 +1,67 @@
+"""
+Pytest functions for admission control
+"""
+
+import asyncio
+
+from athlete_api.admission import (AdmissionMiddleware, ConcurrencyGate, RateLimiter,
+                                   endpoint_class)
+
+
+def test_rate_limiter():
+    """
+     Test that a client is limited after its burst while other clients are not.
+    """
+    limiter = RateLimiter(rate=1, burst=3)
+    assert [limiter.take('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('a') > 0
+    assert limiter.take('b') == 0
+
+
+def test_concurrency_gate_sheds():
+    """
+     Test that requests beyond the cap and the wait queue are shed.
+    """
+    async def run():
+        gate = ConcurrencyGate(limit=1, queue_size=1, timeout=0.05)
+        assert await gate.acquire() is None
+        waiting = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        assert await gate.acquire() == 'queue_full'
+        assert await waiting == 'queue_timeout'
+        gate.release()
+        assert await gate.acquire() is None
+    asyncio.run(run())
+
+
+def test_endpoint_class():
+    """
+     Test classification of requests into endpoint classes.
+    """
+    assert endpoint_class({'path': '/country/USA', 'query_string': b'detail=true'}) == 'detail'
+    assert endpoint_class({'path': '/athletes/a', 'query_string': b''}) == 'query'
+    assert endpoint_class({'path': '/add_athlete/', 'query_string': b''}) is None
+
+
+def test_timeseries_is_rate_limited():
+    """
+     Test that /timeseries gets 429 once the bucket of its client is empty.
+    """
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+
+    async def run():
+        middleware = AdmissionMiddleware(app, rate=0.001, burst=2)
+        statuses = []
+        for _ in range(3):
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+            scope = {'type': 'http', 'path': '/timeseries', 'query_string': b'nocs=NOR',
+                     'headers': [], 'client': ('10.0.0.1', 1234)}
+            await middleware(scope, None, send)
+        return statuses
+
+    assert endpoint_class({'path': '/timeseries', 'query_string': b'nocs=NOR'}) == 'query'
+    assert asyncio.run(run()) == [200, 200, 429]
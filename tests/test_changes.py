@@ -0,0 +1,65 @@
+"""
+Pytest functions for the change feed keeping the caches of the workers current
+"""
+
+from fastapi.testclient import TestClient
+
+from athlete_api.changes import ChangeFeed
+from athlete_api.guard import CardinalityIndex
+from athlete_api.main import app, router
+from athlete_api.profiles import AthleteProfiles
+from athlete_api.regions import RegionIndex
+
+ATHLETE = {"name": "Feed Tester", "sex": "F", "age": 30.0, "team": "Feed Team", "noc": "NF1",
+           "games": "2020 Summer", "year": 2020, "season": "Summer", "city": "Tokyo",
+           "sport": "Feed Sport", "event": "Feed Event", "medal": "Gold"}
+
+
+def test_other_worker_sees_writes():
+    """
+     Test that the profiles, cardinality estimates and regions of another worker
+     follow the writes made through the app once its feed catches up.
+    """
+    client = TestClient(app)
+    profiles, regions, cardinality = AthleteProfiles(), RegionIndex(), CardinalityIndex()
+    profiles.build(*(shard.writer() for shard in router.shards()))
+    cardinality.build(*(shard.writer() for shard in router.shards()))
+    regions.build(router.writer())
+    other = ChangeFeed(router, profiles, regions, cardinality=cardinality)
+
+    assert client.post("/add_region/", json={"noc": "NF1", "region": "Feed Region"}).status_code == 200
+    athlete_id = client.post("/add_athlete/", json=ATHLETE).json()["id"]
+    other.catch_up()
+    assert regions.get("NF1") == ("Feed Region", None)
+    assert profiles.search("Feed Tester", exact=True)["Feed Tester"]["medal_count"] == 1
+    assert cardinality.noc_rows(["NF1"], sport="feed sport") == 1
+    assert cardinality.name_rows("Feed Tester", exact=True) == 1
+
+    client.patch(f"/update_athlete/{athlete_id}", json={"medal": None, "sport": "Other Sport"})
+    other.catch_up()
+    assert profiles.search("Feed Tester", exact=True)["Feed Tester"]["sports"] == ["Other Sport"]
+    assert profiles.search("Feed Tester", exact=True)["Feed Tester"]["medal_count"] == 0
+
+    client.post("/add_athlete/", json=ATHLETE)
+    assert client.delete("/delete_region/NF1").status_code == 200
+    other.catch_up()
+    assert profiles.search("Feed Tester") == {}
+    assert cardinality.noc_rows(["NF1"]) == 0
+    assert regions.get("NF1") is None
+
+
+def test_installed_profiles_replay_writes_made_while_they_were_built():
+    """
+     Test that profiles built before a write, e.g. by a rebuild job, are served with the write.
+    """
+    client = TestClient(app)
+    built = AthleteProfiles()
+    built.build(*(shard.writer() for shard in router.shards()))
+    profiles, regions = AthleteProfiles(), RegionIndex()
+    feed = ChangeFeed(router, profiles, regions)
+
+    assert client.post("/add_region/", json={"noc": "NF1", "region": "Feed Region"}).status_code == 200
+    client.post("/add_athlete/", json=ATHLETE)
+    feed.install(built)
+    assert profiles.search("Feed Tester", exact=True)["Feed Tester"]["medal_count"] == 1
+    assert client.delete("/delete_region/NF1").status_code == 200
@@ -0,0 +1,66 @@
+"""
+Pytest functions for request coalescing
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from athlete_api.coalesce import coalesce, request_key
+from athlete_api.models import Seasons
+
+
+def test_request_key_normalized():
+    """
+     Test that identical parameters produce the same key and strings are kept as sent.
+    """
+    def endpoint(country: str, season: Seasons = Seasons.UNION, exact: bool = True):
+        return country
+
+    assert request_key(endpoint, 'Finland') == request_key(endpoint, country='Finland',
+                                                           season=Seasons.UNION)
+    assert request_key(endpoint, 'Finland ') != request_key(endpoint, 'finland')
+    assert request_key(endpoint, 'Finland') != request_key(endpoint, 'Finland', exact=False)
+
+
+def test_coalesce_shares_execution():
+    """
+     Test that concurrent identical calls run the function once.
+    """
+    calls = []
+    release = threading.Event()
+
+    @coalesce
+    def endpoint(country: str):
+        calls.append(country)
+        release.wait(1)
+        return {country: len(calls)}
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(endpoint, 'USA') for _ in range(8)]
+        time.sleep(0.1)
+        release.set()
+        results = [future.result() for future in futures]
+    assert calls == ['USA']
+    assert results == [{'USA': 1}] * 8
+
+
+def test_coalesce_keeps_distinct_strings_apart():
+    """
+     Test that overlapping calls differing in case or spaces each get their own result.
+    """
+    release = threading.Event()
+
+    @coalesce
+    def endpoint(country: str):
+        release.wait(1)
+        return {'Finland': 'data'} if country == 'Finland' else {}
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        exact = pool.submit(endpoint, 'Finland')
+        time.sleep(0.05)
+        padded = pool.submit(endpoint, 'Finland ')
+        time.sleep(0.05)
+        release.set()
+        assert exact.result() == {'Finland': 'data'}
+        assert padded.result() == {}
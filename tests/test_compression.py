@@ -0,0 +1,56 @@
+"""
+Pytest functions for response compression
+"""
+
+from fastapi import FastAPI, Response
+from fastapi.testclient import TestClient
+
+from athlete_api.compression import CompressionMiddleware, choose_encoding
+
+
+def test_choose_encoding():
+    """
+     Test negotiation of the content encoding.
+    """
+    encodings = {'br': None, 'gzip': None}
+    assert choose_encoding('gzip, deflate, br', encodings) == 'br'
+    assert choose_encoding('gzip;q=0.5, br;q=0', encodings) == 'gzip'
+    assert choose_encoding('identity', encodings) is None
+
+
+def test_compression_threshold():
+    """
+     Test that only responses above the minimum size are compressed.
+    """
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100, offload_size=1000)
+
+    @app.get("/size/{size}")
+    def sized(size: int):
+        return {"data": "x" * size}
+
+    client = TestClient(app)
+    small = client.get("/size/10", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    for size in (500, 5000):
+        response = client.get(f"/size/{size}", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json() == {"data": "x" * size}
+        assert int(response.headers["content-length"]) < size
+
+
+def test_compression_merges_vary():
+    """
+     Test that a compressed response keeps a single Vary header listing the fields it already varied on.
+    """
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.get("/cookie")
+    def cookie(response: Response):
+        response.headers["Vary"] = "Cookie"
+        return {"data": "x" * 500}
+
+    response = TestClient(app).get("/cookie", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers.get_list("vary") == ["Cookie, Accept-Encoding"]
@@ -0,0 +1,68 @@
+"""
+Pytest functions for the validation of the data loader
+"""
+
+import csv
+
+from athlete_api.data_loader import (ATHLETE_COLUMNS, athlete_checks, load_csv,
+                                     validate_rows)
+
+HEADER = ','.join(ATHLETE_COLUMNS)
+VALID = 'Tester,M,20,Finland,FIN,1990 Summer,1990,Summer,City,Judo,Judo M,Gold'
+
+
+class CopyCursor:
+    """Cursor recording the rows passed to COPY"""
+    def __init__(self):
+        self.rows = []
+
+    def copy_expert(self, sql, file):
+        self.rows = list(csv.reader(file))
+
+
+def test_validate_rows():
+    """
+     Test that every failed check of a row is reported and duplicates are flagged.
+    """
+    rows = [VALID.split(','),
+            VALID.replace('Gold', 'Platinum').replace('FIN', 'XXX').split(','),
+            VALID.replace('20', 'abc').split(','),
+            ['Tester', 'M'],
+            VALID.split(',')]
+    results = list(validate_rows(rows, ATHLETE_COLUMNS, athlete_checks({'FIN'}), chunk_size=2))
+    assert [line for line, _, _ in results] == [2, 3, 4, 5, 6]
+    reasons = [reasons for _, _, reasons in results]
+    assert reasons[0] == []
+    assert reasons[1] == ['noc: NOC not found in regions', 'medal: medal must be Gold, Silver or Bronze']
+    assert reasons[2] == ['age: age is not a number']
+    assert reasons[3] == ['expected 12 fields, found 2']
+    assert reasons[4] == ['duplicate of line 2']
+
+
+def test_load_csv_quarantines_bad_rows(tmp_path):
+    """
+     Test that clean rows are copied and bad rows are written to the quarantine file.
+    """
+    path = tmp_path / 'athletes.csv'
+    path.write_text('\n'.join([HEADER, VALID, VALID.replace('Gold', 'Platinum')]) + '\n')
+    cursor = CopyCursor()
+    report = load_csv(cursor, 'athletes_summer', ATHLETE_COLUMNS, str(path), athlete_checks({'FIN'}),
+                      quarantine_directory=str(tmp_path / 'quarantine'))
+    assert (report.rows, report.loaded, report.quarantined) == (2, 1, 1)
+    assert cursor.rows == [VALID.split(',')]
+    with open(tmp_path / 'quarantine' / 'athletes_summer.csv', newline='') as quarantine:
+        quarantined = list(csv.reader(quarantine))
+    assert quarantined[1][:2] == ['3', 'medal: medal must be Gold, Silver or Bronze']
+
+
+def test_load_csv_keeps_rows_of_a_shard(tmp_path):
+    """
+     Test that only the valid rows selected by keep are copied, e.g. the NOCs of a shard.
+    """
+    path = tmp_path / 'athletes.csv'
+    path.write_text('\n'.join([HEADER, VALID, VALID.replace('FIN', 'SWE')]) + '\n')
+    cursor = CopyCursor()
+    report = load_csv(cursor, 'athletes_summer', ATHLETE_COLUMNS, str(path),
+                      athlete_checks({'FIN', 'SWE'}), keep=lambda row: row[4] == 'SWE')
+    assert (report.rows, report.loaded, report.quarantined) == (2, 1, 0)
+    assert cursor.rows == [VALID.replace('FIN', 'SWE').split(',')]
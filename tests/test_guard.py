@@ -0,0 +1,80 @@
+"""
+Pytest functions for the query cost guard
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from athlete_api.guard import CardinalityIndex, CostGuard
+from athlete_api.metrics import metrics
+from athlete_api.models import Seasons
+
+
+class Snapshot:
+    cache_generations = None
+    tables = {
+        'athletes_summer': {'name': ['Anna Berg', 'Anna Berg', 'Jan Berger', 'Eva Nordin'],
+                          'noc': ['NOR', 'NOR', 'SWE', 'SWE'],
+                          'year': [1992, 1996, 1992, 2000],
+                          'sport': ['Swimming', 'Rowing', 'Swimming', 'Swimming']},
+        'athletes_winter': {'name': ['Anna Moen'], 'noc': ['NOR'], 'year': [1994],
+                            'sport': ['Biathlon']},
+    }
+
+    def values(self, table, column):
+        return self.tables[table][column]
+
+
+def test_cardinality_index_bounds_substring_matches():
+    """
+     Test that the estimates never undercount the entries matching a name or NOCs.
+    """
+    index = CardinalityIndex(3)
+    index.build_from_snapshot(Snapshot())
+    assert index.name_rows('Anna Berg', exact=True) == 2
+    assert index.name_rows('anna') == 3
+    assert index.name_rows('berg') == 3
+    assert index.name_rows('an') == 4
+    assert index.name_rows('xyz') == 0
+    assert index.noc_rows(['NOR']) == 3
+    assert index.noc_rows(['nor', 'SWE'], start_date=1993, end_date=1999) == 2
+    assert index.noc_rows(['NOR', 'SWE'], sport='swimming') == 3
+
+
+def test_cardinality_index_follows_changes():
+    """
+     Test that added and removed entries update the estimates of their NOC and name.
+    """
+    index = CardinalityIndex(3)
+    index.build_from_snapshot(Snapshot())
+    entry = SimpleNamespace(name='Anna Lind', noc='nor', year=1992, sport='Swimming')
+    index.add(Seasons.SUMMER, entry)
+    assert index.noc_rows(['NOR'], sport='swimming') == 2
+    assert index.name_rows('Anna Lind', exact=True) == 1
+    assert index.name_rows('anna') == 4
+    index.remove(Seasons.SUMMER, entry)
+    index.remove(Seasons.SUMMER, SimpleNamespace(name='Eva Nordin', noc='SWE', year=2000, sport='Swimming'))
+    assert index.noc_rows(['NOR'], sport='swimming') == 1
+    assert index.noc_rows(['SWE'], start_date=2000) == 0
+    assert index.name_rows('Anna Lind', exact=True) == 0
+    assert index.name_rows('nordin') == 0
+
+
+def test_cost_guard_rejects_broad_queries():
+    """
+     Test that a query over the limit is refused with a 400 and counted, and that
+     summaries get the larger limit.
+    """
+    index = CardinalityIndex(3)
+    guard = CostGuard(index, max_rows=3, detail_max_rows=2)
+    guard.check('test', 10, detail=True)
+    index.build_from_snapshot(Snapshot())
+    guard.check('test', index.name_rows('anna'), detail=False)
+    with pytest.raises(HTTPException) as error:
+        guard.check('test', index.name_rows('anna'), detail=True, hint="Use a longer name.")
+    assert error.value.status_code == 400
+    assert error.value.detail == ("Query too broad: up to 3 matching entries, the limit is 2. "
+                                  "Use a longer name.")
+    assert 'guard_rejected_total{endpoint="test"} 1' in metrics.render()
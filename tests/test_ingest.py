@@ -0,0 +1,90 @@
+"""
+Pytest functions for the buffered ingestion
+"""
+
+import json
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, delete, select, text
+
+from athlete_api.changes import create_tables
+from athlete_api.ingest import BufferFull, IngestBuffer
+from athlete_api.models import AthleteSummer, EventMedal, Region
+from athlete_api.services import EngineRouter, connect
+
+
+def entry(noc, medal='Gold'):
+    return AthleteSummer(name='Ingest Tester', sex='F', age=21.0, team='Test', noc=noc,
+                         games='2030 Summer', year=2030, season='Summer', city='Test',
+                         sport='Test', event='Ingest Test Event', medal=medal)
+
+
+@pytest.fixture(name="engine")
+def engine_fixture():
+    engine = connect(filename='athlete_api/database.ini', section='postgresql_test')
+    SQLModel.metadata.create_all(engine)
+    create_tables(engine)
+    with Session(engine) as session:
+        session.execute(text("CREATE SEQUENCE IF NOT EXISTS ingest_test_seq START 900000000"))
+        session.add(Region(noc='NO4', region='Test Region 4'))
+        session.commit()
+    yield engine
+    with Session(engine) as session:
+        session.execute(delete(EventMedal).where(EventMedal.noc == 'NO4'))
+        session.execute(delete(AthleteSummer).where(AthleteSummer.noc == 'NO4'))
+        session.execute(delete(Region).where(Region.noc == 'NO4'))
+        session.commit()
+
+
+def test_buffer_flushes_batches_and_isolates_bad_entries(engine, tmp_path):
+    """
+     Test that buffered entries keep their ids, count their medals once per event and
+     that an entry failing the insert is quarantined without dropping the rest of its batch,
+     and that a refused entry does not take an id.
+    """
+    flushed = []
+    buffer = IngestBuffer(EngineRouter(engine), batch_size=10, id_block=2, max_pending=3,
+                          sequence='ingest_test_seq', quarantine_directory=str(tmp_path),
+                          on_flush=flushed.extend)
+    ids = [buffer.put(entry('NO4')), buffer.put(entry('XX9')), buffer.put(entry('NO4'))]
+    assert len(set(ids)) == 3
+    assert buffer.pending(ids[0])
+    with pytest.raises(BufferFull):
+        buffer.put(entry('NO4'))
+    assert buffer.flush() == 2
+    assert not buffer.pending(ids[0])
+    assert [athlete.id for athlete in flushed] == [ids[0], ids[2]]
+    with Session(engine) as session:
+        rows = session.exec(select(AthleteSummer.id).where(AthleteSummer.noc == 'NO4')).all()
+        assert sorted(rows) == [ids[0], ids[2]]
+        medals = session.exec(select(EventMedal).where(EventMedal.noc == 'NO4')).all()
+        assert [(row.medal, row.entries) for row in medals] == [('Gold', 2)]
+    quarantined = [json.loads(line) for line in (tmp_path / 'ingest.jsonl').read_text().splitlines()]
+    assert [(row['athlete']['id'], row['athlete']['noc']) for row in quarantined] == [(ids[1], 'XX9')]
+    assert buffer.put(entry('NO4')) == ids[2] + 1
+    buffer.close()
+
+
+def test_buffer_retries_entries_when_the_database_fails(engine, monkeypatch):
+    """
+     Test that entries failing on an unavailable database stay buffered with their ids
+     and are written by the next flush.
+    """
+    buffer = IngestBuffer(EngineRouter(engine), batch_size=10, id_block=2, max_pending=3,
+                          sequence='ingest_test_seq')
+    athlete_id = buffer.put(entry('NO4'))
+    write = buffer._write
+
+    def unavailable(engine, athletes):
+        raise OperationalError('INSERT', {}, Exception('server closed the connection unexpectedly'))
+
+    monkeypatch.setattr(buffer, '_write', unavailable)
+    assert buffer.flush() == 0
+    assert buffer.pending(athlete_id)
+    monkeypatch.setattr(buffer, '_write', write)
+    assert buffer.flush() == 1
+    assert not buffer.pending(athlete_id)
+    with Session(engine) as session:
+        assert session.get(AthleteSummer, athlete_id) is not None
+    buffer.close()
@@ -0,0 +1,100 @@
+"""
+Pytest functions for the background jobs
+"""
+
+import pickle
+import threading
+
+from athlete_api.jobs import JobQueue
+from athlete_api.models import Seasons
+from athlete_api.profiles import AthleteProfiles, Entry
+
+
+def write_artifact(path, text):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return {'bytes': len(text)}
+
+
+def fail():
+    raise ValueError('broken')
+
+
+def wait(job):
+    job.future.exception(timeout=30)
+    for _ in range(100):
+        if job.finished:
+            return job
+        threading.Event().wait(0.01)
+    return job
+
+
+def test_thread_job_writes_artifact(tmp_path):
+    """
+     Test that a job runs in the background and its artifact stays available.
+    """
+    queue = JobQueue(str(tmp_path))
+    job = wait(queue.submit('export', write_artifact, 'name\n', artifact='entries.csv'))
+    assert job.status == 'done'
+    assert job.result == {'bytes': 5}
+    with open(job.artifact, encoding='utf-8') as file:
+        assert file.read() == 'name\n'
+    assert queue.get(job.id) is job
+    queue.shutdown()
+
+
+def test_failed_job_and_pending_limit(tmp_path):
+    """
+     Test that errors are reported in the job and that submit refuses jobs past max_pending.
+    """
+    queue = JobQueue(str(tmp_path), threads=1, max_pending=1)
+    release = threading.Event()
+    blocker = queue.submit('block', release.wait)
+    assert queue.submit('export', fail) is None
+    release.set()
+    wait(blocker)
+    job = wait(queue.submit('export', fail))
+    assert job.status == 'failed'
+    assert job.error == 'broken'
+    queue.shutdown()
+
+
+def test_process_job_result_is_installed(tmp_path):
+    """
+     Test that CPU-bound jobs run in a worker process and on_done runs in this process.
+    """
+    queue = JobQueue(str(tmp_path))
+    installed = []
+    job = wait(queue.submit('calc', pow, 2, 10, cpu=True,
+                            on_done=lambda result: installed.append(result) or result))
+    assert job.status == 'done'
+    assert installed == [1024]
+    assert job.submitted <= job.started <= job.finished
+    queue.shutdown()
+
+
+def test_cancelled_job():
+    """
+     Test that a job cancelled before it ran is reported as cancelled.
+    """
+    queue = JobQueue('jobs', threads=1)
+    release = threading.Event()
+    running = queue.submit('wait', release.wait, 30)
+    job = queue.submit('calc', pow, 2, 10)
+    assert job.future.cancel()
+    assert job.status == 'cancelled' and job.finished is not None
+    release.set()
+    assert wait(running).status == 'done'
+    queue.shutdown()
+
+
+def test_profiles_survive_pickling():
+    """
+     Test that profiles built in a worker process can be sent back and served.
+    """
+    built = AthleteProfiles()
+    built.add(Seasons.SUMMER, Entry('Jan Tester', 'Norway', '1984 Summer', 'Archery', None))
+    profiles = AthleteProfiles()
+    profiles.replace(pickle.loads(pickle.dumps(built)))
+    assert len(profiles) == 1
+    assert profiles.search('tester')['Jan Tester']['games'] == ['1984 Summer']
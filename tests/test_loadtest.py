@@ -0,0 +1,59 @@
+"""
+Pytest functions for the load generator
+"""
+
+from athlete_api.loadtest import compare, find_saturation, percentile, summarize
+
+
+def step(concurrency, throughput, p99_ms=10.0, error_rate=0.0):
+    return {'concurrency': concurrency, 'throughput': throughput, 'p99_ms': p99_ms,
+            'error_rate': error_rate}
+
+
+def test_summarize_separates_errors_and_shed_requests():
+    """
+     Test that shed requests are not counted as errors, that rejected requests are
+     counted apart and that 404s count as successes.
+    """
+    samples = [('noc', 0.010, 200), ('noc', 0.020, 429), ('athletes', 0.030, 404),
+               ('write', 0.040, None), ('noc', 0.050, 504), ('write', 0.060, 422),
+               ('noc', 0.070, 400), ('detail', 0.080, 500)]
+    result = summarize(samples, concurrency=2, elapsed=0.5)
+    assert result['throughput'] == 16.0
+    assert result['p50_ms'] == 40.0
+    assert result['p99_ms'] == 80.0
+    assert result['error_rate'] == 0.375
+    assert result['rejected_rate'] == 0.25
+    assert result['shed_rate'] == 0.125
+    assert result['operations']['noc']['requests'] == 4
+    assert result['operations']['write']['error_rate'] == 0.5
+
+
+def test_percentile():
+    """
+     Test nearest-rank percentiles.
+    """
+    assert percentile([], 0.99) == 0.0
+    assert percentile(list(range(1, 101)), 0.95) == 95
+    assert percentile([3, 1, 2], 0.5) == 2
+
+
+def test_find_saturation():
+    """
+     Test that saturation is the last step that still scaled throughput.
+    """
+    assert find_saturation([step(1, 100), step(2, 190), step(4, 200), step(8, 150)]) == 2
+    assert find_saturation([step(1, 100), step(2, 190), step(4, 380, error_rate=0.05)]) == 2
+    assert find_saturation([step(1, 100), step(2, 190)]) is None
+
+
+def test_compare_reports_regressions():
+    """
+     Test that only changes beyond the tolerance are reported.
+    """
+    baseline = [step(1, 100, p99_ms=10), step(2, 200, p99_ms=20)]
+    assert compare([step(1, 90, p99_ms=11), step(2, 190, p99_ms=22)], baseline) == []
+    regressions = compare([step(1, 70, p99_ms=10), step(2, 200, p99_ms=30, error_rate=0.05)],
+                          baseline)
+    assert len(regressions) == 3
+    assert regressions[0].startswith('concurrency 1: throughput')
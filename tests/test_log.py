@@ -0,0 +1,68 @@
+"""
+Pytest functions for the logging layer
+"""
+
+import io
+import json
+import logging
+import queue
+
+from fastapi.testclient import TestClient
+
+from athlete_api import admin
+from athlete_api.log import (DroppingQueueHandler, JsonFormatter, SamplingFilter, levels,
+                             set_level)
+from athlete_api.main import app
+from athlete_api.metrics import metrics
+
+
+def test_json_formatter_includes_extra_fields():
+    """
+     Test that fields passed with extra end up in the JSON line.
+    """
+    record = logging.makeLogRecord({'name': 'athlete_api.utils', 'levelno': logging.DEBUG,
+                                    'levelname': 'DEBUG', 'msg': 'Where clause', 'attr': 'noc'})
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'Where clause'
+    assert entry['attr'] == 'noc'
+    assert entry['logger'] == 'athlete_api.utils'
+
+
+def test_sampling_filter_only_samples_debug():
+    """
+     Test that debug records are sampled and records of higher levels always pass.
+    """
+    sampling = SamplingFilter(0)
+    assert not sampling.filter(logging.makeLogRecord({'levelno': logging.DEBUG}))
+    assert sampling.filter(logging.makeLogRecord({'levelno': logging.INFO}))
+
+
+def test_queue_handler_drops_when_full():
+    """
+     Test that logging never blocks on a full queue.
+    """
+    handler = DroppingQueueHandler(queue.Queue(1))
+    dropped = metrics.get('log_dropped_total')
+    for _ in range(3):
+        handler.handle(logging.makeLogRecord({'msg': 'message'}))
+    assert handler.queue.qsize() == 1
+    assert metrics.get('log_dropped_total') == dropped + 2
+
+
+def test_admin_logging_switches_sql_echo(monkeypatch):
+    """
+     Test that the admin endpoint requires the token and changes levels at runtime.
+    """
+    client = TestClient(app)
+    monkeypatch.setitem(admin.options, 'token', 'secret')
+    response = client.put("/admin/logging?subsystem=sql&level=INFO")
+    assert response.status_code == 401
+    try:
+        response = client.put("/admin/logging?subsystem=sql&level=INFO",
+                              headers={'X-Admin-Token': 'secret'})
+        assert response.status_code == 200
+        assert response.json()['sql'] == 'INFO'
+        assert logging.getLogger('sqlalchemy.engine').isEnabledFor(logging.INFO)
+    finally:
+        set_level('sql', 'WARNING')
+    assert levels()['sql'] == 'WARNING'
@@ -0,0 +1,90 @@
+"""
+Pytest functions for the event medal table
+"""
+
+from types import SimpleNamespace
+
+import requests
+from sqlmodel import Session, SQLModel, select
+
+from athlete_api.main import games_medals_statement
+from athlete_api.medals import record_medal, record_medals
+from athlete_api.models import CountModes, EventMedal, Region
+from athlete_api.services import connect
+from athlete_api.utils import clause_params
+
+
+def test_record_medal_counts_team_medal_once():
+    """
+     Test that team members share one event medal row that disappears with the last entry.
+    """
+    engine = connect(filename='athlete_api/database.ini', section='postgresql_test')
+    SQLModel.metadata.create_all(engine)
+    member = SimpleNamespace(games='1992 Summer', event='Test Event', noc='NO2', medal='Gold',
+                             year=1992, season='Summer', sport='Test')
+    with Session(engine) as session:
+        session.add(Region(noc='NO2', region='Test Region 2'))
+        session.flush()
+        record_medal(session, member, 1)
+        record_medal(session, member, 1)
+        record_medal(session, SimpleNamespace(**{**vars(member), 'medal': None}), 1)
+        rows = session.exec(select(EventMedal).where(EventMedal.noc == 'NO2')).all()
+        assert [(row.medal, row.entries) for row in rows] == [('Gold', 2)]
+        record_medal(session, member, -1)
+        record_medal(session, member, -1)
+        assert session.exec(select(EventMedal).where(EventMedal.noc == 'NO2')).all() == []
+        session.rollback()
+
+
+def test_event_count_mode_keeps_individual_medals_of_one_noc():
+    """
+     Test that two bronzes of one NOC in an individual event count twice while a
+     team medal counts once.
+    """
+    engine = connect(filename='athlete_api/database.ini', section='postgresql_test')
+    SQLModel.metadata.create_all(engine)
+
+    def entries(games, event, medal, count):
+        return [SimpleNamespace(games=games, event=event, noc='NO3', medal=medal, year=int(games[:4]),
+                                season='Summer', sport='Test') for _ in range(count)]
+
+    clauses = [('noc', ['NO3'], 'in')]
+    with Session(engine) as session:
+        session.add(Region(noc='NO3', region='Test Region 3'))
+        session.flush()
+        record_medals(session, entries('1992 Summer', 'Test Judo', 'Bronze', 2)
+                      + entries('1992 Summer', 'Test Relay', 'Gold', 4)
+                      + entries('1996 Summer', 'Test Relay', 'Bronze', 2))
+        rows = session.execute(games_medals_statement(clauses, CountModes.EVENT),
+                               clause_params(clauses)).fetchall()
+        assert sorted((row.games, row.gold, row.bronze, row.total) for row in rows) == [
+            ('1992 Summer', 1, 2, 3), ('1996 Summer', 0, 1, 1)]
+        rows = session.execute(games_medals_statement(clauses, CountModes.ENTRY),
+                               clause_params(clauses)).fetchall()
+        assert sorted((row.games, row.total) for row in rows) == [('1992 Summer', 6), ('1996 Summer', 2)]
+        session.rollback()
+
+
+def test_get_noc_data_event_count_mode():
+    """
+    Test that event counting never reports more medals than entry counting
+    """
+    url = "http://127.0.0.1:8000/noc/USA?start_date=1980&end_date=1990&sport=basketball"
+    entries = requests.get(url).json()
+    events = requests.get(url + "&count_mode=event").json()
+    assert entries.keys() == events.keys()
+    for year in entries:
+        assert events[year]["medal_count"]["total"] <= entries[year]["medal_count"]["total"]
+        assert events[year]["total_entries"] == entries[year]["total_entries"]
+
+
+def test_event_count_mode_noc_is_case_insensitive():
+    """
+    Test that event counts of a lower-case NOC match the upper-case one
+    """
+    url = "http://127.0.0.1:8000/noc/{}?start_date=1990&end_date=2000&count_mode=event"
+    upper = requests.get(url.format("USA")).json()
+    assert any(year["medal_count"]["total"] for year in upper.values())
+    lower = requests.get(url.format("usa")).json()
+    assert {year: counts["medal_count"] for year, counts in lower.items()} == \
+        {year: counts["medal_count"] for year, counts in upper.items()}
@@ -0,0 +1,56 @@
+"""
+Pytest functions for the sampling profiler
+"""
+
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+from athlete_api import admin
+from athlete_api.main import app
+from athlete_api.profiler import Sampler
+
+
+def spin(until):
+    while time.perf_counter() < until:
+        pass
+
+
+def test_sampler_collapses_stacks_of_sampled_threads():
+    """
+     Test that the stacks of a busy thread are counted in the collapsed format and
+     that threads waiting for work are left out.
+    """
+    waiting = threading.Event()
+    idle = threading.Thread(target=waiting.wait, name='idle')
+    idle.start()
+    sampler = Sampler(0.001, threads={threading.get_ident(), idle.ident}).start()
+    spin(time.perf_counter() + 0.1)
+    sampler.stop()
+    waiting.set()
+    idle.join()
+    assert sampler.samples > 0
+    stack, count = max(sampler.stacks.items(), key=lambda item: item[1])
+    assert stack.startswith('MainThread;')
+    assert stack.endswith('test_profiler:spin')
+    assert not any(stack.startswith('idle;') for stack in sampler.stacks)
+    assert sampler.collapsed().splitlines()[0].endswith(f' {sampler.stacks[min(sampler.stacks)]}')
+
+
+def test_profiled_request_is_downloadable(monkeypatch):
+    """
+     Test that profile=true needs the admin token and that the profile of the
+     request can be downloaded with the id of its response.
+    """
+    client = TestClient(app)
+    monkeypatch.setitem(admin.options, 'token', 'secret')
+    assert client.get("/athletes/phelps?profile=true").status_code == 401
+    response = client.get("/athletes/phelps?profile=true", headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    profile_id = response.headers['X-Profile-Id']
+    profile = client.get(f"/admin/profiles/{profile_id}", headers={'X-Admin-Token': 'secret'})
+    assert profile.status_code == 200
+    assert profile.headers['Content-Disposition'] == f'attachment; filename="profile-{profile_id}.folded"'
+    assert int(profile.headers['X-Profile-Samples']) >= 0
+    assert client.get("/admin/profiles/unknown", headers={'X-Admin-Token': 'secret'}).status_code == 404
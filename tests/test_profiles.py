@@ -0,0 +1,44 @@
+"""
+Pytest functions for the athlete profile index
+"""
+
+from types import SimpleNamespace
+
+from athlete_api.models import Seasons
+from athlete_api.profiles import AthleteProfiles
+
+
+def entry(**fields):
+    """
+     Athlete entry with default values for the profile fields.
+    """
+    values = {'name': 'Test Name', 'team': 'Test Team', 'games': '2020 Summer',
+              'sport': 'Test Sport', 'medal': None}
+    values.update(fields)
+    return SimpleNamespace(**values)
+
+
+def test_profiles_add_remove():
+    """
+     Test that entries are aggregated per athlete and removed incrementally.
+    """
+    profiles = AthleteProfiles()
+    profiles.add(Seasons.SUMMER, entry(medal='Gold'))
+    profiles.add(Seasons.SUMMER, entry(games='2016 Summer'))
+    profiles.add(Seasons.WINTER, entry(games='2018 Winter', sport='Skiing'))
+    profiles.add(Seasons.SUMMER, entry(name='Other Tester'))
+
+    assert profiles.search('test name', exact=True) == {
+        'Test Name': {'medal_count': 1, 'teams': ['Test Team'],
+                      'games': ['2016 Summer', '2018 Winter', '2020 Summer'],
+                      'sports': ['Skiing', 'Test Sport']}}
+    assert list(profiles.search('test')) == ['Test Name', 'Other Tester']
+    assert profiles.search('test name', exact=True, season=Seasons.WINTER)['Test Name']['sports'] == ['Skiing']
+
+    profiles.remove(Seasons.WINTER, entry(games='2018 Winter', sport='Skiing'))
+    profiles.remove(Seasons.SUMMER, entry(medal='Gold'))
+    assert profiles.search('test name', exact=True) == {
+        'Test Name': {'medal_count': 0, 'teams': ['Test Team'],
+                      'games': ['2016 Summer'], 'sports': ['Test Sport']}}
+    profiles.remove(Seasons.SUMMER, entry(games='2016 Summer'))
+    assert profiles.search('test name') == {}
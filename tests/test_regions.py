@@ -0,0 +1,41 @@
+"""
+Pytest functions for the region index
+"""
+
+from athlete_api.models import Region
+from athlete_api.regions import RegionIndex
+
+
+def test_region_index_resolve():
+    """
+     Test exact and partial resolution of country names and index updates.
+    """
+    regions = RegionIndex()
+    regions.add(Region(noc="NO1", region="Test Region", notes=None))
+    regions.add(Region(noc="NO2", region="Test Region", notes="Test Notes"))
+    regions.add(Region(noc="NO3", region="Other Region", notes=None))
+
+    assert regions.resolve("test region") == {"NO1": ("Test Region", None),
+                                              "NO2": ("Test Region", "Test Notes")}
+    assert sorted(regions.resolve("region", exact=False)) == ["NO1", "NO2", "NO3"]
+    assert regions.resolve("region") == {}
+
+    regions.remove("NO2")
+    regions.add(Region(noc="NO3", region="Test Region", notes=None))
+    assert sorted(regions.resolve("test region")) == ["NO1", "NO3"]
+
+
+def test_region_index_nocs_are_case_insensitive():
+    """
+     Test that a region added with a lower-case NOC is found and removed by any case
+     and resolves to the NOC as stored.
+    """
+    regions = RegionIndex()
+    regions.add(Region(noc="no4", region="Lower Region", notes=None))
+    assert regions.get("NO4") == ("Lower Region", None)
+    assert regions.get("no4") == ("Lower Region", None)
+    assert regions.resolve("lower region") == {"no4": ("Lower Region", None)}
+    regions.add(Region(noc="NO4", region="Upper Region", notes=None))
+    assert regions.resolve("lower region") == {}
+    regions.remove("No4")
+    assert regions.get("no4") is None
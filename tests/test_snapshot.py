@@ -0,0 +1,85 @@
+"""
+Pytest functions for the dataset snapshot
+"""
+
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from athlete_api.models import AthleteSummer, Region
+from athlete_api.services import EngineRouter, ShardRouter
+from athlete_api.snapshot import SnapshotRefresher, SnapshotStore, write_snapshot
+
+
+def test_snapshot_round_trip(tmp_path):
+    """
+     Test that a written snapshot maps back to the same values and that new generations are picked up.
+    """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                           poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(Region(noc="NO1", region="Test Region 1", notes=None))
+        session.add(AthleteSummer(id=1, name="Test Name", sex="M", age=25.0, team="Test Team",
+                                  noc="NO1", games="2020 Summer", year=2020, season="Summer",
+                                  city="Test City", sport="Test Sport", event="Test Event",
+                                  medal="Gold"))
+        session.commit()
+
+    write_snapshot(EngineRouter(engine), str(tmp_path))
+    store = SnapshotStore(str(tmp_path))
+    snapshot = store.current()
+    assert snapshot.generation == 1
+    assert snapshot.rows('athletes_summer') == 1
+    assert list(snapshot.values('athletes_summer', 'name')) == ["Test Name"]
+    assert snapshot.values('athletes_summer', 'name')[0] == "Test Name"
+    assert list(snapshot.values('athletes_summer', 'age')) == [25.0]
+    assert list(snapshot.values('athletes_summer', 'year')) == [2020]
+    assert list(snapshot.values('regions', 'notes')) == [None]
+    assert snapshot.values('regions', 'notes')[0] is None
+    assert snapshot.rows('athletes_winter') == 0
+    assert snapshot.cache_generations == {'athletes': [0], 'regions': 0}
+
+    write_snapshot(EngineRouter(engine), str(tmp_path))
+    assert store.current().generation == 2
+
+
+def test_snapshot_refresher_writes_changes_once(tmp_path):
+    """
+     Test that the refresher writes a new snapshot only when the tables changed since the current one.
+    """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                           poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    current = {'athletes': [0], 'regions': 0}
+    refresher = SnapshotRefresher(str(tmp_path), lambda directory: write_snapshot(EngineRouter(engine), directory),
+                                  lambda: current, delay=60)
+    assert refresher.refresh() is not None
+    assert refresher.refresh() is None
+    current = {'athletes': [1], 'regions': 0}
+    assert refresher.refresh() is not None
+    assert SnapshotStore(str(tmp_path)).current().generation == 2
+
+
+def test_snapshot_gathers_the_shards(tmp_path):
+    """
+     Test that the athletes of every shard are written with the generation of each shard.
+    """
+    engines = []
+    for noc in ("NO1", "NO2"):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                               poolclass=StaticPool)
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(Region(noc=noc, region=f"Test Region {noc}", notes=None))
+            session.add(AthleteSummer(name=f"Tester {noc}", sex="F", age=25.0, team="Test Team",
+                                      noc=noc, games="2020 Summer", year=2020, season="Summer",
+                                      city="Test City", sport="Test Sport", event="Test Event"))
+            session.commit()
+        engines.append(EngineRouter(engine))
+    router = ShardRouter(engines[0], {'first': engines[0], 'second': engines[1]})
+
+    write_snapshot(router, str(tmp_path))
+    snapshot = SnapshotStore(str(tmp_path)).current()
+    assert sorted(snapshot.values('athletes_summer', 'name')) == ["Tester NO1", "Tester NO2"]
+    assert list(snapshot.values('regions', 'noc')) == ["NO1"]
+    assert snapshot.cache_generations == {'athletes': [0, 0], 'regions': 0}
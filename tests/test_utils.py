@@ -0,0 +1,64 @@
+"""
+Pytest functions for helper functions
+"""
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from athlete_api.models import AthleteSummer
+from athlete_api.utils import (StatementCache, add_where, clause_params, clause_shape,
+                               parse_fields, project, select_columns)
+
+
+def test_clause_shape_and_params():
+    """
+     Test that skipped clauses are left out of the shape and the parameters.
+    """
+    clauses = [('noc', 'FIN', 'equal'), ('sport', None, 'equal'),
+               ('year', 1990, 'gte'), ('year', None, 'lte')]
+    assert clause_shape(clauses) == (('noc', 'equal', 'str'), ('year', 'gte', 'int'))
+    assert clause_params(clauses) == {'noc_equal': 'fin', 'year_gte': 1990}
+
+
+def test_statement_cache_binds_parameters():
+    """
+     Test that statements of the same shape are built once and take their values as parameters.
+    """
+    cache = StatementCache('test')
+    builds = []
+
+    def build(clauses):
+        builds.append(clauses)
+        return add_where(select_columns(AthleteSummer, ('name',)), clauses, bind=True)
+
+    for noc in ('FIN', 'SWE'):
+        clauses = [('noc', noc, 'equal'), ('year', 1990, 'gte')]
+        statement = cache.get(clause_shape(clauses), lambda: build(clauses))
+    assert len(builds) == 1
+    compiled = statement.compile(dialect=postgresql.dialect())
+    assert 'lower(noc) = %(noc_equal)s' in str(compiled)
+    assert 'year >= %(year_gte)s' in str(compiled)
+
+
+def test_parse_fields_and_project():
+    """
+     Test that requested fields are validated and entries are restricted to them.
+    """
+    allowed = ('name', 'year', 'event', 'medal')
+    assert parse_fields(None, allowed) is None
+    assert parse_fields(' Name, year,name ', allowed) == ('name', 'year')
+    with pytest.raises(ValueError):
+        parse_fields('name,height', allowed)
+    rows = [{'name': 'A', 'year': 1904, 'event': 'Athletics 100m', 'medal': None}]
+    assert project(rows, None) is rows
+    assert project(rows, ('name', 'medal')) == [{'name': 'A', 'medal': None}]
+
+
+@pytest.mark.parametrize("clause", [('noc', 'USA', 'unequal'), ('noc', 'USA', 'in'),
+                                    ('year', 2000, 'contain'), ('year', [2000], 'gte')])
+def test_add_where_refuses_unsupported_relations(clause):
+    """
+     Test that a clause without a filter for its value type raises instead of being dropped.
+    """
+    with pytest.raises(ValueError):
+        add_where(select_columns(AthleteSummer, ('name',)), [clause])
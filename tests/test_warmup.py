@@ -0,0 +1,73 @@
+"""
+Pytest functions for the cache warm-up
+"""
+
+from athlete_api.coalesce import coalesce, request_key
+from athlete_api.models import Seasons
+from athlete_api.warmup import TopK, WarmUp
+
+calls = []
+
+
+@coalesce
+def get_data(name: str, season: Seasons = Seasons.UNION):
+    calls.append((name, season))
+    return name
+
+
+def test_top_k_keeps_frequent_keys():
+    """
+     Test that the bounded log keeps the heavy hitters when rare keys keep arriving.
+    """
+    log = TopK(3)
+    for index in range(100):
+        log.record('hot')
+        log.record(f'rare {index}')
+    assert len(log) == 3
+    assert log.top(1) == [('hot', 100)]
+
+
+def test_warm_up_replays_saved_log(tmp_path):
+    """
+     Test that recorded requests survive a restart and are replayed with their enum parameters.
+    """
+    path = str(tmp_path / 'warmup.json')
+    recorder = WarmUp({'get_data': get_data}, path=path)
+    for _ in range(3):
+        recorder.record('get_data', request_key(get_data.__wrapped__, 'Jan', season=Seasons.WINTER))
+    recorder.record('get_data', request_key(get_data.__wrapped__, 'Eva'))
+    recorder.record('other', ())
+    recorder.stop()
+
+    warmup = WarmUp({'get_data': get_data}, path=path, replay=1)
+    warmup.load()
+    calls.clear()
+    status = warmup.replay()
+    assert calls == [('Jan', Seasons.WINTER)]
+    assert status['replayed'] == 1
+    assert status['coverage'] == 0.75
+
+
+def test_warm_up_merges_the_logs_of_all_workers(tmp_path):
+    """
+     Test that every worker saves its own log, that a restarted worker replays the
+     merged logs without the skipped requests and removes the old files once it saved.
+    """
+    path = str(tmp_path / 'warmup.json')
+    skip = lambda name, params: params['name'] == 'Memory'
+    for worker, names in (('1', ['Jan']), ('2', ['Eva', 'Eva', 'Memory'])):
+        recorder = WarmUp({'get_data': get_data}, path=path, skip=skip, worker=worker)
+        for name in names:
+            recorder.record('get_data', request_key(get_data.__wrapped__, name))
+        recorder.stop()
+    assert sorted(file.name for file in tmp_path.iterdir()) == ['warmup.1.json', 'warmup.2.json']
+
+    warmup = WarmUp({'get_data': get_data}, path=path, skip=skip, worker='3')
+    warmup.history.record(('get_data', request_key(get_data.__wrapped__, 'Memory')), 5)
+    warmup.load()
+    calls.clear()
+    assert warmup.replay()['replayed'] == 2
+    assert calls == [('Eva', Seasons.UNION), ('Jan', Seasons.UNION)]
+    warmup.record('get_data', request_key(get_data.__wrapped__, 'Jan'))
+    warmup.stop()
+    assert [file.name for file in tmp_path.iterdir()] == ['warmup.3.json']